@@ -1,8 +1,10 @@
-import re
+import asyncio
 from abc import ABCMeta, abstractmethod, abstractproperty
 from collections import Sequence
 from flex.utils.decorators import export
 
+from .tokens import token_cache
+
 
 class ABC(object, metaclass=ABCMeta):
 	__slots__ = ()
@@ -43,6 +45,113 @@ class CacheBackendABC(AppBoundInstanceABC):
 	def expire(self, key, timeout):
 		raise NotImplementedError('%s.expire' % self.__class__.__name__)
 
+	def get_many(self, keys):
+		"""Returns a dict of the given keys to their values. Missing keys are
+		left out.
+		"""
+		rv = {}
+		for key in keys:
+			value = self.get(key)
+			if value is not None:
+				rv[key] = value
+		return rv
+
+	def set_many(self, mapping, timeout=None):
+		for key, value in mapping.items():
+			self.set(key, value, timeout)
+
+	def delete_many(self, keys):
+		for key in keys:
+			self.delete(key)
+
+	#: Whether the backend can read and write individual fields of a hash
+	#: value with `get_fields()` and `set_fields()`.
+	supports_fields = False
+
+	def get_fields(self, key):
+		"""Returns the dict of fields stored under key or None."""
+		raise NotImplementedError('%s.get_fields' % self.__class__.__name__)
+
+	def set_fields(self, key, mapping, timeout=None):
+		"""Update the given fields of the hash stored under key."""
+		raise NotImplementedError('%s.set_fields' % self.__class__.__name__)
+
+	#: Whether the backend supports versioned compare-and-set writes with
+	#: `cas()` and `cas_fields()`.
+	supports_cas = False
+
+	#: Whether the backend's store is only used by this process, so that the
+	#: versions written by this process are all the versions there are.
+	in_process = False
+
+	def cas(self, key, value, version, timeout=None):
+		"""Set key to value if the version of the stored value is version then
+		increment the stored version. Missing keys have version 0. Returns
+		True if the value was set and False otherwise.
+		"""
+		raise NotImplementedError('%s.cas' % self.__class__.__name__)
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		"""Like `cas()` but updates the given fields of the hash stored
+		under key.
+		"""
+		raise NotImplementedError('%s.cas_fields' % self.__class__.__name__)
+
+
+
+@export
+class AsyncCacheBackendABC(AppBoundInstanceABC):
+	"""An asyncio cache backend. Same as `CacheBackendABC` with coroutine
+	methods.
+	"""
+
+	__slots__ = ()
+
+	@abstractmethod
+	async def get(self, key):
+		raise NotImplementedError('%s.get' % self.__class__.__name__)
+
+	@abstractmethod
+	async def set(self, key, value, timeout=None):
+		raise NotImplementedError('%s.set' % self.__class__.__name__)
+
+	@abstractmethod
+	async def delete(self, key):
+		raise NotImplementedError('%s.delete' % self.__class__.__name__)
+
+	@abstractmethod
+	async def expire(self, key, timeout):
+		raise NotImplementedError('%s.expire' % self.__class__.__name__)
+
+	async def get_many(self, keys):
+		keys = list(keys)
+		values = await asyncio.gather(*(self.get(key) for key in keys))
+		return {k: v for k, v in zip(keys, values) if v is not None}
+
+	async def set_many(self, mapping, timeout=None):
+		await asyncio.gather(*(self.set(k, v, timeout) for k, v in mapping.items()))
+
+	async def delete_many(self, keys):
+		await asyncio.gather(*(self.delete(key) for key in keys))
+
+	supports_fields = False
+
+	async def get_fields(self, key):
+		raise NotImplementedError('%s.get_fields' % self.__class__.__name__)
+
+	async def set_fields(self, key, mapping, timeout=None):
+		raise NotImplementedError('%s.set_fields' % self.__class__.__name__)
+
+	supports_cas = False
+
+	in_process = False
+
+	async def cas(self, key, value, version, timeout=None):
+		raise NotImplementedError('%s.cas' % self.__class__.__name__)
+
+	async def cas_fields(self, key, mapping, version, timeout=None):
+		raise NotImplementedError('%s.cas_fields' % self.__class__.__name__)
+
 
 
 @export
@@ -60,11 +169,51 @@ class SessionManagerABC(ABC):
 
 
 @export
-class UssdDataSequence(Sequence):
+class AsyncSessionManagerABC(ABC):
+	__slots__ = ()
+
+	@abstractmethod
+	async def open(self, request):
+		raise NotImplementedError('%s.open' % self.__class__.__name__)
+
+	@abstractmethod
+	async def close(self, session, response):
+		raise NotImplementedError('%s.close' % self.__class__.__name__)
+
 
+
+@export
+class SessionCodecABC(ABC):
 	__slots__ = ()
 
-	_arg_splitter = re.compile(r'\*(?=(?:[^\"]*\"[^\"]*\")*[^\"]*$)')
+	@abstractmethod
+	def encode(self, session) -> bytes:
+		raise NotImplementedError('%s.encode' % self.__class__.__name__)
+
+	@abstractmethod
+	def decode(self, value: bytes):
+		raise NotImplementedError('%s.decode' % self.__class__.__name__)
+
+	#: Whether the codec implements `encode_fields()`, `decode_fields()`,
+	#: `changed_fields()` and `encode_changes()` for dirty-tracking.
+	supports_fields = False
+
+
+
+@export
+class InstrumentationExporterABC(ABC):
+	__slots__ = ()
+
+	@abstractmethod
+	def export(self, snapshot):
+		raise NotImplementedError('%s.export' % self.__class__.__name__)
+
+
+
+@export
+class UssdDataSequence(Sequence):
+
+	__slots__ = ()
 
 	@property
 	@abstractmethod
@@ -77,7 +226,7 @@ class UssdDataSequence(Sequence):
 
 	def parse_ussd_data(self, value):
 		if isinstance(value, str):
-			return (re.sub(r'^\"(.*)\"$', r'\1', str(c)) for c in self._arg_splitter.split(value))
+			return token_cache.get(value)
 		return value
 
 	@abstractmethod
@@ -87,24 +236,18 @@ class UssdDataSequence(Sequence):
 	def equals(self, other):
 		"""Check equality against strings, lists and tuples.
 		"""
-		if isinstance(other, UssdDataSequence):
-			return self.ussd_data == other.ussd_data
-		else:
-			try:
-				other = self.parse_ussd_data(other)
-				if not isinstance(other, list):
-					other = list(other)
-			except (TypeError, ValueError):
-				return False
+		try:
+			other = other.ussd_data if isinstance(other, UssdDataSequence) else self.parse_ussd_data(other)
+			if not isinstance(other, list):
+				other = list(other)
+		except (TypeError, ValueError):
+			return False
 		return self.ussd_data == other
 
 	def startswith(self, other, start=None, end=None):
-		if isinstance(other, UssdDataSequence):
-			other = other.ussd_data
-		else:
-			other = self.parse_ussd_data(other)
-			if not isinstance(other, list):
-				other = list(other)
+		other = other.ussd_data if isinstance(other, UssdDataSequence) else self.parse_ussd_data(other)
+		if not isinstance(other, list):
+			other = list(other)
 
 		target = self.ussd_data if start is None and end is None else self.ussd_data[start:end]
 		olen, tlen = len(other), len(target)
@@ -116,12 +259,9 @@ class UssdDataSequence(Sequence):
 			return False
 
 	def endswith(self, other, start=None, end=None):
-		if isinstance(other, UssdDataSequence):
-			other = other.ussd_data
-		else:
-			other = self.parse_ussd_data(other)
-			if not isinstance(other, list):
-				other = list(other)
+		other = other.ussd_data if isinstance(other, UssdDataSequence) else self.parse_ussd_data(other)
+		if not isinstance(other, list):
+			other = list(other)
 
 		target = self.ussd_data if start is None and end is None else self.ussd_data[start:end]
 		olen, tlen = len(other), len(target)
@@ -1,14 +1,22 @@
+from collections import OrderedDict
+from inspect import isawaitable
+from threading import Lock
+from time import monotonic
+
 from flex.utils.decorators import export
-from flex.utils.module_loading import import_if_string
+from flex.utils.module_loading import import_if_string, import_strings
+from flex.utils.void import Void
 
+from .abc import CacheBackendABC, AsyncCacheBackendABC
 
-from .abc import CacheBackendABC
 
 
-@export
-class CacheBackend(CacheBackendABC):
+class _StoreBackend(object):
+	"""Store configuration and key prefixing shared by the sync and async
+	cache backends.
+	"""
 
-	__slots__ = ('_store', 'key_prefix')
+	__slots__ = ()
 
 	def __init__(self, app=None, store=None, key_prefix=None):
 		self.set_store(store)
@@ -36,7 +44,7 @@ class CacheBackend(CacheBackendABC):
 		if 'store' in config:
 			self.set_store(config['store'])
 
-		if not self.store:
+		if self.store is None:
 			raise AttributeError(
 				'Required attribute store not configured for cache backend %s on app %s.'\
 				% (self.__class__.__name__, app.name)
@@ -45,6 +53,26 @@ class CacheBackend(CacheBackendABC):
 	def make_key(self, key):
 		return '%s%s%s' % (self.key_prefix, self.key_prefix and ':', key)
 
+	@property
+	def supports_fields(self):
+		store = self.store
+		return hasattr(store, 'get_fields') and hasattr(store, 'set_fields')
+
+	@property
+	def supports_cas(self):
+		return hasattr(self.store, 'cas')
+
+	@property
+	def in_process(self):
+		return getattr(self.store, 'in_process', False)
+
+
+
+@export
+class CacheBackend(_StoreBackend, CacheBackendABC):
+
+	__slots__ = ('_store', 'key_prefix')
+
 	def get(self, key):
 		return self.store.get(self.make_key(key))
 
@@ -57,4 +85,343 @@ class CacheBackend(CacheBackendABC):
 	def expire(self, key, timeout):
 		return self.store.expire(self.make_key(key), timeout)
 
+	def get_many(self, keys):
+		"""Returns a dict of the given keys to their values in one round-trip
+		if the store has a `get_many` method. Missing keys are left out.
+		"""
+		get_many = getattr(self.store, 'get_many', None)
+		if get_many is None:
+			return super(CacheBackend, self).get_many(keys)
+
+		keys = {self.make_key(k): k for k in keys}
+		return {keys[k]: v for k, v in get_many(list(keys)).items() if v is not None}
+
+	def set_many(self, mapping, timeout=None):
+		set_many = getattr(self.store, 'set_many', None)
+		if set_many is None:
+			return super(CacheBackend, self).set_many(mapping, timeout)
+		return set_many({self.make_key(k): v for k, v in mapping.items()}, timeout)
+
+	def delete_many(self, keys):
+		delete_many = getattr(self.store, 'delete_many', None)
+		if delete_many is None:
+			return super(CacheBackend, self).delete_many(keys)
+		return delete_many([self.make_key(k) for k in keys])
+
+	def get_fields(self, key):
+		return self.store.get_fields(self.make_key(key))
+
+	def set_fields(self, key, mapping, timeout=None):
+		return self.store.set_fields(self.make_key(key), mapping, timeout)
+
+	def cas(self, key, value, version, timeout=None):
+		return self.store.cas(self.make_key(key), value, version, timeout)
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		return self.store.cas_fields(self.make_key(key), mapping, version, timeout)
+
+
+
+async def _resolve(value):
+	return (await value) if isawaitable(value) else value
+
+
+
+@export
+class AsyncCacheBackend(_StoreBackend, AsyncCacheBackendABC):
+	"""An asyncio cache backend.
+
+	The store's methods may be coroutine functions (e.g. an asyncio redis
+	client) or plain ones for in-process stores. Native `get_many`,
+	`set_many` and `delete_many` store methods are used when present.
+	"""
+
+	__slots__ = ('_store', 'key_prefix')
+
+	async def get(self, key):
+		return await _resolve(self.store.get(self.make_key(key)))
+
+	async def set(self, key, value, timeout=None):
+		return await _resolve(self.store.set(self.make_key(key), value, timeout))
+
+	async def delete(self, key):
+		return await _resolve(self.store.delete(self.make_key(key)))
+
+	async def expire(self, key, timeout):
+		return await _resolve(self.store.expire(self.make_key(key), timeout))
+
+	async def get_many(self, keys):
+		get_many = getattr(self.store, 'get_many', None)
+		if get_many is None:
+			return await super(AsyncCacheBackend, self).get_many(keys)
+
+		keys = {self.make_key(k): k for k in keys}
+		values = await _resolve(get_many(list(keys)))
+		return {keys[k]: v for k, v in values.items() if v is not None}
+
+	async def set_many(self, mapping, timeout=None):
+		set_many = getattr(self.store, 'set_many', None)
+		if set_many is None:
+			return await super(AsyncCacheBackend, self).set_many(mapping, timeout)
+		return await _resolve(set_many({self.make_key(k): v for k, v in mapping.items()}, timeout))
+
+	async def delete_many(self, keys):
+		delete_many = getattr(self.store, 'delete_many', None)
+		if delete_many is None:
+			return await super(AsyncCacheBackend, self).delete_many(keys)
+		return await _resolve(delete_many([self.make_key(k) for k in keys]))
+
+	async def get_fields(self, key):
+		return await _resolve(self.store.get_fields(self.make_key(key)))
+
+	async def set_fields(self, key, mapping, timeout=None):
+		return await _resolve(self.store.set_fields(self.make_key(key), mapping, timeout))
+
+	async def cas(self, key, value, version, timeout=None):
+		return await _resolve(self.store.cas(self.make_key(key), value, version, timeout))
+
+	async def cas_fields(self, key, mapping, version, timeout=None):
+		return await _resolve(self.store.cas_fields(self.make_key(key), mapping, version, timeout))
+
+
+
+@export
+class LRUCache(object):
+	"""A bounded, thread-safe LRU mapping with per-entry TTLs.
+
+	Expired entries are dropped lazily when read. When full, the least
+	recently used entry is evicted.
+	"""
+
+	__slots__ = ('maxsize', '_data', '_lock', 'clock')
+
+	def __init__(self, maxsize=1024, clock=monotonic):
+		self.maxsize = maxsize
+		self.clock = clock
+		self._data = OrderedDict()
+		self._lock = Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is None:
+				return default
+			elif entry[0] is not None and entry[0] <= self.clock():
+				del self._data[key]
+				return default
+			self._data.move_to_end(key)
+			return entry[1]
+
+	def set(self, key, value, timeout=None):
+		expires = None if timeout is None else self.clock() + timeout
+		with self._lock:
+			self._data[key] = (expires, value)
+			self._data.move_to_end(key)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+
+	def expire(self, key, timeout):
+		with self._lock:
+			entry = self._data.get(key)
+			if entry is not None:
+				self._data[key] = (None if timeout is None else self.clock() + timeout, entry[1])
+
+	def delete(self, key):
+		with self._lock:
+			self._data.pop(key, None)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def __contains__(self, key):
+		return self.get(key, Void) is not Void
+
+	def __len__(self):
+		return len(self._data)
+
+
+
+@export
+class NearCacheBackend(CacheBackend):
+	"""A two-tier cache backend keeping recently used values in a bounded
+	in-process `LRUCache` in front of the shared store.
+
+	Writes always go through to the store. The `mode` controls what is kept
+	locally:
+
+		- READ_YOUR_WRITES (default): only values written by this worker, so
+		  a worker never reads anything older than its own last write.
+		- WRITE_THROUGH: values read from or written to the store.
+
+	Local entries live for at most `near_timeout` seconds (or the timeout they
+	were set with if shorter) and are not invalidated when other workers
+	write the same keys unless `invalidation_hooks` are set up to do so.
+	Both modes require sticky load balancing (all turns of a session on the
+	same worker) or invalidation. Otherwise a worker can read a value up to
+	`near_timeout` seconds older than another worker's write.
+
+	Values written with `cas()` or `cas_fields()` (i.e. versioned sessions)
+	are never kept locally and their keys are always read from the store, so
+	a version check is never made against a stale local copy.
+
+	`invalidation_hooks` are called with the (unprefixed) key after every
+	write or delete, e.g. to publish invalidations to other workers, which
+	then call `invalidate()`.
+
+	Hash fields (`get_fields()`/`set_fields()`) are only kept locally once
+	the whole hash is known, i.e. after a read in WRITE_THROUGH mode.
+
+	Values are cached by reference and must not be mutated after `set()`.
+	Options are read from the app's config with the `cache_near_` prefix.
+	"""
+
+	__slots__ = ('mode', 'near_timeout', 'local', 'versioned', 'invalidation_hooks')
+
+	WRITE_THROUGH = 'write_through'
+	READ_YOUR_WRITES = 'read_your_writes'
+
+	def __init__(self, app=None, store=None, key_prefix=None, maxsize=1024,
+				near_timeout=30, mode=READ_YOUR_WRITES, invalidation_hooks=()):
+		self.mode = mode
+		self.near_timeout = near_timeout
+		self.local = LRUCache(maxsize)
+		self.versioned = LRUCache(maxsize)
+		self.invalidation_hooks = list(invalidation_hooks)
+		super(NearCacheBackend, self).__init__(app, store, key_prefix)
+
+	def init_app(self, app):
+		super(NearCacheBackend, self).init_app(app)
+		config = app.config.namespace('cache_near_')
+		self.mode = config.get('mode', self.mode)
+		self.near_timeout = config.get('timeout', self.near_timeout)
+		self.local.maxsize = self.versioned.maxsize = config.get('maxsize', self.local.maxsize)
+		self.invalidation_hooks.extend(import_strings(config.get('invalidation_hooks', ())))
+
+		if self.mode not in (self.WRITE_THROUGH, self.READ_YOUR_WRITES):
+			raise ValueError('Invalid near cache mode %r on app %s.' % (self.mode, app.name))
+
+	def local_timeout(self, timeout):
+		if timeout is None or self.near_timeout is None:
+			return self.near_timeout if timeout is None else timeout
+		return min(timeout, self.near_timeout)
+
+	def add_invalidation_hook(self, hook):
+		self.invalidation_hooks.append(hook)
+
+	def invalidate(self, key):
+		"""Drop key from the local cache."""
+		self.local.delete(key)
+		self.local.delete(('fields', key))
+
+	def clear_local(self):
+		self.local.clear()
+
+	def _written(self, key):
+		for hook in self.invalidation_hooks:
+			hook(key)
+
+	def _versioned(self, key):
+		self.invalidate(key)
+		self.versioned.set(key, True)
+
+	def caches_reads(self, key):
+		return self.mode == self.WRITE_THROUGH and key not in self.versioned
+
+	def get(self, key):
+		rv = self.local.get(key, Void)
+		if rv is Void:
+			rv = super(NearCacheBackend, self).get(key)
+			if rv is not None and self.caches_reads(key):
+				self.local.set(key, rv, self.near_timeout)
+		return rv
+
+	def set(self, key, value, timeout=None):
+		rv = super(NearCacheBackend, self).set(key, value, timeout)
+		self.local.delete(('fields', key))
+		self.local.set(key, value, self.local_timeout(timeout))
+		self._written(key)
+		return rv
+
+	def delete(self, key):
+		rv = super(NearCacheBackend, self).delete(key)
+		self.invalidate(key)
+		self._written(key)
+		return rv
+
+	def get_many(self, keys):
+		rv, missing = {}, []
+		for key in keys:
+			value = self.local.get(key, Void)
+			if value is Void:
+				missing.append(key)
+			else:
+				rv[key] = value
+
+		if missing:
+			found = super(NearCacheBackend, self).get_many(missing)
+			if self.mode == self.WRITE_THROUGH:
+				for key, value in found.items():
+					if key not in self.versioned:
+						self.local.set(key, value, self.near_timeout)
+			rv.update(found)
+		return rv
+
+	def set_many(self, mapping, timeout=None):
+		rv = super(NearCacheBackend, self).set_many(mapping, timeout)
+		local_timeout = self.local_timeout(timeout)
+		for key, value in mapping.items():
+			self.local.delete(('fields', key))
+			self.local.set(key, value, local_timeout)
+			self._written(key)
+		return rv
+
+	def delete_many(self, keys):
+		keys = list(keys)
+		rv = super(NearCacheBackend, self).delete_many(keys)
+		for key in keys:
+			self.invalidate(key)
+			self._written(key)
+		return rv
+
+	def expire(self, key, timeout):
+		rv = super(NearCacheBackend, self).expire(key, timeout)
+		self.local.expire(key, self.local_timeout(timeout))
+		self.local.expire(('fields', key), self.local_timeout(timeout))
+		return rv
+
+	def cas(self, key, value, version, timeout=None):
+		self._versioned(key)
+		rv = super(NearCacheBackend, self).cas(key, value, version, timeout)
+		if rv:
+			self._written(key)
+		return rv
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		self._versioned(key)
+		rv = super(NearCacheBackend, self).cas_fields(key, mapping, version, timeout)
+		if rv:
+			self._written(key)
+		return rv
+
+	def get_fields(self, key):
+		rv = self.local.get(('fields', key), Void)
+		if rv is Void:
+			rv = super(NearCacheBackend, self).get_fields(key)
+			if rv and self.caches_reads(key):
+				self.local.set(('fields', key), dict(rv), self.near_timeout)
+		return rv and dict(rv)
 
+	def set_fields(self, key, mapping, timeout=None):
+		rv = super(NearCacheBackend, self).set_fields(key, mapping, timeout)
+		self.local.delete(key)
+		# Only a fully known hash can be kept locally.
+		current = self.local.get(('fields', key))
+		if current is None:
+			self.local.delete(('fields', key))
+		else:
+			current = dict(current)
+			current.update(mapping)
+			self.local.set(('fields', key), current, self.local_timeout(timeout))
+		self._written(key)
+		return rv
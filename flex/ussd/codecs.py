@@ -0,0 +1,359 @@
+import datetime
+import marshal
+import pickle
+from operator import itemgetter
+
+from flex.utils.decorators import export
+
+from .abc import SessionCodecABC
+from .screens import screens
+
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+# Session attributes that are not persisted.
+_TRANSIENT_ATTRS = frozenset((
+	'_is_started', '_history', 'request', '_snapshot', 'aux', '_aux_snapshot', '_lease', '_winner'
+))
+
+# Session attributes with their own slot in the binary payload.
+_PAYLOAD_ATTRS = frozenset((
+	'key', 'created_at', 'accessed_at', 'version', 'data', 'ctx', 'argv',
+	'ussd_string', 'last_response', '_history_stack', 'screen', 'restored',
+))
+
+_NON_EXTRA_ATTRS = _PAYLOAD_ATTRS | _TRANSIENT_ATTRS
+
+# Positions of the mapping fields in the flattened session. Values that can't
+# be encoded natively are pickled one key at a time in these.
+_DATA, _CTX, _SCREEN_STATE, _EXTRAS = 5, 6, 12, 14
+_MAPPING_FIELDS = frozenset((_DATA, _CTX, _SCREEN_STATE, _EXTRAS))
+
+# Named groups of positions in the flattened session. Each group is encoded
+# separately so that changes can be detected and written per field.
+SESSION_FIELDS = (
+	('key', (0, 1)),
+	('time', (2, 3, 4)),
+	('data', (_DATA,)),
+	('ctx', (_CTX,)),
+	('input', (7, 8, 9)),
+	('history', (10,)),
+	('screen', (11, _SCREEN_STATE)),
+	('meta', (13, _EXTRAS)),
+)
+
+SESSION_FIELD_NAMES = tuple(name for name, _ in SESSION_FIELDS)
+
+_FIELD_GETTERS = tuple((name, itemgetter(*positions)) for name, positions in SESSION_FIELDS)
+_FIELD_SCALARS = tuple((name, len(positions) == 1) for name, positions in SESSION_FIELDS)
+
+# Prefixes fields with values that were pickled. Marshal output never starts
+# with a null byte.
+_PICKLED = b'\x00'
+
+
+
+@export
+class PickleSessionCodec(SessionCodecABC):
+	"""Encodes sessions with pickle."""
+
+	__slots__ = ('session_class', 'key_class', 'protocol')
+
+	def __init__(self, session_class=None, key_class=None, protocol=pickle.HIGHEST_PROTOCOL):
+		self.session_class = session_class
+		self.key_class = key_class
+		self.protocol = protocol
+
+	def encode(self, session):
+		return pickle.dumps(session, self.protocol)
+
+	def decode(self, value):
+		return pickle.loads(value)
+
+
+
+@export
+class BinarySessionCodec(SessionCodecABC):
+	"""A compact, versioned binary session codec.
+
+	The session is flattened into a tuple of builtin values and serialized
+	with marshal. Timestamps are stored as integer microseconds since the
+	epoch, the data and context bags as plain dicts and the screen as its
+	registered name and state. Values marshal can't encode (e.g. custom
+	objects in `session.data`) are pickled individually.
+
+	Stores that support hash fields get the session as a set of named
+	fields (see `SESSION_FIELDS`) so that `encode_fields()` and
+	`decode_fields()` can be used to detect and write only the fields that
+	changed. Single values keep the values of the `soft_fields` apart from
+	the rest so that `encode_changes()` can tell if anything else changed
+	with a single comparison. Changes to the soft fields (the timestamps)
+	alone don't make a session dirty. The session's version is in the time
+	field but it's only incremented when the session is written.
+
+	Encoded values start with `MAGIC` followed by a version byte. Other
+	versions are rejected. Pickled sessions (starting with the pickle
+	protocol opcode) are still decoded so that sessions written with
+	`PickleSessionCodec` survive the switch.
+	"""
+
+	__slots__ = ('session_class', 'key_class', '_header', '_parts')
+
+	MAGIC = b'\xa5u'
+	VERSION = 1
+	# Version 2 is the last marshal format without object references. Later
+	# versions flag objects by their refcount, so equal values could encode
+	# differently and fields would look dirty when they are not.
+	MARSHAL_VERSION = 2
+
+	supports_fields = True
+
+	soft_fields = frozenset(('time',))
+
+	def __init__(self, session_class=None, key_class=None):
+		if session_class is None or key_class is None:
+			from .sessions import Session, SessionKey
+			session_class = session_class or Session
+			key_class = key_class or SessionKey
+		self.session_class = session_class
+		self.key_class = key_class
+		self._header = self.header
+		self._parts = _split_payload(self.soft_fields)
+
+	@property
+	def header(self):
+		return self.MAGIC + bytes((self.VERSION,))
+
+	def encode(self, session):
+		return self._encode(session)[0]
+
+	def decode(self, value):
+		magic, version = value[:len(self.MAGIC)], value[len(self.MAGIC):len(self.MAGIC)+1]
+		if magic != self.MAGIC:
+			if value[:1] == b'\x80':
+				return pickle.loads(value)
+			raise ValueError('Unknown session encoding %r.' % (value[:3],))
+
+		if version != self._header[len(self.MAGIC):]:
+			raise ValueError('Unsupported session encoding version %r.' % (version,))
+
+		soft_positions, soft, hard = marshal.loads(value[len(self.MAGIC)+1:])
+		payload = list(_unpack(hard))
+		for i, v in zip(soft_positions, _unpack(soft) if isinstance(soft, bytes) else soft):
+			payload.insert(i, v)
+		session = self.restore(payload)
+		session._snapshot = hard
+		return session
+
+	def encode_changes(self, session):
+		"""Encode the session into a single value.
+
+		Returns a `(value, changed)` tuple where changed tells if anything
+		but the `soft_fields` changed since the session was decoded or last
+		encoded or is None if it was neither.
+
+		The last input (`argv`, `ussd_string` and `last_response`) is not
+		soft since it must be written, and it changes every turn. So changed
+		is only False for retransmits of the last turn.
+		"""
+		value, hard = self._encode(session)
+		snapshot = session.__dict__.get('_snapshot')
+		session._snapshot = hard
+		return value, (snapshot != hard if isinstance(snapshot, bytes) else None)
+
+	def _encode(self, session):
+		payload, version = self.flatten(session), self.MARSHAL_VERSION
+		soft_positions, soft, hard_positions, hard = self._parts
+		hard = _pack_values(payload, hard_positions, hard)
+		try:
+			body = marshal.dumps((soft_positions, soft(payload), hard), version)
+		except ValueError:
+			body = marshal.dumps((soft_positions, _pack_values(payload, soft_positions, soft), hard), version)
+		return self._header + body, hard
+
+	def encode_fields(self, session):
+		"""Encode the session into a dict of field names to bytes."""
+		payload, dumps, version = self.flatten(session), marshal.dumps, self.MARSHAL_VERSION
+		try:
+			return {name: dumps(get(payload), version) for name, get in _FIELD_GETTERS}
+		except ValueError:
+			return {name: _pack(payload, positions) for name, positions in SESSION_FIELDS}
+
+	def decode_fields(self, fields):
+		"""Create a session from fields encoded by `encode_fields()`.
+
+		The fields are kept in the session's `_snapshot` to detect changes.
+		"""
+		session = self.restore(_load_fields(fields))
+		session._snapshot = fields
+		return session
+
+	def changed_fields(self, session, fields):
+		"""Returns the names of the fields in fields that differ from the
+		session's snapshot or None if the session has no snapshot.
+		"""
+		snapshot = session.__dict__.get('_snapshot')
+		if not isinstance(snapshot, dict):
+			return None
+		return [k for k, v in fields.items() if snapshot.get(k) != v]
+
+	def flatten(self, session):
+		"""Return the session as a list of builtin values."""
+		state = session.__dict__
+		key = session.key
+		screen = state.get('screen')
+		history = state.get('_history')
+		return [
+			key.phone_number,
+			key.session_id,
+			_timestamp(state.get('created_at')),
+			_timestamp(state.get('accessed_at')),
+			state.get('version', 0),
+			dict(session.data),
+			dict(session.ctx),
+			state.get('argv'),
+			state.get('ussd_string'),
+			state.get('last_response'),
+			history.stack if history is not None else state.get('_history_stack'),
+			None if screen is None else screen.__meta__.name,
+			None if screen is None else screen.__getstate__(),
+			state.get('restored'),
+			_extras(state),
+		]
+
+	def restore(self, payload):
+		"""Create a session from a payload created by `flatten()`."""
+		(phone_number, session_id, created_at, accessed_at, version, data, ctx, argv,
+			ussd_string, last_response, history_stack, screen_name, screen_state, restored, extras) = payload
+
+		session = self.session_class(self.key_class(phone_number, session_id))
+		session.created_at = _datetime(created_at)
+		session.accessed_at = _datetime(accessed_at)
+		session.version = version
+		session.data.update(data)
+		session.ctx.update(ctx)
+		session.argv = argv
+		session.ussd_string = ussd_string
+		session.last_response = last_response
+		session._history_stack = history_stack
+		session.restored = restored
+		if screen_name is not None:
+			# Stored names are absolute, so the registry is read directly.
+			cls = screens[screen_name]
+			screen = session.screen = cls.__new__(cls)
+			screen.__dict__.update(screen_state)
+		session.__dict__.update(extras)
+		return session
+
+
+
+def _extras(state):
+	keys = state.keys() - _NON_EXTRA_ATTRS
+	return {k: state[k] for k in keys} if keys else {}
+
+
+def _timestamp(value):
+	if isinstance(value, datetime.datetime) and value.tzinfo is None:
+		return (value - _EPOCH) // _MICROSECOND
+	return value
+
+
+def _datetime(value):
+	if isinstance(value, int):
+		return _EPOCH + datetime.timedelta(0, 0, value)
+	return value
+
+
+def _encodable(value):
+	try:
+		marshal.dumps(value)
+	except ValueError:
+		return False
+	return True
+
+
+def _pack(payload, positions):
+	values = [payload[i] for i in positions]
+	try:
+		value = values[0] if len(values) == 1 else tuple(values)
+		return marshal.dumps(value, BinarySessionCodec.MARSHAL_VERSION)
+	except ValueError:
+		mappings = frozenset(j for j, i in enumerate(positions) if i in _MAPPING_FIELDS)
+		return _PICKLED + marshal.dumps(_pickle_unencodable(values, mappings), BinarySessionCodec.MARSHAL_VERSION)
+
+
+def _split_payload(soft_fields):
+	"""Returns the positions of soft_fields in the flattened session and the
+	positions of the rest, each followed by a getter of their values.
+	"""
+	soft = tuple(sorted(i for name, positions in SESSION_FIELDS if name in soft_fields for i in positions))
+	hard = tuple(i for name, positions in SESSION_FIELDS if name not in soft_fields for i in positions)
+	return soft, _values_getter(soft), tuple(sorted(hard)), _values_getter(sorted(hard))
+
+
+def _values_getter(positions):
+	if len(positions) > 1:
+		return itemgetter(*positions)
+	return lambda payload: tuple(payload[i] for i in positions)
+
+
+def _pack_values(payload, positions, get):
+	try:
+		return marshal.dumps(get(payload), BinarySessionCodec.MARSHAL_VERSION)
+	except ValueError:
+		mappings = frozenset(j for j, i in enumerate(positions) if i in _MAPPING_FIELDS)
+		values = [payload[i] for i in positions]
+		return _PICKLED + marshal.dumps(_pickle_unencodable(values, mappings), BinarySessionCodec.MARSHAL_VERSION)
+
+
+def _unpack(value):
+	if value[:1] == _PICKLED:
+		return _unpickle(*marshal.loads(value[1:]))
+	return marshal.loads(value)
+
+
+def _load_fields(fields):
+	payload, loads = [], marshal.loads
+	for name, scalar in _FIELD_SCALARS:
+		value = fields[name]
+		if value[0] == 0:
+			payload.extend(_unpickle(*loads(value[1:])))
+		elif scalar:
+			payload.append(loads(value))
+		else:
+			payload.extend(loads(value))
+	return payload
+
+
+def _pickle_unencodable(payload, mappings=_MAPPING_FIELDS):
+	"""Pickle the values in payload that marshal can't encode.
+
+	Returns a `(payload, pickled)` tuple where pickled maps the position of
+	every affected value to the list of pickled keys for the positions in
+	mappings or to None if the whole value was pickled.
+	"""
+	payload, pickled = list(payload), {}
+	for i, value in enumerate(payload):
+		if i in mappings and isinstance(value, dict):
+			keys = [k for k, v in value.items() if not _encodable(v)]
+			if keys:
+				value = payload[i] = dict(value)
+				for k in keys:
+					value[k] = pickle.dumps(value[k], pickle.HIGHEST_PROTOCOL)
+				pickled[i] = keys
+		elif not _encodable(value):
+			payload[i] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+			pickled[i] = None
+	return payload, pickled
+
+
+def _unpickle(payload, pickled):
+	for i, keys in pickled.items():
+		if keys is None:
+			payload[i] = pickle.loads(payload[i])
+		else:
+			value = payload[i]
+			for k in keys:
+				value[k] = pickle.loads(value[k])
+	return payload
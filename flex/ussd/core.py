@@ -4,6 +4,8 @@ from flex.utils.decorators import cached_property
 from flex.utils.module_loading import import_if_string, import_strings
 
 from .config import Config, ConfigAttribute, ussd_config
+from .abc import UssdDataSequence
+from .trie import UssdCodeTrie
 from .wrappers import UssdCode
 from .exc import ImproperlyConfigured
 from . import signals
@@ -15,6 +17,7 @@ class UssdApp(object):
 
 	name = ConfigAttribute('name')
 	inital_screen = ConfigAttribute('inital_screen')
+	initial_screen = ConfigAttribute('inital_screen')
 
 	default_config = dict(
 		cache_backend='flex.ussd.cache.CacheBackend',
@@ -79,38 +82,44 @@ class UssdApp(object):
 
 
 class UssdAppRouter(object):
-	__slots__ = ('routes', 'base_code')
+	__slots__ = ('routes', 'base_code', '_trie')
 
 	def __init__(self, code=None):
 		self.routes = OrderedDict()
 		self.base_code = code and UssdCode(code)
+		self._trie = UssdCodeTrie()
 
 	def route(self, code, handler):
 		code = code if isinstance(code, UssdCode) else UssdCode(code)
-		key_code = tuple(code)
-		if key_code in self.routes:
+		if code in self.routes:
 			raise ValueError('Ussd code %s already registered in ussd router.' % (code,))
-		self.routes[key_code] = (code, handler)
+		self.routes[code] = (code, handler)
+		self._trie.insert(code, code)
 
 	def resolve(self, request):
-
-
-		ussd_string = request.ussd_string
-		if ussd_string.startswith(self.base_code):
-			ussd_string = ussd_string[len(self.base_code):]
-			codes = sorted(filter(ussd_string.startswith, self.routes.keys()))
-			if codes:
-				code = codes[-1]
-				route_code = '%s*%s' % (self.base_code, code) if self.base_code else code
-				request.route_code = route_code
-				return self.routes[code], route_code
+		ussd_string = getattr(request, 'ussd_code', None)
+		if ussd_string is None:
+			ussd_string = request.ussd_string
+		if self.base_code:
+			if not ussd_string.startswith(self.base_code):
+				return None, None
+			start = len(self.base_code)
+		else:
+			start = 0
+
+		tokens = ussd_string.ussd_data if isinstance(ussd_string, UssdDataSequence) else UssdCode(ussd_string).ussd_data
+		code, ln = self._trie.longest_prefix(tokens, start)
+		if ln is not None:
+			route_code = '%s*%s' % (self.base_code, code) if self.base_code else code
+			request.route_code = route_code
+			return self.routes[code], route_code
 		return None, None
 
 	def __len__(self):
 		return self.routes.__len__()
 
 	def __contains__(self, code):
-		return self.routes.__contains__(code)
+		return self.routes.__contains__(code if isinstance(code, (UssdCode, tuple)) else UssdCode(code))
 
 
 
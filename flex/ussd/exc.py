@@ -11,3 +11,8 @@ class ScreenMetadataError(ValueError):
 
 class UssdNamespaceError(RuntimeError):
 	pass
+
+
+class RedirectError(RuntimeError):
+	"""A chain of screen redirects looped or was too long."""
+	pass
@@ -1,21 +1,48 @@
 from typing import Callable, Any
 
 from functools import wraps
+from inspect import isawaitable
+from time import perf_counter
 from flex.utils.decorators import cached_property
 from flex.utils.module_loading import import_if_string, import_strings
 
 from .abc import AppBoundInstanceABC
+from .exc import RedirectError
 from .wrappers import UssdRequest
 from .response import BaseUssdResponse, UssdResponse, UssdStatus
 from .screens import screens, UssdScreen
+from .instrumentation import null_timer, timer
 from . import signals
 
 
+def _redirect_key(cls, params, args):
+	key = (cls, tuple(sorted(params.items())), tuple(args))
+	try:
+		hash(key)
+	except TypeError:
+		key = (cls, repr(sorted(params.items())), repr(tuple(args)))
+	return key
+
+
+def _split_args(args):
+	return (args[0], tuple(args[1:])) if args else (None, ())
+
+
+
 class RequestHandler(AppBoundInstanceABC):
 
-	def __init__(self, app=None):
+	#: The maximum number of redirects followed in a single request.
+	max_redirects = 16
+
+	#: Whether to fail redirects that revisit a screen with the same params
+	#: and inputs in a single request.
+	redirect_cycle_detection = True
+
+	def __init__(self, app=None, collector=None):
 		self.app = None
+		self.collector = collector
 		self._exception_middleware = []
+		self._exception_chains = ((),)
 		if app is not None:
 			self.init_app(app)
 
@@ -30,30 +57,114 @@ class RequestHandler(AppBoundInstanceABC):
 				% (app.name, self.__class__.__name__, self.app.name)
 			)
 		self.app = app
+		self.max_redirects = app.config.get('max_redirects', self.max_redirects)
+		self.redirect_cycle_detection = app.config.get('redirect_cycle_detection', self.redirect_cycle_detection)
+
+		collector = app.config.get('instrumentation_collector')
+		if collector is not None:
+			self.set_collector(collector)
+
+	def set_collector(self, collector):
+		"""Attach an instrumentation collector. Pass None to detach it.
+		"""
+		collector = import_if_string(collector)
+		if isinstance(collector, type):
+			collector = collector()
+		self.collector = collector
+		self.__dict__.pop('handle', None)
+
+	def timer(self, stage, label=None):
+		"""Returns a context manager that times the given stage into the
+		collector. A no-op if no collector is attached.
+		"""
+		collector = self.collector
+		return null_timer if collector is None else timer(collector, self.app.name, stage, label)
 
 	def get_middleware(self):
 		return self.app.middleware
 
+	def is_active_middleware(self, mware) -> bool:
+		"""Whether the middleware is active for the app. Middleware can opt out
+		of an app with an `is_active(app)` class or static method.
+		"""
+		is_active = getattr(mware, 'is_active', None)
+		return is_active is None or bool(is_active(self.app))
+
+	def handles_exceptions(self, mware) -> bool:
+		"""Whether the middleware may have a `process_exception()` method.
+		Factories that are not classes are assumed to.
+		"""
+		return not isinstance(mware, type) or hasattr(mware, 'process_exception')
+
+	@property
+	def converts_exceptions(self) -> bool:
+		"""Whether `get_exception_response()` is overridden to turn unhandled
+		exceptions into responses.
+		"""
+		return type(self).get_exception_response is not RequestHandler.get_exception_response
+
 	def create_handler(self) -> Callable[[UssdRequest], BaseUssdResponse]:
+		"""Compile the app's active middleware into a single handler.
+
+		Exception boundaries are only placed where an exception can be turned
+		into a response: around the screen handler and in front of each
+		middleware with a `process_exception()` method, skipping boundaries
+		with no layer between them. Without exception middleware there are
+		none. The exception middleware each boundary applies are precomputed
+		as tuples per depth and an exception is only offered to them once.
+		"""
 		self._exception_middleware = []
-		handler = self.wrap_exception_handler(self.screen_handler, self.get_exception_handler(0))
-		for mware in self.get_middleware():
+		middleware = [m for m in self.get_middleware() if self.is_active_middleware(m)]
+		guarded = self.converts_exceptions or any(self.handles_exceptions(m) for m in middleware)
+
+		handler = self.screen_handler
+		if guarded:
+			handler = self.wrap_exception_handler(handler, self.get_exception_handler(0))
+
+		for mware in middleware:
+			if not guarded and self.handles_exceptions(mware):
+				handler = self.wrap_exception_handler(
+					handler, self.get_exception_handler(len(self._exception_middleware))
+				)
+
 			mw_instance = mware(handler)
 			if mw_instance is not None:
 				if hasattr(mw_instance, 'process_exception'):
 					self._exception_middleware.append(mw_instance.process_exception)
 
-				handler = self.wrap_exception_handler(
-					mw_instance,
-					self.get_exception_handler(len(self._exception_middleware))
-				)
+				if self.collector is not None:
+					mw_instance = self.timed_middleware(mw_instance, getattr(mware, '__name__', str(mware)))
+
+				handler, guarded = mw_instance, False
+
+		if not guarded and self.converts_exceptions:
+			handler = self.wrap_exception_handler(
+				handler, self.get_exception_handler(len(self._exception_middleware))
+			)
+
+		chain = tuple(self._exception_middleware)
+		self._exception_chains = tuple(chain[depth:] for depth in range(len(chain) + 1))
 		return handler
 
+	def timed_middleware(self, func, label):
+		"""Wrap the given middleware instance to time it into the collector.
+		"""
+		collector, app_name = self.collector, self.app.name
+		def inner(request):
+			start = perf_counter()
+			try:
+				return func(request)
+			finally:
+				collector.observe(app_name, 'middleware', perf_counter() - start, label)
+		return inner
+
 	def before_request(self, request) -> None:
-		signals.before_request.send(self.app, request=request)
+		if signals.before_request.has_receivers(self.app):
+			signals.before_request.send(self.app, request=request)
 
 	def after_request(self, response, request) -> None:
-		signals.after_request.send(self.app, response=response, request=request)
+		if signals.after_request.has_receivers(self.app):
+			signals.after_request.send(self.app, response=response, request=request)
 
 	def get_initial_screen(self) -> UssdScreen:
 		rv = screens.get(self.app.initial_screen)
@@ -61,30 +172,84 @@ class RequestHandler(AppBoundInstanceABC):
 
 	def screen_handler(self, request) -> BaseUssdResponse:
 		screen = request.session.screen or self.get_initial_screen()
+		if not request.parsed:
+			with self.timer('parse'):
+				request.data
 		rv = self.dispatch_to_screen(screen, request, *request.data.head)
 		return rv
 
 	def dispatch_to_screen(self, screen: UssdScreen, request: UssdRequest, arg=None, *next_args) -> UssdResponse:
-		request.session.screen = screen
+		"""Dispatch the request to screen and follow the redirects it returns.
+
+		Redirects are followed in a loop, at most `max_redirects` of them.
+		Each hop is timed as a `redirect` stage labelled with the target.
+		"""
+		hops, seen, hop = 0, set(), None
+		while True:
+			request.session.screen = screen
 
-		screen.init_request(request)
+			screen.init_request(request)
 
-		res = screen() if arg is None else screen(arg)
+			with self.timer('screen', screen.__meta__.name):
+				res = screen() if arg is None else screen(arg)
 
-		if isinstance(res, BaseUssdResponse):
-			if res.status == UssdStatus.REDIRECT:
-				next_screen = screens.get(res.screen, screen)(**res.params)
-				if res.data:
-					next_args = res.data
-				return self.dispatch_to_screen(next_screen, request, *next_args)
-			else:
+			if hop is not None:
+				self.observe_redirect(*hop)
+
+			if isinstance(res, str):
+				return UssdResponse(res)
+			elif not isinstance(res, BaseUssdResponse):
+				raise RuntimeError(
+					'Screen must return a BaseUssdResponse object or string. Got %s' % (type(res),)
+				)
+			elif res.status != UssdStatus.REDIRECT:
 				return res
-		elif isinstance(res, str):
-			return UssdResponse(res)
 
-		raise RuntimeError(
-			'Screen must return a BaseUssdResponse object or string. Got %s' % (type(res),)
-		)
+			hops, start = hops + 1, perf_counter()
+			screen, args = self.follow_redirect(screen, res, next_args, hops, seen)
+			arg, next_args = _split_args(args)
+			hop = start, screen.__meta__.name
+
+	def get_redirect_target(self, screen: UssdScreen, target):
+		"""Returns the screen class a redirect from screen to target leads
+		to. Resolved targets are cached on the screen's metadata.
+		"""
+		targets = screen.__meta__.redirect_targets
+		try:
+			return targets[target]
+		except KeyError:
+			rv = targets[target] = screens.get(target, screen)
+			return rv
+
+	def follow_redirect(self, screen: UssdScreen, res, next_args, hops, seen):
+		"""Returns the `(screen, args)` the redirect res from screen leads to.
+
+		Raises `RedirectError` if the redirect is hop number hops and that's
+		more than `max_redirects` or, with `redirect_cycle_detection`, if it
+		leads to a screen with the same params and inputs as a previous hop
+		(tracked in the set seen).
+		"""
+		if hops > self.max_redirects:
+			raise RedirectError(
+				'Too many redirects. More than %d from screen %s to %s.'\
+				% (self.max_redirects, screen.__meta__.name, res.screen)
+			)
+
+		cls = self.get_redirect_target(screen, res.screen)
+		args = res.data or next_args
+		if self.redirect_cycle_detection:
+			key = _redirect_key(cls, res.params, args)
+			if key in seen:
+				raise RedirectError(
+					'Redirect cycle. Screen %s redirected to %s(%s) again.'\
+					% (screen.__meta__.name, cls.__meta__.name, ', '.join('%s=%r' % p for p in res.params.items()))
+				)
+			seen.add(key)
+		return cls(**res.params), args
+
+	def observe_redirect(self, start, label):
+		if self.collector is not None:
+			self.collector.observe(self.app.name, 'redirect', perf_counter() - start, label)
 
 	def wrap_exception_handler(self, func, exception_handler=None):
 		"""Wrap the given callable in exception-to-response conversion.
@@ -99,26 +264,158 @@ class RequestHandler(AppBoundInstanceABC):
 		return inner
 
 	def get_exception_handler(self, depth=0):
+		"""Returns a function offering exceptions to the exception middleware
+		from depth on.
+		"""
 		def exception_handler(request, exception):
-			for handler in self._exception_middleware[depth:]:
-				response = handler(request, exception)
-				if response:
-					return response
+			declined = self.get_declined_exceptions(request)
+			if id(exception) not in declined:
+				for handler in self._exception_chains[depth]:
+					response = handler(request, exception)
+					if response:
+						return response
+				declined[id(exception)] = exception
 			return self.get_exception_response(request, exception)
 		return exception_handler
 
+	def get_declined_exceptions(self, request):
+		"""Returns the exceptions the exception middleware declined while
+		handling request, keyed by id, so that outer exception boundaries
+		don't offer them again.
+		"""
+		return request.__dict__.setdefault('_declined_exceptions', {})
+
 	def get_exception_response(self, request, exc):
 		raise exc
 
+	def observe_idempotency(self, start, response):
+		if self.collector is not None:
+			self.collector.observe(
+				self.app.name, 'idempotency', perf_counter() - start,
+				'miss' if response is None else 'hit'
+			)
+
+	def get_cached_response(self, request, manager):
+		"""Returns the cached response if the request is a retransmit of the
+		session's last turn. Only called if manager has idempotency enabled.
+		"""
+		start = perf_counter()
+		rv = manager.get_cached_response(request)
+		self.observe_idempotency(start, rv)
+		return rv
+
 	def __call__(self, request: UssdRequest):
 		request.app = self.app
 		self.before_request(request)
-		response = self.handle(request)
+		manager = self.app.session_manager
+		idempotent = getattr(manager, 'idempotency', False)
+		response = self.get_cached_response(request, manager) if idempotent else None
+		if response is None:
+			response = self.handle(request)
+			if idempotent:
+				manager.cache_response(request, response)
 		self.after_request(response, request)
 		return response
 
 
 
+class AsyncRequestHandler(RequestHandler):
+	"""A request handler for asyncio apps.
+
+	Awaits async middleware (e.g. `flex.ussd.sessions.AsyncSessionMiddleware`),
+	exception middleware and screens with `async def get/put` methods. Sync
+	middleware and screens work too, but sync middleware must return the
+	response of the next handler untouched as it's only awaited afterwards.
+	"""
+
+	def timed_middleware(self, func, label):
+		collector, app_name = self.collector, self.app.name
+		async def inner(request):
+			start = perf_counter()
+			try:
+				rv = func(request)
+				return (await rv) if isawaitable(rv) else rv
+			finally:
+				collector.observe(app_name, 'middleware', perf_counter() - start, label)
+		return inner
+
+	async def screen_handler(self, request) -> BaseUssdResponse:
+		screen = request.session.screen or self.get_initial_screen()
+		if not request.parsed:
+			with self.timer('parse'):
+				request.data
+		return await self.dispatch_to_screen(screen, request, *request.data.head)
+
+	async def dispatch_to_screen(self, screen: UssdScreen, request: UssdRequest, arg=None, *next_args) -> UssdResponse:
+		hops, seen, hop = 0, set(), None
+		while True:
+			request.session.screen = screen
+
+			screen.init_request(request)
 
+			with self.timer('screen', screen.__meta__.name):
+				res = screen() if arg is None else screen(arg)
+				if isawaitable(res):
+					res = await res
 
+			if hop is not None:
+				self.observe_redirect(*hop)
 
+			if isinstance(res, str):
+				return UssdResponse(res)
+			elif not isinstance(res, BaseUssdResponse):
+				raise RuntimeError(
+					'Screen must return a BaseUssdResponse object or string. Got %s' % (type(res),)
+				)
+			elif res.status != UssdStatus.REDIRECT:
+				return res
+
+			hops, start = hops + 1, perf_counter()
+			screen, args = self.follow_redirect(screen, res, next_args, hops, seen)
+			arg, next_args = _split_args(args)
+			hop = start, screen.__meta__.name
+
+	def wrap_exception_handler(self, func, exception_handler=None):
+		exception_handler = exception_handler or self.get_exception_response
+		@wraps(func)
+		async def inner(request):
+			try:
+				rv = func(request)
+				return (await rv) if isawaitable(rv) else rv
+			except Exception as exc:
+				rv = exception_handler(request, exc)
+				return (await rv) if isawaitable(rv) else rv
+		return inner
+
+	def get_exception_handler(self, depth=0):
+		async def exception_handler(request, exception):
+			declined = self.get_declined_exceptions(request)
+			if id(exception) not in declined:
+				for handler in self._exception_chains[depth]:
+					response = handler(request, exception)
+					if isawaitable(response):
+						response = await response
+					if response:
+						return response
+				declined[id(exception)] = exception
+			return self.get_exception_response(request, exception)
+		return exception_handler
+
+	async def get_cached_response(self, request, manager):
+		start = perf_counter()
+		rv = await manager.get_cached_response(request)
+		self.observe_idempotency(start, rv)
+		return rv
+
+	async def __call__(self, request: UssdRequest):
+		request.app = self.app
+		self.before_request(request)
+		manager = self.app.session_manager
+		idempotent = getattr(manager, 'idempotency', False)
+		response = (await self.get_cached_response(request, manager)) if idempotent else None
+		if response is None:
+			response = await self.handle(request)
+			if idempotent:
+				await manager.cache_response(request, response)
+		self.after_request(response, request)
+		return response
@@ -0,0 +1,207 @@
+from bisect import bisect_left
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+
+from flex.utils.decorators import export
+
+from .abc import InstrumentationExporterABC
+
+logger = getLogger('ussd')
+
+
+#: Default histogram bucket upper bounds in seconds.
+DEFAULT_BUCKETS = (
+	0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+	0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+
+def quantile(buckets, counts, q):
+	"""Estimate the q (0-1) quantile of a histogram as the upper bound of the
+	bucket it falls in. Returns inf if it's in the overflow bucket.
+	"""
+	total = sum(counts)
+	if not total:
+		return 0.0
+	rank, seen = q * total, 0
+	for i, c in enumerate(counts):
+		seen += c
+		if seen >= rank:
+			break
+	return buckets[i] if i < len(buckets) else float('inf')
+
+
+
+@export
+class Histogram(object):
+	"""A fixed-bucket latency histogram.
+
+	counts[i] is the number of observations <= buckets[i] (and greater than
+	buckets[i-1]). The last count holds the observations above the last
+	bucket.
+	"""
+
+	__slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = tuple(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self._lock = Lock()
+
+	def observe(self, value):
+		i = bisect_left(self.buckets, value)
+		with self._lock:
+			self.counts[i] += 1
+			self.sum += value
+			self.count += 1
+
+	def quantile(self, q):
+		return quantile(self.buckets, self.counts, q)
+
+	def asdict(self):
+		with self._lock:
+			return dict(buckets=self.buckets, counts=list(self.counts), sum=self.sum, count=self.count)
+
+	def __repr__(self):
+		return '%s(count=%d, sum=%f)' % (self.__class__.__name__, self.count, self.sum)
+
+
+
+@export
+class Collector(object):
+	"""Collects stage timings into histograms keyed by `(app, stage, label)`.
+
+	Stages recorded by the request pipeline are:
+		session_open, parse, middleware (labeled by the middleware's name),
+		screen (labeled by the screen's name), redirect (labeled by the target
+		screen's name) and session_close.
+
+	With idempotency enabled, lookups of retransmitted requests are recorded
+	in the idempotency stage labeled 'hit' or 'miss' (see `hit_rate()`).
+	"""
+
+	histogram_class = Histogram
+
+	def __init__(self, buckets=DEFAULT_BUCKETS, exporters=()):
+		self.buckets = tuple(buckets)
+		self.histograms = {}
+		self.exporters = list(exporters)
+		self._lock = Lock()
+
+	def histogram(self, app, stage, label=None):
+		key = (app, stage, label)
+		rv = self.histograms.get(key)
+		if rv is None:
+			with self._lock:
+				rv = self.histograms.get(key)
+				if rv is None:
+					rv = self.histograms[key] = self.histogram_class(self.buckets)
+		return rv
+
+	def observe(self, app, stage, seconds, label=None):
+		self.histogram(app, stage, label).observe(seconds)
+
+	def hit_rate(self, app, stage='idempotency'):
+		"""Returns the ratio of 'hit' to all 'hit' and 'miss' observations of
+		the stage or None if there are none.
+		"""
+		hits, misses = self.histograms.get((app, stage, 'hit')), self.histograms.get((app, stage, 'miss'))
+		hits, total = hits.count if hits else 0, sum(h.count for h in (hits, misses) if h)
+		return hits / total if total else None
+
+	def add_exporter(self, exporter):
+		self.exporters.append(exporter)
+
+	def snapshot(self):
+		"""Returns a dict of `(app, stage, label)` keys to histogram dicts."""
+		return {k: h.asdict() for k, h in list(self.histograms.items())}
+
+	def export(self):
+		snapshot = self.snapshot()
+		for exporter in self.exporters:
+			exporter.export(snapshot)
+
+	def reset(self):
+		with self._lock:
+			self.histograms = {}
+
+
+
+@export
+class LogExporter(InstrumentationExporterABC):
+	"""Logs the count, mean and estimated p50/p99 of each histogram."""
+
+	__slots__ = ('logger',)
+
+	def __init__(self, logger=logger):
+		self.logger = logger
+
+	def export(self, snapshot):
+		for (app, stage, label), data in sorted(snapshot.items(), key=lambda x: tuple(map(str, x[0]))):
+			if not data['count']:
+				continue
+			self.logger.info(
+				'%s %s%s: count=%d mean=%.6fs p50<=%ss p99<=%ss',
+				app, stage, '[%s]' % label if label else '', data['count'], data['sum'] / data['count'],
+				quantile(data['buckets'], data['counts'], .5), quantile(data['buckets'], data['counts'], .99)
+			)
+
+
+
+class _Timer(object):
+
+	__slots__ = ('collector', 'app', 'stage', 'label', 'start')
+
+	def __init__(self, collector, app, stage, label):
+		self.collector = collector
+		self.app = app
+		self.stage = stage
+		self.label = label
+
+	def __enter__(self):
+		self.start = perf_counter()
+		return self
+
+	def __exit__(self, *exc_info):
+		self.collector.observe(self.app, self.stage, perf_counter() - self.start, self.label)
+
+
+
+class _NullTimer(object):
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		pass
+
+
+null_timer = _NullTimer()
+
+
+def timer(collector, app, stage, label=None):
+	"""Returns a context manager timing a stage into the collector or a
+	shared no-op one if collector is None.
+	"""
+	return null_timer if collector is None else _Timer(collector, app, stage, label)
+
+
+def _no_timer(stage, label=None):
+	return null_timer
+
+
+def get_timer(app):
+	"""Returns the `timer` of app's request handler or, if it has none or
+	the handler has not been created yet, one returning `null_timer`.
+
+	Never creates the handler itself; `app.handler` is a cached property.
+	"""
+	handler = None if app is None else vars(app).get('handler')
+	rv = getattr(handler, 'timer', None)
+	return _no_timer if rv is None else rv
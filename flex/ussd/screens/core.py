@@ -27,7 +27,7 @@ class UssdScreenMeta(type):
 		# Gather screen's state attributes and pop them from dct
 		_forbidden_state_attrs = frozenset(('app', 'request', 'session'))
 		state_attrs = set()
-		for k,v in dct.items():
+		for k,v in list(dct.items()):
 			if isinstance(v, StateAttribute):
 				if k in _forbidden_state_attrs:
 					raise exc.ImproperlyConfigured(
@@ -69,3 +69,8 @@ class ScreenMetadata(BaseMetadata):
 	def state_attributes(self, value):
 		return set()
 
+	@metafield()
+	def redirect_targets(self, value):
+		"""Cache of the screen classes redirects from this screen resolved to."""
+		return {}
+
@@ -1,10 +1,18 @@
+import asyncio
 import datetime
+import marshal
+from hashlib import blake2b
+from threading import Lock
+from time import monotonic, sleep
 
 from flex.datastructures.collections import AttrBag
-from flex.utils.decorators import cached_property, export
+from flex.utils.decorators import export
 from flex.utils.module_loading import import_if_string
 
-from .abc import SessionManagerABC, AppBoundInstanceABC
+from .abc import SessionManagerABC, AsyncSessionManagerABC, AppBoundInstanceABC
+from .instrumentation import get_timer
+from .cache import LRUCache
+from .response import BaseUssdResponse, UssdRedirectResponse, UssdResponse, UssdStatus
 from .wrappers import UssdRequest
 from . import signals
 
@@ -29,9 +37,14 @@ class Session(object):
 		self.key = key
 		self.created_at = None
 		self.accessed_at = None
+		self.version = 0
 		self.data = AttrBag()
 		self.ctx = AttrBag()
 		self.argv = None
+		self.ussd_string = None
+		self.last_response = None
+		self.screen = None
+		self.aux = {}
 		self._is_started = False
 		self._history_stack = None
 		self._history = None
@@ -90,8 +103,8 @@ class Session(object):
 
 	def __getstate__(self):
 		state = self.__dict__.copy()
-		state['_history_stack'] = self.history.stack
-		for k in ('_is_started', 'request', '_history'):
+		state['_history_stack'] = self._history.stack if self._history is not None else self._history_stack
+		for k in ('_is_started', 'request', '_history', '_snapshot', 'aux', '_aux_snapshot', '_lease', '_winner'):
 			if k in state:
 				del state[k]
 		state['_history'] = None
@@ -113,16 +126,36 @@ class Session(object):
 class SessionManager(AppBoundInstanceABC, SessionManagerABC):
 
 	def __init__(self, app=None, backend=None, lifetime=60, timeout=None, name='ussd_session',
-				session_class=Session, session_key_class=SessionKey):
+				session_class=Session, session_key_class=SessionKey, incremental_parsing=True,
+				codec='flex.ussd.codecs.BinarySessionCodec', dirty_tracking=True, auxiliary_keys=(),
+				versioning=False, idempotency=False, write_behind=False, write_behind_size=1024,
+				write_behind_interval=0.05, lease_timeout=None, lease_wait=5, lease_interval=0.02):
 		self.app = None
 		self._session_timeout = None
 		self.session_name = name
 		self.session_lifetime = lifetime
 		self.session_timeout = timeout
+		self.incremental_parsing = incremental_parsing
+		self.dirty_tracking = dirty_tracking
+		self.auxiliary_keys = tuple(auxiliary_keys)
+		self.versioning = versioning
+		self.idempotency = idempotency
+		self.write_behind = write_behind
+		self.write_behind_size = write_behind_size
+		self.write_behind_interval = write_behind_interval
+		self.lease_timeout = lease_timeout
+		self.lease_wait = lease_wait
+		self.lease_interval = lease_interval
+		self._write_behind = None
+		self._app_backend = None
+		self._versions = LRUCache(4096)
+		self._leases = {}
+		self._versions_lock = Lock()
 
 		self.set_backend(backend)
 		self.session_class = import_if_string(session_class)
 		self.session_key_class = import_if_string(session_key_class)
+		self.set_codec(codec)
 
 		if app is not None:
 			self.init_app(app)
@@ -135,17 +168,40 @@ class SessionManager(AppBoundInstanceABC, SessionManagerABC):
 	def session_timeout(self, value):
 		self._session_timeout = value
 
+	write_behind_class = 'flex.ussd.writebehind.WriteBehindBackend'
+
 	@property
 	def backend(self):
-		if self._backend is not None:
-			return self._backend
-		elif self.app is not None:
-			return self.app.cache
-		else:
-			raise AttributeError(
-				'Required attribute backend not configured for session manager %s.'\
-				% (self.__class__.__name__,)
-			)
+		"""The configured backend or else the app's cache. The app's cache is
+		looked up once since the backend is read several times per request.
+		"""
+		backend = self._backend
+		if backend is None:
+			backend = self._app_backend
+		if backend is None:
+			if self.app is None:
+				raise AttributeError(
+					'Required attribute backend not configured for session manager %s.'\
+					% (self.__class__.__name__,)
+				)
+			backend = self._app_backend = self.app.cache
+		return self.get_write_behind(backend) if self.write_behind else backend
+
+	@property
+	def lease_backend(self):
+		"""The backend session leases are taken on. Unlike `backend`, its
+		writes are never queued in write-behind mode.
+		"""
+		backend = self.backend
+		return backend.backend if self.write_behind else backend
+
+	def get_write_behind(self, backend):
+		"""Returns the write-behind backend queueing the writes to backend."""
+		rv = self._write_behind
+		if rv is None or rv.backend is not backend:
+			cls = import_if_string(self.write_behind_class)
+			rv = self._write_behind = cls(backend, self.write_behind_size, self.write_behind_interval)
+		return rv
 
 	def set_backend(self, backend):
 		if backend is not None:
@@ -156,7 +212,18 @@ class SessionManager(AppBoundInstanceABC, SessionManagerABC):
 
 	backend.setter(set_backend)
 
-	@cached_property
+	def set_codec(self, codec):
+		"""Set the codec used to encode sessions before they are saved to the
+		backend. A codec type is created with the session and session key
+		classes. If None, session objects are passed to the backend as is.
+		"""
+		self._codec_option = codec
+		codec = import_if_string(codec)
+		if isinstance(codec, type):
+			codec = codec(self.session_class, self.session_key_class)
+		self.codec = codec
+
+	@property
 	def stale_sessions(self):
 		return self.session_timeout != self.session_lifetime
 
@@ -173,9 +240,22 @@ class SessionManager(AppBoundInstanceABC, SessionManagerABC):
 		self.session_name = config.get('name', self.session_name)
 		self.session_lifetime = config.get('lifetime', self.session_lifetime)
 		self.session_timeout = config.get('timeout', self.session_timeout)
+		self.incremental_parsing = config.get('incremental_parsing', self.incremental_parsing)
+		self.dirty_tracking = config.get('dirty_tracking', self.dirty_tracking)
+		self.auxiliary_keys = tuple(config.get('auxiliary_keys', self.auxiliary_keys))
+		self.versioning = config.get('versioning', self.versioning)
+		self.idempotency = config.get('idempotency', self.idempotency)
+		self.write_behind = config.get('write_behind', self.write_behind)
+		self.write_behind_size = config.get('write_behind_size', self.write_behind_size)
+		self.write_behind_interval = config.get('write_behind_interval', self.write_behind_interval)
+		self.lease_timeout = config.get('lease_timeout', self.lease_timeout)
+		self.lease_wait = config.get('lease_wait', self.lease_wait)
+		self.lease_interval = config.get('lease_interval', self.lease_interval)
+		self._versions.maxsize = config.get('local_versions', self._versions.maxsize)
 
 		self.session_class = import_if_string(config.get('class', self.session_class))
 		self.session_key_class = import_if_string(config.get('key_class', self.session_key_class))
+		self.set_codec(config.get('codec', self._codec_option))
 
 		if 'backend' in config:
 			self.set_backend(config['backend'])
@@ -183,37 +263,507 @@ class SessionManager(AppBoundInstanceABC, SessionManagerABC):
 		self.backend
 
 	def open(self, request):
+		"""Load the request's session.
+
+		With versioning and a `lease_timeout` (both off by default), a lease
+		is taken on the session so concurrent requests for it are caught
+		before dispatch. A request that can't take the lease waits for the
+		holder to save the session and keeps its response (see
+		`pop_winning_response()`). If the wait times out, the request is
+		dispatched and the version check in `close()` decides.
+		"""
 		key = self.get_session_key(request)
-		session = self.get_saved_session(key)
+		session = self.prepare_session(request, key, *self.load(key))
+		if self.leases and not self.acquire_lease(session):
+			session._winner = self.wait_for_winner(session)
+		return session
+
+	def close(self, session, response):
+		"""Save the session. Returns the response of the request that saved
+		the session first if a concurrent request for the same session won.
+		"""
+		session.last_response = self.pack_response(response)
+		try:
+			if not self.saved_session(session):
+				return self.get_winning_response(session)
+			self.save_auxiliary(session)
+		finally:
+			self.release_lease(session)
+
+	def flush(self):
+		"""Write the sessions queued in write-behind mode to the backend."""
+		if self._write_behind is not None:
+			self._write_behind.flush()
+
+	def pack_response(self, response):
+		if isinstance(response, BaseUssdResponse) and not isinstance(response, UssdRedirectResponse):
+			return (response.data, int(response.status))
+		return response
+
+	def unpack_response(self, value):
+		if isinstance(value, tuple):
+			return UssdResponse(value[0], UssdStatus(value[1]))
+		return value
+
+	def get_winning_response(self, session):
+		saved = self.get_saved_session(session.key)
+		return saved and self.unpack_response(saved.last_response)
+
+	def pop_winning_response(self, session):
+		"""Returns the response of the concurrent request that held the
+		session's lease when it was opened or None if it should be dispatched.
+		"""
+		return session.__dict__.pop('_winner', None)
+
+	@property
+	def leases(self):
+		return bool(self.versioning and self.lease_timeout)
+
+	def get_lease_key(self, key: SessionKey):
+		return self.get_auxiliary_key(key, 'lease')
+
+	def acquire_lease(self, session):
+		"""Take the session's lease. Returns False if another request holds it.
+
+		Leases are added with `cas()` against version 0 (i.e. only if missing)
+		on backends that support it. For other in-process stores they are
+		taken under a lock like the versions. Sessions in other stores are
+		not leased.
+		"""
+		key, backend = self.get_lease_key(session.key), self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			acquired = backend.cas(key, b'1', 0, self.lease_timeout)
+		elif getattr(backend, 'in_process', False):
+			acquired = self.acquire_local_lease(key)
+		else:
+			return True
+		if acquired:
+			session._lease = key
+		return acquired
+
+	def acquire_local_lease(self, key):
+		"""Take an in-process lease. Leases map keys to their expiry time
+		and expired ones are pruned once there are more than `local_versions`.
+		"""
+		now, leases = monotonic(), self._leases
+		with self._versions_lock:
+			if leases.get(key, 0) > now:
+				return False
+			leases[key] = now + self.lease_timeout
+			if len(leases) > self._versions.maxsize:
+				for k in [k for k, expires in leases.items() if expires <= now]:
+					del leases[k]
+			return True
+
+	def release_lease(self, session):
+		key = session.__dict__.pop('_lease', None)
+		if key is None:
+			return
+		backend = self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			backend.delete(key)
+		else:
+			self._leases.pop(key, None)
+
+	def is_leased(self, key):
+		backend = self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			return backend.get(key) is not None
+		return self._leases.get(key, 0) > monotonic()
+
+	def wait_for_winner(self, session):
+		"""Wait up to `lease_wait` seconds for the lease holder to save the
+		session. Returns its response or None if it timed out or left the
+		session's version unchanged.
+		"""
+		key, deadline = self.get_lease_key(session.key), monotonic() + self.lease_wait
+		while self.is_leased(key):
+			if monotonic() >= deadline:
+				return None
+			sleep(self.lease_interval)
+		return self.get_newer_response(session, self.get_saved_session(session.key))
+
+	def get_newer_response(self, session, saved):
+		if saved is not None and saved.version != session.version:
+			return self.unpack_response(saved.last_response)
+
+	def get_fingerprint(self, request: UssdRequest):
+		"""Returns a digest of the request's session id and ussd string."""
+		value = '%s\x00%s' % (request.session_id, request.raw_ussd_string)
+		return blake2b(value.encode(), digest_size=16).digest()
+
+	def get_turn_key(self, request: UssdRequest):
+		return self.get_auxiliary_key(self.get_session_key(request), 'last_turn')
+
+	def get_cached_response(self, request: UssdRequest):
+		"""Returns the response sent for the session's last turn if request is
+		a retransmit of it (same session id and ussd string) or None.
+		"""
+		return self.load_turn(request, self.backend.get(self.get_turn_key(request)))
+
+	def cache_response(self, request: UssdRequest, response):
+		"""Save response with the request's fingerprint as the session's last
+		turn. Responses with data that can't be marshalled are not cached.
+		"""
+		value = self.dump_turn(request, response)
+		if value is not None:
+			self.backend.set(self.get_turn_key(request), value, self.session_timeout)
+
+	def dump_turn(self, request, response):
+		packed = self.pack_response(response)
+		if not isinstance(packed, tuple):
+			return None
+		try:
+			return marshal.dumps((self.get_fingerprint(request),) + packed)
+		except ValueError:
+			return None
+
+	def load_turn(self, request, value):
+		if value is None:
+			return None
+		fingerprint, data, status = marshal.loads(value)
+		if fingerprint == self.get_fingerprint(request):
+			return self.unpack_response((data, status))
+
+	def prepare_session(self, request, key, session, aux):
+		"""Create the session if it wasn't saved and prepare it for request."""
 		if session and self.stale_sessions:
 			session.is_stale = datetime.datetime.now() - self.session_lifetime > session.last_activity
 
 		if not session:
 			session = self.create_session(key)
+			session.version = self.get_local_version(key)
+
+		session.aux, session._aux_snapshot = aux, dict(aux)
+
+		if self.incremental_parsing:
+			self.resume_request(session, request)
 
 		return session
 
-	def close(self, session, response):
-		self.saved_session(session)
+	def resume_request(self, session, request: UssdRequest):
+		"""Parse the request's data against the previous turn's ussd string and
+		tokens then save this turn's in the session. The previous turn is only
+		used if it belongs to the same ussd session as request.
+		"""
+		if session.session_id == request.session_id:
+			request.resume(getattr(session, 'ussd_string', None), session.argv)
+		with self.timer('parse'):
+			tokens = request.data.tokens
+		session.ussd_string, session.argv = request.raw_ussd_string, tokens
+
+	def timer(self, stage, label=None):
+		return get_timer(self.app)(stage, label)
 
 	def create_session(self, key: SessionKey):
 		return self.session_class(key)
 
+	def get_local_version(self, key: SessionKey):
+		"""Returns the version new sessions for key start at.
+
+		In-process stores without compare-and-set are checked against the
+		versions this process wrote. A session removed from the store starts
+		again at its last version here so its writes don't lose to its own
+		stale version.
+		"""
+		if not (self.versioning and self.uses_local_versions(self.backend)):
+			return 0
+		return self._versions.get(self.get_backend_key(key), 0)
+
+	def uses_local_versions(self, backend):
+		"""Whether writes to backend are checked against the versions this
+		process wrote, i.e. if its store is in-process without compare-and-set.
+		"""
+		return not getattr(backend, 'supports_cas', False) and getattr(backend, 'in_process', False)
+
 	def get_session_key(self, request: UssdRequest):
 		return self.session_key_class(request.phone_number, request.session_id)
 
 	def get_backend_key(self, key: SessionKey):
 		return '%s:%s' % (self.session_name, key.phone_number)
 
+	@property
+	def tracks_fields(self):
+		"""Whether sessions are stored as hashes of encoded fields."""
+		codec = self.codec
+		return self.dirty_tracking and getattr(codec, 'supports_fields', False) \
+			and getattr(self.backend, 'supports_fields', False)
+
+	def get_auxiliary_key(self, key: SessionKey, name):
+		return '%s:%s' % (self.get_backend_key(key), name)
+
+	def get_auxiliary_keys(self, key: SessionKey):
+		"""Returns a dict of the auxiliary key names loaded with the session
+		to their backend keys.
+		"""
+		return {name: self.get_auxiliary_key(key, name) for name in self.auxiliary_keys}
+
+	def load(self, key: SessionKey):
+		"""Load the saved session and its auxiliary values.
+
+		Returns a `(session, aux)` tuple where aux is a dict of the auxiliary
+		key names found. Unless the session is stored as hash fields, they are
+		fetched with a single `get_many()` round-trip.
+		"""
+		aux_keys = self.get_auxiliary_keys(key)
+		if not aux_keys:
+			return self.get_saved_session(key), {}
+
+		if self.tracks_fields:
+			session = self.get_saved_session(key)
+			values = self.backend.get_many(aux_keys.values())
+		else:
+			backend_key = self.get_backend_key(key)
+			values = self.backend.get_many([backend_key] + list(aux_keys.values()))
+			session = self.decode(values.pop(backend_key, None))
+
+		return session, self.auxiliary_values(aux_keys, values)
+
+	def auxiliary_values(self, aux_keys, values):
+		return {name: values[k] for name, k in aux_keys.items() if k in values}
+
+	def decode(self, value):
+		return value if value is None or self.codec is None else self.codec.decode(value)
+
+	def decode_fields(self, value):
+		return self.codec.decode_fields(value) if value else None
+
 	def get_saved_session(self, key: SessionKey):
-		return self.backend.get(self.get_backend_key(key))
+		backend_key = self.get_backend_key(key)
+		if self.tracks_fields:
+			return self.decode_fields(self.backend.get_fields(backend_key))
+		return self.decode(self.backend.get(backend_key))
+
+	def save_auxiliary(self, session):
+		"""Write the session's auxiliary values with a single `set_many()` and
+		delete the ones removed since it was opened.
+		"""
+		for method, args in self.get_auxiliary_writes(session):
+			getattr(self.backend, method)(*args)
+
+	def get_auxiliary_writes(self, session):
+		"""Returns a list of `(backend_method, args)` tuples saving the session's
+		auxiliary values.
+		"""
+		aux, snapshot = getattr(session, 'aux', None), session.__dict__.pop('_aux_snapshot', None)
+		if not (aux or snapshot):
+			return []
+
+		rv, key = [], session.key
+		if aux:
+			rv.append(('set_many', ({self.get_auxiliary_key(key, k): v for k, v in aux.items()}, self.session_timeout)))
+		removed = [self.get_auxiliary_key(key, k) for k in snapshot or () if k not in aux]
+		if removed:
+			rv.append(('delete_many', (removed,)))
+		session._aux_snapshot = dict(aux)
+		return rv
 
 	def saved_session(self, session):
-		self.backend.set(self.get_backend_key(session.key), session, self.session_timeout)
+		"""Save the session to the backend. Returns False if the session was
+		saved by another request since it was loaded.
+		"""
+		method, args = self.get_versioned_write(session)
+		if method is None:
+			return False
+		rv = getattr(self.backend, method)(*args)
+		return rv if method in ('cas', 'cas_fields') else True
+
+	def get_versioned_write(self, session):
+		"""Returns the `(backend_method, args)` tuple saving the session or
+		`(None, None)` if the session lost a version check.
+
+		Compare-and-set writes are passed to backends that support them. For
+		other in-process stores, the versions written by this process are
+		checked under a lock instead. Other processes' writes can't be seen
+		that way, so sessions in shared stores without compare-and-set are
+		written unversioned.
+		"""
+		backend = self.backend
+		method, args = self.get_session_write(session)
+		if method not in ('cas', 'cas_fields') or getattr(backend, 'supports_cas', False):
+			return method, args
+
+		key, value, version, timeout = args
+		if getattr(backend, 'in_process', False):
+			with self._versions_lock:
+				if self._versions.get(key, version) != version:
+					return None, None
+				self._versions.set(key, version + 1, self.session_timeout)
+		return ('set' if method == 'cas' else 'set_fields'), (key, value, timeout)
+
+	def get_session_write(self, session):
+		"""Returns the `(backend_method, args)` tuple saving the session.
+
+		With versioning, writes that change the session increment its version
+		and are compare-and-set writes (`cas` or `cas_fields`) against the
+		version it was loaded with.
+		"""
+		expected = session.version = getattr(session, 'version', 0)
+		if self.versioning:
+			session.version += 1
+
+		method, args = self._get_session_write(session)
+		if method == 'expire':
+			session.version = expected
+		elif self.versioning:
+			method = 'cas' if method == 'set' else 'cas_fields'
+			args = args[:2] + (expected,) + args[2:]
+		return method, args
+
+	def _get_session_write(self, session):
+		"""Returns the unversioned `(backend_method, args)` tuple saving the
+		session.
+
+		With dirty-tracking, sessions that didn't change since they were loaded
+		are not written. Only their TTL is refreshed. If only the codec's
+		`soft_fields` (the timestamps) changed the session is not dirty either.
+		Since every new turn changes the last input this only skips the write
+		for retransmits. Stores that support hash fields only get the fields
+		that changed.
+		"""
+		codec, backend_key, timeout = self.codec, self.get_backend_key(session.key), self.session_timeout
+		if codec is None:
+			return 'set', (backend_key, session, timeout)
+		elif not (self.dirty_tracking and getattr(codec, 'supports_fields', False)):
+			return 'set', (backend_key, codec.encode(session), timeout)
+		elif not getattr(self.backend, 'supports_fields', False):
+			value, changed = codec.encode_changes(session)
+			if changed is False:
+				return 'expire', (backend_key, timeout)
+			return 'set', (backend_key, value, timeout)
+
+		fields = codec.encode_fields(session)
+		changed = codec.changed_fields(session, fields)
+		session._snapshot = fields
+		if changed is not None and codec.soft_fields.issuperset(changed):
+			return 'expire', (backend_key, timeout)
+		elif changed is not None:
+			fields = {k: fields[k] for k in changed}
+		return 'set_fields', (backend_key, fields, timeout)
+
+
+
+@export
+class AsyncSessionManager(SessionManager, AsyncSessionManagerABC):
+	"""A session manager for asyncio apps. Requires an async cache backend
+	(see `flex.ussd.cache.AsyncCacheBackend`).
+
+	The session and its auxiliary values are loaded concurrently when the
+	session is stored as hash fields.
+	"""
+
+	write_behind_class = 'flex.ussd.writebehind.AsyncWriteBehindBackend'
+
+	async def open(self, request):
+		key = self.get_session_key(request)
+		session = self.prepare_session(request, key, *(await self.load(key)))
+		if self.leases and not (await self.acquire_lease(session)):
+			session._winner = await self.wait_for_winner(session)
+		return session
+
+	async def close(self, session, response):
+		session.last_response = self.pack_response(response)
+		try:
+			if not (await self.saved_session(session)):
+				return await self.get_winning_response(session)
+			await self.save_auxiliary(session)
+		finally:
+			await self.release_lease(session)
+
+	async def flush(self):
+		if self._write_behind is not None:
+			await self._write_behind.flush()
+
+	async def get_cached_response(self, request: UssdRequest):
+		return self.load_turn(request, await self.backend.get(self.get_turn_key(request)))
+
+	async def cache_response(self, request: UssdRequest, response):
+		value = self.dump_turn(request, response)
+		if value is not None:
+			await self.backend.set(self.get_turn_key(request), value, self.session_timeout)
+
+	async def get_winning_response(self, session):
+		saved = await self.get_saved_session(session.key)
+		return saved and self.unpack_response(saved.last_response)
+
+	async def acquire_lease(self, session):
+		key, backend = self.get_lease_key(session.key), self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			acquired = await backend.cas(key, b'1', 0, self.lease_timeout)
+		elif getattr(backend, 'in_process', False):
+			acquired = self.acquire_local_lease(key)
+		else:
+			return True
+		if acquired:
+			session._lease = key
+		return acquired
+
+	async def release_lease(self, session):
+		key = session.__dict__.pop('_lease', None)
+		if key is None:
+			return
+		backend = self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			await backend.delete(key)
+		else:
+			self._leases.pop(key, None)
+
+	async def is_leased(self, key):
+		backend = self.lease_backend
+		if getattr(backend, 'supports_cas', False):
+			return (await backend.get(key)) is not None
+		return self._leases.get(key, 0) > monotonic()
+
+	async def wait_for_winner(self, session):
+		key, deadline = self.get_lease_key(session.key), monotonic() + self.lease_wait
+		while await self.is_leased(key):
+			if monotonic() >= deadline:
+				return None
+			await asyncio.sleep(self.lease_interval)
+		return self.get_newer_response(session, await self.get_saved_session(session.key))
+
+	async def load(self, key: SessionKey):
+		aux_keys = self.get_auxiliary_keys(key)
+		if not aux_keys:
+			return (await self.get_saved_session(key)), {}
+
+		if self.tracks_fields:
+			session, values = await asyncio.gather(
+				self.get_saved_session(key), self.backend.get_many(aux_keys.values())
+			)
+		else:
+			backend_key = self.get_backend_key(key)
+			values = await self.backend.get_many([backend_key] + list(aux_keys.values()))
+			session = self.decode(values.pop(backend_key, None))
+
+		return session, self.auxiliary_values(aux_keys, values)
+
+	async def get_saved_session(self, key: SessionKey):
+		backend_key = self.get_backend_key(key)
+		if self.tracks_fields:
+			return self.decode_fields(await self.backend.get_fields(backend_key))
+		return self.decode(await self.backend.get(backend_key))
+
+	async def saved_session(self, session):
+		method, args = self.get_versioned_write(session)
+		if method is None:
+			return False
+		rv = await getattr(self.backend, method)(*args)
+		return rv if method in ('cas', 'cas_fields') else True
+
+	async def save_auxiliary(self, session):
+		writes = self.get_auxiliary_writes(session)
+		await asyncio.gather(*(getattr(self.backend, method)(*args) for method, args in writes))
 
 
 
 class SessionMiddleware(object):
+	"""Opens the request's session and saves it once the response is ready.
+
+	With the session manager's `write_behind` option the save is queued and
+	written by a background flusher (see `flex.ussd.writebehind`) so the
+	response doesn't wait for the store.
+	"""
 
 	__slots__ = ('handle_request',)
 
@@ -221,11 +771,53 @@ class SessionMiddleware(object):
 		self.handle_request = handle_request
 
 	def __call__(self, request):
-		session = request.app.session_manager.open(request)
+		manager, timer = request.app.session_manager, get_timer(request.app)
+		with timer('session_open'):
+			session = manager.open(request)
+		winner = manager.pop_winning_response(session)
+		if winner is not None:
+			return winner
 		request.session = session #= signals.open_session.pipe(request.app, session, request=request)
 
-		response = self.handle_request(request)
+		try:
+			response = self.handle_request(request)
+		except BaseException:
+			manager.release_lease(session)
+			raise
 
 		session = request.session #signals.save_session.pipe(request.app, request.session, response=response)
-		request.app.session_manager.close(session, response)
-		return response
+		with timer('session_close'):
+			winner = manager.close(session, response)
+		return response if winner is None else winner
+
+
+
+class AsyncSessionMiddleware(object):
+	"""`SessionMiddleware` for apps using an `AsyncRequestHandler` and an
+	`AsyncSessionManager`.
+	"""
+
+	__slots__ = ('handle_request',)
+
+	def __init__(self, handle_request):
+		self.handle_request = handle_request
+
+	async def __call__(self, request):
+		manager, timer = request.app.session_manager, get_timer(request.app)
+		with timer('session_open'):
+			session = await manager.open(request)
+		winner = manager.pop_winning_response(session)
+		if winner is not None:
+			return winner
+		request.session = session
+
+		try:
+			response = await self.handle_request(request)
+		except BaseException:
+			await manager.release_lease(session)
+			raise
+
+		session = request.session
+		with timer('session_close'):
+			winner = await manager.close(session, response)
+		return response if winner is None else winner
@@ -0,0 +1,234 @@
+from bisect import bisect
+from hashlib import blake2b
+
+from flex.utils.decorators import export
+from flex.utils.module_loading import import_if_string
+
+from .cache import CacheBackend
+
+
+
+def ring_hash(value):
+	"""A stable 64 bit hash of value's string form. Unlike `hash()` it is the
+	same in every process.
+	"""
+	return int.from_bytes(blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+
+def phone_number_shard_key(key):
+	"""Returns the part of a cache key that selects its shard.
+
+	A hash tag in braces (e.g. 'x:{0700}:y') is used if present. Otherwise
+	the segment after the first ':' is used which, for keys created by the
+	session manager (`<session_name>:<phone_number>[:<aux>]`), is the phone
+	number. So all of a subscriber's keys land on the same shard.
+	"""
+	key = str(key)
+	start = key.find('{')
+	if start > -1:
+		end = key.find('}', start + 1)
+		if end > start + 1:
+			return key[start+1:end]
+
+	parts = key.split(':', 2)
+	return parts[1] if len(parts) > 1 else key
+
+
+
+@export
+class HashRing(object):
+	"""A consistent-hash ring with virtual nodes.
+
+	Each node is placed on the ring `replicas * weight` times. A key belongs
+	to the first point clockwise from its hash. Adding a node only moves the
+	keys that fall on its new points, about 1/N of them, to it.
+	"""
+
+	__slots__ = ('replicas', 'nodes', '_weights', '_points', '_owners')
+
+	def __init__(self, nodes=None, replicas=160):
+		self.replicas = replicas
+		self.nodes = {}
+		self._weights = {}
+		self._points = []
+		self._owners = []
+		for name, node in (nodes or {}).items():
+			self.add_node(name, node)
+
+	def add_node(self, name, node, weight=1):
+		if name in self.nodes:
+			raise ValueError('Node %r already in hash ring.' % (name,))
+		self.nodes[name] = node
+		self._weights[name] = weight
+		self._rebuild()
+
+	def remove_node(self, name):
+		del self.nodes[name]
+		del self._weights[name]
+		self._rebuild()
+
+	def set_replicas(self, replicas):
+		"""Change the number of points per node and re-place the nodes."""
+		self.replicas = replicas
+		self._rebuild()
+
+	def _rebuild(self):
+		points = sorted(
+			(ring_hash('%s#%d' % (name, i)), name)
+			for name, weight in self._weights.items()
+				for i in range(int(self.replicas * weight))
+		)
+		self._points = [p for p, _ in points]
+		self._owners = [n for _, n in points]
+
+	def get_name(self, key):
+		"""Returns the name of the node owning key."""
+		if not self._points:
+			raise LookupError('Hash ring %r has no nodes.' % (self,))
+		i = bisect(self._points, ring_hash(key))
+		return self._owners[i if i < len(self._owners) else 0]
+
+	def get_node(self, key):
+		return self.nodes[self.get_name(key)]
+
+	def __len__(self):
+		return len(self.nodes)
+
+	def __repr__(self):
+		return '%s(%s)' % (self.__class__.__name__, ', '.join(map(str, self.nodes)))
+
+
+
+@export
+class ShardedCacheBackend(CacheBackend):
+	"""A cache backend spreading keys over several stores (shards) using a
+	consistent-hash `HashRing`.
+
+	Keys are routed by `shard_key(key)` (see `phone_number_shard_key`) so a
+	session and its auxiliary keys are always on the same shard and batch
+	operations take one round-trip per shard involved. Shards can be added
+	at runtime with `add_shard()`. Keys that move to the new shard are not
+	copied and will miss once.
+
+	Options are read from the app's config with the `cache_` prefix:
+	`shards` (a dict of names to stores or a list of stores), `shard_replicas`
+	and `shard_key`.
+	"""
+
+	__slots__ = ('ring', 'shard_key')
+
+	def __init__(self, app=None, shards=None, key_prefix=None, replicas=160,
+				shard_key=phone_number_shard_key):
+		self.ring = HashRing(replicas=replicas)
+		self.shard_key = shard_key
+		self.set_shards(shards)
+		super(ShardedCacheBackend, self).__init__(app, None, key_prefix)
+
+	@property
+	def store(self):
+		return self.ring if self.ring.nodes else None
+
+	def set_shards(self, shards):
+		if shards is None:
+			return
+		if not isinstance(shards, dict):
+			shards = {str(i): store for i, store in enumerate(shards)}
+		for name, store in shards.items():
+			self.add_shard(name, store)
+
+	def add_shard(self, name, store, weight=1):
+		store = import_if_string(store)
+		if callable(store):
+			store = store()
+		self.ring.add_node(name, store, weight)
+
+	def remove_shard(self, name):
+		self.ring.remove_node(name)
+
+	def init_app(self, app):
+		config = app.config.namespace('cache_')
+		if 'shard_replicas' in config:
+			self.ring.set_replicas(config['shard_replicas'])
+		self.shard_key = import_if_string(config.get('shard_key', self.shard_key))
+		if not self.ring.nodes and 'shards' in config:
+			self.set_shards(config['shards'])
+		super(ShardedCacheBackend, self).init_app(app)
+
+	def set_store(self, store):
+		if store is not None:
+			raise ValueError('%s uses shards not a store.' % (self.__class__.__name__,))
+
+	def get_shard(self, key):
+		return self.ring.get_node(self.shard_key(key))
+
+	def group_keys(self, keys):
+		"""Returns a list of `(shard, keys)` tuples."""
+		rv = {}
+		for key in keys:
+			name = self.ring.get_name(self.shard_key(key))
+			rv.setdefault(name, []).append(key)
+		return [(self.ring.nodes[name], keys) for name, keys in rv.items()]
+
+	def get(self, key):
+		return self.get_shard(key).get(self.make_key(key))
+
+	def set(self, key, value, timeout=None):
+		return self.get_shard(key).set(self.make_key(key), value, timeout)
+
+	def delete(self, key):
+		return self.get_shard(key).delete(self.make_key(key))
+
+	def expire(self, key, timeout):
+		return self.get_shard(key).expire(self.make_key(key), timeout)
+
+	def get_many(self, keys):
+		rv = {}
+		for shard, keys in self.group_keys(keys):
+			prefixed = {self.make_key(k): k for k in keys}
+			get_many = getattr(shard, 'get_many', None)
+			if get_many is None:
+				values = {k: shard.get(k) for k in prefixed}
+			else:
+				values = get_many(list(prefixed))
+			rv.update((prefixed[k], v) for k, v in values.items() if v is not None)
+		return rv
+
+	def set_many(self, mapping, timeout=None):
+		for shard, keys in self.group_keys(mapping):
+			set_many = getattr(shard, 'set_many', None)
+			if set_many is None:
+				for k in keys:
+					shard.set(self.make_key(k), mapping[k], timeout)
+			else:
+				set_many({self.make_key(k): mapping[k] for k in keys}, timeout)
+
+	def delete_many(self, keys):
+		for shard, keys in self.group_keys(keys):
+			delete_many = getattr(shard, 'delete_many', None)
+			if delete_many is None:
+				for k in keys:
+					shard.delete(self.make_key(k))
+			else:
+				delete_many([self.make_key(k) for k in keys])
+
+	@property
+	def supports_fields(self):
+		return bool(self.ring.nodes) and all(
+			hasattr(s, 'get_fields') and hasattr(s, 'set_fields') for s in self.ring.nodes.values()
+		)
+
+	def get_fields(self, key):
+		return self.get_shard(key).get_fields(self.make_key(key))
+
+	def set_fields(self, key, mapping, timeout=None):
+		return self.get_shard(key).set_fields(self.make_key(key), mapping, timeout)
+
+	@property
+	def supports_cas(self):
+		return bool(self.ring.nodes) and all(hasattr(s, 'cas') for s in self.ring.nodes.values())
+
+	def cas(self, key, value, version, timeout=None):
+		return self.get_shard(key).cas(self.make_key(key), value, version, timeout)
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		return self.get_shard(key).cas_fields(self.make_key(key), mapping, version, timeout)
@@ -1,12 +1,131 @@
-from flex.signal import Namespace
+from threading import Lock
 
-signals = Namespace('flex.ussd')
+from flex.signal import Namespace
 
 
 def _get_app_name(app):
 	return app if isinstance(app, str) else getattr(app, 'name', app)
 
 
+
+class Pipeline(object):
+	"""A signal whose receivers are compiled into a tuple per sender.
+
+	Receivers connected for a sender id (see `get_sender_id`) or for all
+	senders (sender=None) are called in the order they were connected. The
+	tuple of receivers for each sender is built on first use and cached
+	until a receiver is connected or disconnected, so sending is a dict
+	lookup and a loop. `has_receivers()` lets hot paths skip building
+	the signal's arguments when nothing is connected.
+	"""
+
+	__slots__ = ('name', 'get_sender_id', '_receivers', '_compiled', '_lock')
+
+	def __init__(self, name, get_sender_id=None):
+		self.name = name
+		self.get_sender_id = get_sender_id or (lambda sender: sender)
+		self._receivers = ()
+		self._compiled = {}
+		self._lock = Lock()
+
+	def configure(self, **options):
+		for k, v in options.items():
+			setattr(self, k, v)
+		self._compiled = {}
+		return self
+
+	def connect(self, receiver=None, sender=None):
+		"""Connect receiver for sender or for all senders if sender is None.
+		Can be used as a decorator.
+		"""
+		if receiver is None:
+			return lambda receiver: self.connect(receiver, sender)
+
+		sender_id = None if sender is None else self.get_sender_id(sender)
+		with self._lock:
+			if (sender_id, receiver) not in self._receivers:
+				self._receivers += ((sender_id, receiver),)
+			self._compiled = {}
+		return receiver
+
+	def disconnect(self, receiver, sender=None):
+		"""Disconnect receiver. Returns True if it was connected."""
+		sender_id = None if sender is None else self.get_sender_id(sender)
+		with self._lock:
+			receivers = self._receivers
+			self._receivers = tuple(r for r in receivers if r != (sender_id, receiver))
+			self._compiled = {}
+			return len(receivers) != len(self._receivers)
+
+	def receivers_for(self, sender):
+		"""Returns the tuple of receivers for sender."""
+		if not self._receivers:
+			return ()
+
+		sender_id = self.get_sender_id(sender)
+		compiled = self._compiled
+		try:
+			return compiled[sender_id]
+		except KeyError:
+			rv = compiled[sender_id] = self.compile(sender_id)
+			return rv
+		except TypeError:
+			return self.compile(sender_id)
+
+	def compile(self, sender_id):
+		return tuple(r for sid, r in self._receivers if sid is None or sid == sender_id)
+
+	def has_receivers(self, sender=None):
+		"""Whether any receiver is connected (for sender if given)."""
+		if not self._receivers:
+			return False
+		return sender is None or bool(self.receivers_for(sender))
+
+	def send(self, sender, **kwargs):
+		"""Call the receivers for sender. Returns a list of `(receiver,
+		return_value)` tuples.
+		"""
+		return [(r, r(sender, **kwargs)) for r in self.receivers_for(sender)]
+
+	def pipe(self, sender, value, **kwargs):
+		"""Pass value through the receivers for sender, each getting the
+		previous one's return value. Returns the final value.
+		"""
+		for receiver in self.receivers_for(sender):
+			value = receiver(sender, value, **kwargs)
+		return value
+
+	def __repr__(self):
+		return '%s(%r)' % (self.__class__.__name__, self.name)
+
+
+
+class PipelineNamespace(Namespace):
+	"""A signal namespace whose pipelines are compiled `Pipeline`s.
+
+	`pipeline(name)` returns the pipeline registered under name, creating it
+	on first use, so looking a pipeline up by name gets the instance that
+	fires.
+	"""
+
+	def __init__(self, *args, **kwargs):
+		super(PipelineNamespace, self).__init__(*args, **kwargs)
+		self._pipelines = {}
+		self._pipelines_lock = Lock()
+
+	def pipeline(self, name):
+		with self._pipelines_lock:
+			rv = self._pipelines.get(name)
+			if rv is None:
+				rv = self._pipelines[name] = Pipeline(name)
+			return rv
+
+
+
+signals = PipelineNamespace('flex.ussd')
+
+
+
 """ Pipelines
 """
 # Global config
@@ -24,4 +143,3 @@ save_session 			= signals.pipeline('save_session').configure(get_sender_id=_get_
 #
 before_request 			= signals.pipeline('before_request').configure(get_sender_id=_get_app_name)
 after_request 			= signals.pipeline('after_request').configure(get_sender_id=_get_app_name)
-
@@ -0,0 +1,269 @@
+import mmap
+import os
+import pickle
+import struct
+from threading import Lock
+from time import time
+
+from flex.utils.decorators import export
+
+
+# Entry flags.
+_PICKLED_VALUE, _BYTES_KEY = 1, 2
+
+
+
+@export
+def dump_snapshot(store, path, clock=time):
+	"""Write the live entries of store to a snapshot file at path. Returns
+	the number of entries written.
+
+	The store must implement `entries()` (see
+	`flex.ussd.stores.MemoryStore.entries`). Entries are streamed to a
+	temporary file which then replaces path, so a crash never leaves a
+	partial snapshot behind. TTLs are saved as absolute (wall clock) expiry
+	times so the time the process was down counts against them.
+
+	The file starts with `Snapshot.MAGIC`, the time it was taken and the
+	number of entries. Each entry is a fixed size header (flags, key and
+	value lengths, expiry time and version) followed by the key and value.
+	Values that are not bytes are pickled.
+	"""
+	tmp, count = '%s.%d.tmp' % (path, os.getpid()), 0
+	with open(tmp, 'wb') as fp:
+		now = clock()
+		fp.write(Snapshot.MAGIC + Snapshot.HEADER.pack(now, 0))
+		for key, value, ttl, version in store.entries():
+			flags = 0
+			if not isinstance(key, bytes):
+				key = str(key).encode()
+			else:
+				flags |= _BYTES_KEY
+			if not isinstance(value, bytes):
+				value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+				flags |= _PICKLED_VALUE
+			expires = 0.0 if ttl is None else now + ttl
+			fp.write(Snapshot.ENTRY.pack(flags, len(key), len(value), expires, version or 0))
+			fp.write(key)
+			fp.write(value)
+			count += 1
+		fp.seek(len(Snapshot.MAGIC))
+		fp.write(Snapshot.HEADER.pack(now, count))
+		fp.flush()
+		os.fsync(fp.fileno())
+	os.replace(tmp, path)
+	return count
+
+
+
+@export
+class Snapshot(object):
+	"""A memory-mapped snapshot written by `dump_snapshot()`.
+
+	Opening a snapshot only reads the entry headers and keys to build an
+	index. Values are decoded when an entry is popped. The file is unmapped
+	once every entry was popped or on `close()`.
+	"""
+
+	MAGIC = b'USNP\x01'
+	HEADER = struct.Struct('<dQ')
+	ENTRY = struct.Struct('<BIIdQ')
+
+	__slots__ = ('path', 'clock', 'taken_at', 'index', '_file', '_map')
+
+	def __init__(self, path, clock=time):
+		self.path = path
+		self.clock = clock
+		self.index = {}
+		self._file = open(path, 'rb')
+		try:
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			self._file.close()
+			raise ValueError('Snapshot %r is empty.' % (path,))
+
+		if self._map[:len(self.MAGIC)] != self.MAGIC:
+			self.close()
+			raise ValueError('File %r is not a session snapshot.' % (path,))
+		self.taken_at, count = self.HEADER.unpack_from(self._map, len(self.MAGIC))
+		self.build_index(count)
+
+	def build_index(self, count):
+		buf, unpack, size, now = self._map, self.ENTRY.unpack_from, self.ENTRY.size, self.clock()
+		offset = len(self.MAGIC) + self.HEADER.size
+		for _ in range(count):
+			flags, klen, vlen, expires, version = unpack(buf, offset)
+			start = offset + size
+			if not expires or expires > now:
+				key = buf[start:start+klen]
+				key = key if flags & _BYTES_KEY else key.decode()
+				self.index[key] = (start + klen, flags, vlen, expires, version)
+			offset = start + klen + vlen
+		if not self.index:
+			self.close()
+
+	def pop(self, key):
+		"""Remove key from the snapshot and return its `(value, ttl, version)`
+		or None if it's not in the snapshot or expired.
+		"""
+		entry = self.index.pop(key, None)
+		if entry is None:
+			return None
+
+		start, flags, vlen, expires, version = entry
+		value = self._map[start:start+vlen]
+		if not self.index:
+			self.close()
+
+		ttl = None
+		if expires:
+			ttl = expires - self.clock()
+			if ttl <= 0:
+				return None
+		return (pickle.loads(value) if flags & _PICKLED_VALUE else value), ttl, version
+
+	def discard(self, key):
+		self.index.pop(key, None)
+		if not self.index:
+			self.close()
+
+	def close(self):
+		self.index.clear()
+		if not self._map.closed:
+			self._map.close()
+		self._file.close()
+
+	@property
+	def closed(self):
+		return self._map.closed
+
+	def __contains__(self, key):
+		return key in self.index
+
+	def __len__(self):
+		return len(self.index)
+
+
+
+@export
+class WarmStore(object):
+	"""Wraps a store to warm it lazily from a snapshot on startup.
+
+	Reads that miss the store fault the entry in from the snapshot (with its
+	remaining TTL and version) so only the sessions that are used again are
+	decoded. Writes and deletes shadow the snapshot's entries.
+
+	E.g. restore the sessions saved at shutdown with::
+
+		cache_store = lambda: WarmStore(MemoryStore(), '/var/run/ussd/sessions.snap')
+
+	and save them by calling `snapshot()` (or `dump_snapshot()`) when the
+	process exits. A missing snapshot file is ignored.
+	"""
+
+	__slots__ = ('store', 'path', 'source', '_lock')
+
+	def __init__(self, store, path=None, clock=time):
+		self.store = store
+		self.path = path
+		self.source = None
+		self._lock = Lock()
+		if path is not None and os.path.exists(path):
+			self.source = Snapshot(path, clock)
+
+	@property
+	def warming(self):
+		source = self.source
+		return source is not None and not source.closed
+
+	def fault(self, key):
+		"""Load key from the snapshot into the store and return its value."""
+		with self._lock:
+			entry = self.source.pop(key) if self.warming else None
+			if entry is None:
+				return self.store.get(key)
+			value, ttl, version = entry
+			self.store.restore(key, value, ttl, version)
+			return value
+
+	def fault_many(self, keys):
+		for key in keys:
+			if key in self.source:
+				self.fault(key)
+
+	def shadow(self, keys):
+		with self._lock:
+			if self.warming:
+				for key in keys:
+					self.source.discard(key)
+
+	def snapshot(self, path=None):
+		"""Write the store's entries to path (defaults to the path the store
+		was warmed from). Entries not yet faulted in are restored first.
+		"""
+		if self.warming:
+			self.fault_many(list(self.source.index))
+		return dump_snapshot(self.store, path or self.path)
+
+	def get(self, key):
+		value = self.store.get(key)
+		if value is None and self.warming:
+			return self.fault(key)
+		return value
+
+	def get_many(self, keys):
+		keys = list(keys)
+		rv = self.store.get_many(keys)
+		if self.warming:
+			for key in keys:
+				if key not in rv and key in self.source:
+					value = self.fault(key)
+					if value is not None:
+						rv[key] = value
+		return rv
+
+	def set(self, key, value, timeout=None):
+		self.shadow((key,))
+		return self.store.set(key, value, timeout)
+
+	def set_many(self, mapping, timeout=None):
+		self.shadow(mapping)
+		return self.store.set_many(mapping, timeout)
+
+	def cas(self, key, value, version, timeout=None):
+		if self.warming:
+			self.fault_many((key,))
+		return self.store.cas(key, value, version, timeout)
+
+	def expire(self, key, timeout):
+		if self.warming:
+			self.fault_many((key,))
+		return self.store.expire(key, timeout)
+
+	def ttl(self, key):
+		if self.warming:
+			self.fault_many((key,))
+		return self.store.ttl(key)
+
+	def delete(self, key):
+		self.shadow((key,))
+		return self.store.delete(key)
+
+	def delete_many(self, keys):
+		keys = list(keys)
+		self.shadow(keys)
+		return self.store.delete_many(keys)
+
+	def restore(self, key, value, timeout=None, version=None):
+		self.shadow((key,))
+		return self.store.restore(key, value, timeout, version)
+
+	def entries(self):
+		return self.store.entries()
+
+	def close(self):
+		if self.source is not None:
+			self.source.close()
+		close = getattr(self.store, 'close', None)
+		if close is not None:
+			close()
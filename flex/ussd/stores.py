@@ -0,0 +1,634 @@
+import pickle
+import struct
+import sys
+import weakref
+from collections import OrderedDict
+from hashlib import blake2b
+from math import ceil
+from multiprocessing import Lock as MPLock
+from multiprocessing.shared_memory import SharedMemory
+from threading import Event, Lock, Thread
+from time import monotonic, time
+
+from flex.utils.decorators import export
+
+
+
+def sizeof(key, value):
+	"""Estimate the memory used by a cache entry in bytes."""
+	size = len(value) if isinstance(value, (bytes, bytearray, str)) else sys.getsizeof(value)
+	return size + (len(key) if isinstance(key, str) else sys.getsizeof(key))
+
+
+
+class _Entry(object):
+
+	__slots__ = ('value', 'expires', 'tick', 'size', 'version')
+
+	def __init__(self, value, expires, tick, size, version):
+		self.value = value
+		self.expires = expires
+		self.tick = tick
+		self.size = size
+		self.version = version
+
+
+
+class _Stripe(object):
+	"""One lock-protected shard of a `MemoryStore`.
+
+	Entries are kept in LRU order. Entries with a TTL are also scheduled in a
+	hashed timing wheel mapping the tick they expire in to their keys.
+	`last_tick` is the last tick swept and is only read or written under the
+	stripe's lock.
+	"""
+
+	__slots__ = ('lock', 'data', 'wheel', 'size', 'max_size', 'last_tick')
+
+	def __init__(self, max_size=None, last_tick=0):
+		self.lock = Lock()
+		self.data = OrderedDict()
+		self.wheel = {}
+		self.size = 0
+		self.max_size = max_size
+		self.last_tick = last_tick
+
+	def schedule(self, key, entry, tick):
+		if entry.tick is not None:
+			keys = self.wheel.get(entry.tick)
+			if keys is not None:
+				keys.discard(key)
+				if not keys:
+					del self.wheel[entry.tick]
+		entry.tick = tick
+		if tick is not None:
+			self.wheel.setdefault(tick, set()).add(key)
+
+	def remove(self, key):
+		entry = self.data.pop(key)
+		self.schedule(key, entry, None)
+		self.size -= entry.size
+		return entry
+
+	def evict(self):
+		"""Evict least recently used entries until the stripe fits its cap."""
+		evicted = 0
+		while self.max_size is not None and self.size > self.max_size and len(self.data) > 1:
+			self.remove(next(iter(self.data)))
+			evicted += 1
+		return evicted
+
+
+
+@export
+class MemoryStore(object):
+	"""A thread-safe in-process cache store.
+
+	Keys are spread over `stripes` independently locked shards so threads
+	working on different sessions rarely contend. Expired entries are dropped
+	when read and a background thread sweeps the rest every `sweep_interval`
+	seconds using a timing wheel, touching only the entries that expired.
+
+	If `max_size` (in bytes as estimated by `sizeof`) is set, the least
+	recently used entries are evicted to stay under it. The cap is split
+	evenly between the stripes so eviction is LRU per stripe.
+
+	Implements the cache store protocol used by `flex.ussd.cache.CacheBackend`
+	including the batch operations and versioned `cas()`.
+	"""
+
+	in_process = True
+
+	def __init__(self, stripes=16, max_size=None, sweep_interval=1.0, sizeof=sizeof, clock=monotonic):
+		self.clock = clock
+		self.sizeof = sizeof
+		self.sweep_interval = sweep_interval
+		self._last_tick = self.tick(clock())
+		self.stripes = tuple(
+			_Stripe(None if max_size is None else max_size // stripes, self._last_tick)
+			for _ in range(stripes)
+		)
+		self.evictions = 0
+		self.expirations = 0
+		self._sweeper = None
+		if sweep_interval:
+			self.start_sweeper()
+
+	@property
+	def size(self):
+		return sum(s.size for s in self.stripes)
+
+	def tick(self, timestamp):
+		"""Returns the timing wheel tick for timestamp. Entries expiring in a
+		tick are swept at its end.
+		"""
+		return ceil(timestamp / (self.sweep_interval or 1.0))
+
+	def get_stripe(self, key):
+		return self.stripes[hash(key) % len(self.stripes)]
+
+	def _get(self, stripe, key, now):
+		entry = stripe.data.get(key)
+		if entry is None:
+			return None
+		elif entry.expires is not None and entry.expires <= now:
+			stripe.remove(key)
+			self.expirations += 1
+			return None
+		stripe.data.move_to_end(key)
+		return entry
+
+	def _set(self, stripe, key, value, timeout, now, version=None):
+		entry = stripe.data.get(key)
+		if entry is None:
+			entry = stripe.data[key] = _Entry(value, None, None, 0, 0)
+		else:
+			stripe.data.move_to_end(key)
+			entry.value = value
+			stripe.size -= entry.size
+
+		entry.size = self.sizeof(key, value)
+		entry.version = entry.version + 1 if version is None else version
+		stripe.size += entry.size
+		self._expire(stripe, key, entry, timeout, now)
+		self.evictions += stripe.evict()
+
+	def _expire(self, stripe, key, entry, timeout, now):
+		if timeout is None:
+			entry.expires = None
+			stripe.schedule(key, entry, None)
+		else:
+			entry.expires = now + timeout
+			stripe.schedule(key, entry, max(self.tick(entry.expires), stripe.last_tick + 1))
+
+	def get(self, key):
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			entry = self._get(stripe, key, self.clock())
+			return None if entry is None else entry.value
+
+	def set(self, key, value, timeout=None):
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			self._set(stripe, key, value, timeout, self.clock())
+
+	def delete(self, key):
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			if key in stripe.data:
+				stripe.remove(key)
+				return True
+		return False
+
+	def expire(self, key, timeout):
+		"""Set the key's TTL. Returns False if the key doesn't exist."""
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			now = self.clock()
+			entry = self._get(stripe, key, now)
+			if entry is None:
+				return False
+			self._expire(stripe, key, entry, timeout, now)
+			return True
+
+	def ttl(self, key):
+		"""Returns the remaining TTL of key in seconds, None if it doesn't
+		expire or -1 if it doesn't exist.
+		"""
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			now = self.clock()
+			entry = self._get(stripe, key, now)
+			if entry is None:
+				return -1
+			return None if entry.expires is None else entry.expires - now
+
+	def cas(self, key, value, version, timeout=None):
+		"""Set key to value if its version is version. Missing keys have
+		version 0. See `flex.ussd.abc.CacheBackendABC.cas`.
+		"""
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			now = self.clock()
+			entry = self._get(stripe, key, now)
+			if (0 if entry is None else entry.version) != version:
+				return False
+			self._set(stripe, key, value, timeout, now, version + 1)
+			return True
+
+	def restore(self, key, value, timeout=None, version=None):
+		"""Set key like `set()` but with the given version, e.g. to reload an
+		entry from a snapshot.
+		"""
+		stripe = self.get_stripe(key)
+		with stripe.lock:
+			self._set(stripe, key, value, timeout, self.clock(), version)
+
+	def entries(self):
+		"""Iterate over the live entries as `(key, value, ttl, version)` tuples
+		where ttl is the remaining TTL in seconds or None. Each stripe is copied
+		under its lock so writers are only blocked one stripe at a time.
+		"""
+		for stripe in self.stripes:
+			with stripe.lock:
+				now = self.clock()
+				rows = [
+					(k, e.value, None if e.expires is None else e.expires - now, e.version)
+					for k, e in stripe.data.items() if e.expires is None or e.expires > now
+				]
+			yield from rows
+
+	def _group(self, keys):
+		rv = {}
+		for key in keys:
+			rv.setdefault(self.get_stripe(key), []).append(key)
+		return rv.items()
+
+	def get_many(self, keys):
+		rv = {}
+		for stripe, keys in self._group(keys):
+			with stripe.lock:
+				now = self.clock()
+				for key in keys:
+					entry = self._get(stripe, key, now)
+					if entry is not None:
+						rv[key] = entry.value
+		return rv
+
+	def set_many(self, mapping, timeout=None):
+		for stripe, keys in self._group(mapping):
+			with stripe.lock:
+				now = self.clock()
+				for key in keys:
+					self._set(stripe, key, mapping[key], timeout, now)
+
+	def delete_many(self, keys):
+		for stripe, keys in self._group(keys):
+			with stripe.lock:
+				for key in keys:
+					if key in stripe.data:
+						stripe.remove(key)
+
+	def clear(self):
+		for stripe in self.stripes:
+			with stripe.lock:
+				stripe.data.clear()
+				stripe.wheel.clear()
+				stripe.size = 0
+
+	def sweep(self):
+		"""Remove the entries that expired since the last sweep. Only the
+		timing wheel ticks that passed are visited. Returns the number of
+		entries removed.
+		"""
+		current = self.tick(self.clock()) - 1
+		if current <= self._last_tick:
+			return 0
+
+		removed = 0
+		for stripe in self.stripes:
+			with stripe.lock:
+				wheel = stripe.wheel
+				ticks = range(stripe.last_tick + 1, current + 1)
+				if len(wheel) < len(ticks):
+					ticks = sorted(t for t in wheel if t <= current)
+				for tick in ticks:
+					for key in wheel.pop(tick, ()):
+						entry = stripe.data.pop(key)
+						stripe.size -= entry.size
+						removed += 1
+				stripe.last_tick = max(stripe.last_tick, current)
+		self._last_tick = current
+		self.expirations += removed
+		return removed
+
+	def start_sweeper(self):
+		if self._sweeper is None:
+			self._sweeper = _Sweeper(self, self.sweep_interval)
+			self._sweeper.start()
+
+	def stop_sweeper(self):
+		if self._sweeper is not None:
+			self._sweeper.stop()
+			self._sweeper = None
+
+	close = stop_sweeper
+
+	def __contains__(self, key):
+		return self.get(key) is not None
+
+	def __len__(self):
+		return sum(len(s.data) for s in self.stripes)
+
+
+
+class _Sweeper(Thread):
+	"""Daemon thread calling `MemoryStore.sweep()` periodically. Holds a weak
+	reference to the store and exits once it is garbage collected.
+	"""
+
+	def __init__(self, store, interval):
+		super(_Sweeper, self).__init__(name='MemoryStoreSweeper', daemon=True)
+		self.store = weakref.ref(store)
+		self.interval = interval
+		self.stopped = Event()
+
+	def run(self):
+		while not self.stopped.wait(self.interval):
+			store = self.store()
+			if store is None:
+				break
+			store.sweep()
+			del store
+
+	def stop(self):
+		self.stopped.set()
+
+
+
+@export
+class ValueTooLarge(ValueError):
+	"""Raised by `SharedMemoryStore` for entries that don't fit in a slot."""
+	pass
+
+
+
+# Slot states.
+_EMPTY, _USED = 0, 1
+
+# Slot flags.
+_RAW, _PICKLED, _EXTERNAL = 0, 1, 2
+
+
+
+@export
+class SharedMemoryStore(object):
+	"""A cache store in a `multiprocessing.shared_memory` segment, shared by
+	all the worker processes on a host.
+
+	The segment holds a fixed-size hash table. Keys hash (with a stable hash)
+	to a bucket of `bucket_size` slots, which is probed linearly. Each bucket
+	is guarded by one of `lock_stripes` process-shared locks. When a bucket is
+	full the entry closest to expiring is evicted.
+
+	Every slot is `slot_size` bytes including a 32 byte header, so the key and
+	value must fit in the rest. Values that are not bytes are pickled.
+	Entries that don't fit are handled explicitly. If an `oversize_store` is
+	given they are kept there and the slot only records where the value is.
+	Otherwise `ValueTooLarge` is raised.
+
+	The locks are `multiprocessing` locks. They are inherited by forked
+	workers, so create the store in the master process before forking (e.g.
+	with gunicorn's preload_app). Call `unlink()` once, from the master, when
+	done with the segment. Attaching to an existing segment (`create=False`)
+	requires the `locks` of the store that created it.
+	"""
+
+	MAGIC = b'USSD'
+	HEADER = struct.Struct('<4sIII')
+	SLOT_HEADER = struct.Struct('<BBHIQdQ')
+
+	def __init__(self, name=None, buckets=2048, bucket_size=8, slot_size=1024,
+				lock_stripes=64, oversize_store=None, clock=time, create=True, locks=None):
+		if slot_size <= self.SLOT_HEADER.size:
+			raise ValueError('slot_size must be more than %d bytes.' % self.SLOT_HEADER.size)
+		elif not create and locks is None:
+			raise ValueError(
+				'The locks of the store that created %r are required to attach to it.' % (name,)
+			)
+
+		self.clock = clock
+		self.oversize_store = oversize_store
+		size = self.HEADER.size + buckets * bucket_size * slot_size
+		if create:
+			self.shm = SharedMemory(name, create=True, size=size)
+			self.HEADER.pack_into(self.shm.buf, 0, self.MAGIC, buckets, bucket_size, slot_size)
+		else:
+			self.shm = SharedMemory(name)
+			magic, buckets, bucket_size, slot_size = self.HEADER.unpack_from(self.shm.buf, 0)
+			if magic != self.MAGIC:
+				raise ValueError('Shared memory %r is not a %s.' % (name, self.__class__.__name__))
+
+		self.buckets = buckets
+		self.bucket_size = bucket_size
+		self.slot_size = slot_size
+		self.capacity = slot_size - self.SLOT_HEADER.size
+		self.locks = list(locks) if locks is not None else [MPLock() for _ in range(lock_stripes)]
+
+	@property
+	def name(self):
+		return self.shm.name
+
+	def key_hash(self, key):
+		return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')
+
+	def encode_key(self, key):
+		return key if isinstance(key, bytes) else str(key).encode()
+
+	def encode_value(self, value):
+		if isinstance(value, bytes):
+			return _RAW, value
+		return _PICKLED, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+	def decode_value(self, flags, value):
+		return pickle.loads(value) if flags == _PICKLED else value
+
+	def _bucket(self, hkey):
+		bucket = hkey % self.buckets
+		return bucket, self.locks[bucket % len(self.locks)]
+
+	def _slots(self, bucket):
+		start = self.HEADER.size + bucket * self.bucket_size * self.slot_size
+		return range(start, start + self.bucket_size * self.slot_size, self.slot_size)
+
+	def _find(self, bucket, hkey, bkey, now):
+		"""Returns the `(offset, header)` of the live slot holding key or
+		`(free_offset, None)` where free_offset is an empty or expired slot (or
+		None if the bucket is full). Expired slots holding key are freed.
+		"""
+		buf, unpack, free = self.shm.buf, self.SLOT_HEADER.unpack_from, None
+		for offset in self._slots(bucket):
+			header = unpack(buf, offset)
+			state, flags, klen, vlen, h, expires, version = header
+			if state == _EMPTY:
+				free = offset if free is None else free
+				continue
+			expired = expires and expires <= now
+			if h == hkey and bytes(buf[offset+self.SLOT_HEADER.size:offset+self.SLOT_HEADER.size+klen]) == bkey:
+				if expired:
+					self._free(offset, bkey, flags)
+					return offset, None
+				return offset, header
+			elif expired and free is None:
+				free = offset
+		return free, None
+
+	def _free(self, offset, bkey, flags):
+		buf = self.shm.buf
+		if flags == _EXTERNAL and self.oversize_store is not None:
+			self.oversize_store.delete(bkey)
+		buf[offset] = _EMPTY
+
+	def _victim(self, bucket):
+		"""Returns the offset of the slot to evict from a full bucket: the
+		one that expires first (entries without a TTL go last).
+		"""
+		buf, unpack = self.shm.buf, self.SLOT_HEADER.unpack_from
+		rv, soonest = None, None
+		for offset in self._slots(bucket):
+			expires = unpack(buf, offset)[5] or float('inf')
+			if soonest is None or expires < soonest:
+				rv, soonest = offset, expires
+		return rv
+
+	def _read(self, offset, header, bkey):
+		state, flags, klen, vlen, h, expires, version = header
+		if flags == _EXTERNAL:
+			return None if self.oversize_store is None else self.oversize_store.get(bkey)
+		start = offset + self.SLOT_HEADER.size + klen
+		return self.decode_value(flags, bytes(self.shm.buf[start:start+vlen]))
+
+	def _write(self, bucket, offset, hkey, bkey, value, timeout, now, version):
+		"""Write the entry to the slot at offset (or a victim's if None).
+		Returns its flags.
+		"""
+		flags, data = self.encode_value(value)
+		if len(bkey) > self.capacity:
+			raise ValueTooLarge('Key %r is too long for a %d byte slot.' % (bkey, self.slot_size))
+		elif len(bkey) + len(data) > self.capacity:
+			if self.oversize_store is None:
+				raise ValueTooLarge(
+					'Entry %r of %d bytes does not fit in a %d byte slot.'\
+					% (bkey, len(bkey) + len(data), self.capacity)
+				)
+			self.oversize_store.set(bkey, value, timeout)
+			flags, data = _EXTERNAL, b''
+
+		if offset is None:
+			offset = self._victim(bucket)
+			header = self.SLOT_HEADER.unpack_from(self.shm.buf, offset)
+			start = offset + self.SLOT_HEADER.size
+			self._free(offset, bytes(self.shm.buf[start:start+header[2]]), header[1])
+
+		buf, start = self.shm.buf, offset + self.SLOT_HEADER.size
+		buf[start:start+len(bkey)] = bkey
+		buf[start+len(bkey):start+len(bkey)+len(data)] = data
+		expires = 0.0 if timeout is None else now + timeout
+		self.SLOT_HEADER.pack_into(buf, offset, _USED, flags, len(bkey), len(data), hkey, expires, version)
+		return flags
+
+	def _set(self, key, value, timeout, version=None, new_version=None):
+		bkey = self.encode_key(key)
+		hkey = self.key_hash(bkey)
+		bucket, lock = self._bucket(hkey)
+		with lock:
+			now = self.clock()
+			offset, header = self._find(bucket, hkey, bkey, now)
+			current = 0 if header is None else header[6]
+			if version is not None and current != version:
+				return False
+			if new_version is None:
+				new_version = current + 1
+			external = header is not None and header[1] == _EXTERNAL
+			flags = self._write(bucket, offset, hkey, bkey, value, timeout, now, new_version)
+			# The old external value is only dropped once the new value is in
+			# the slot. A new external value overwrote it already.
+			if external and flags != _EXTERNAL and self.oversize_store is not None:
+				self.oversize_store.delete(bkey)
+			return True
+
+	def get(self, key):
+		bkey = self.encode_key(key)
+		hkey = self.key_hash(bkey)
+		bucket, lock = self._bucket(hkey)
+		with lock:
+			offset, header = self._find(bucket, hkey, bkey, self.clock())
+			return None if header is None else self._read(offset, header, bkey)
+
+	def set(self, key, value, timeout=None):
+		self._set(key, value, timeout)
+
+	def cas(self, key, value, version, timeout=None):
+		"""Set key to value if its version is version. Missing keys have
+		version 0. See `flex.ussd.abc.CacheBackendABC.cas`.
+		"""
+		return self._set(key, value, timeout, version)
+
+	def restore(self, key, value, timeout=None, version=None):
+		"""Set key like `set()` but with the given version."""
+		self._set(key, value, timeout, None, version)
+
+	def entries(self):
+		"""Iterate over the live entries as `(key, value, ttl, version)` tuples.
+		Keys are returned as strings.
+		"""
+		buf, unpack, size = self.shm.buf, self.SLOT_HEADER.unpack_from, self.SLOT_HEADER.size
+		for bucket in range(self.buckets):
+			with self.locks[bucket % len(self.locks)]:
+				now, rows = self.clock(), []
+				for offset in self._slots(bucket):
+					header = unpack(buf, offset)
+					state, flags, klen, vlen, h, expires, version = header
+					if state == _USED and not (expires and expires <= now):
+						bkey = bytes(buf[offset+size:offset+size+klen])
+						ttl = expires - now if expires else None
+						rows.append((bkey.decode(), self._read(offset, header, bkey), ttl, version))
+			yield from rows
+
+	def delete(self, key):
+		bkey = self.encode_key(key)
+		hkey = self.key_hash(bkey)
+		bucket, lock = self._bucket(hkey)
+		with lock:
+			offset, header = self._find(bucket, hkey, bkey, self.clock())
+			if header is None:
+				return False
+			self._free(offset, bkey, header[1])
+			return True
+
+	def expire(self, key, timeout):
+		"""Set the key's TTL. Returns False if the key doesn't exist."""
+		bkey = self.encode_key(key)
+		hkey = self.key_hash(bkey)
+		bucket, lock = self._bucket(hkey)
+		with lock:
+			now = self.clock()
+			offset, header = self._find(bucket, hkey, bkey, now)
+			if header is None:
+				return False
+			expires = 0.0 if timeout is None else now + timeout
+			self.SLOT_HEADER.pack_into(self.shm.buf, offset, *(header[:5] + (expires, header[6])))
+			if header[1] == _EXTERNAL and self.oversize_store is not None:
+				self.oversize_store.expire(bkey, timeout)
+			return True
+
+	def get_many(self, keys):
+		rv = {}
+		for key in keys:
+			value = self.get(key)
+			if value is not None:
+				rv[key] = value
+		return rv
+
+	def set_many(self, mapping, timeout=None):
+		for key, value in mapping.items():
+			self.set(key, value, timeout)
+
+	def delete_many(self, keys):
+		for key in keys:
+			self.delete(key)
+
+	def __len__(self):
+		buf, unpack, now, rv = self.shm.buf, self.SLOT_HEADER.unpack_from, self.clock(), 0
+		for offset in range(self.HEADER.size, len(buf) - self.slot_size + 1, self.slot_size):
+			state, expires = buf[offset], unpack(buf, offset)[5]
+			rv += state == _USED and not (expires and expires <= now)
+		return rv
+
+	def close(self):
+		"""Detach from the shared memory segment."""
+		self.shm.close()
+
+	def unlink(self):
+		"""Destroy the shared memory segment."""
+		self.shm.unlink()
@@ -0,0 +1,133 @@
+from functools import lru_cache
+
+from flex.utils.decorators import export
+
+
+
+@export
+def tokenize_ussd_string(value):
+	"""Split a ussd string into a list of tokens.
+
+	Tokens are separated by '*'. A separator is ignored if it's inside a
+	double quoted segment, and the quotes wrapping a whole token are
+	stripped. For example::
+
+		tokenize_ussd_string('123*"my*input"*00') == ['123', 'my*input', '00']
+
+	Like the old look-ahead split, a '*' is treated as a separator only if
+	it's followed by an even number of quotes. Strings without quotes are
+	split with `str.split`.
+	"""
+	if '"' not in value:
+		return value.split('*')
+
+	rv = []
+	append = rv.append
+	# Quotes remaining to the right of the current position.
+	quotes = value.count('"')
+	start = 0
+	pos = 0
+	for pos, char in enumerate(value):
+		if char == '"':
+			quotes -= 1
+		elif char == '*' and quotes % 2 == 0:
+			append(_unquote(value[start:pos]))
+			start = pos + 1
+	append(_unquote(value[start:]))
+	return rv
+
+
+@export
+def resume_tokenize(value, previous, previous_tokens):
+	"""Tokenize value by extending the tokens of a previous ussd string.
+
+	Gateways resend the whole accumulated ussd string on every turn. If value
+	is previous followed by a '*' and more input, only the new input is
+	tokenized and appended to a copy of previous_tokens. Returns None if the
+	previous tokens can't be reused. i.e. value doesn't extend previous, or
+	the new input has an odd number of quotes (which changes how the
+	previous part splits).
+	"""
+	if previous is None or previous_tokens is None:
+		return None
+	elif value == previous:
+		return list(previous_tokens)
+
+	ln = len(previous)
+	if len(value) > ln and value[ln] == '*' and value.startswith(previous):
+		rest = value[ln+1:]
+		if rest.count('"') % 2 == 0:
+			rv = list(previous_tokens)
+			rv.extend(token_cache.get(rest))
+			return rv
+	return None
+
+
+def _unquote(token):
+	if len(token) > 1 and token[0] == '"' and token[-1] == '"' and '\n' not in token:
+		return token[1:-1]
+	return token
+
+
+
+@export
+class UssdTokenCache(object):
+	"""A bounded, thread safe LRU cache of ussd strings to token tuples.
+
+	Most traffic is made of the same few dial strings and menu paths, so
+	tokens are shared across requests instead of re-tokenizing the same
+	strings. Strings longer than `max_length` are usually unique user input
+	and are tokenized without going through the cache.
+	"""
+
+	__slots__ = ('max_length', '_tokenize', '_bypassed')
+
+	def __init__(self, maxsize=2048, max_length=128):
+		self.max_length = max_length
+		self._bypassed = 0
+		self.resize(maxsize)
+
+	def resize(self, maxsize):
+		"""Replace the underlying cache with an empty one of the given size.
+		"""
+		self._tokenize = lru_cache(maxsize)(_tokenize_to_tuple)
+
+	def get(self, value):
+		if len(value) > self.max_length:
+			self._bypassed += 1
+			return _tokenize_to_tuple(value)
+		return self._tokenize(value)
+
+	__call__ = get
+
+	def info(self):
+		"""Returns a `(hits, misses, maxsize, currsize)` named tuple."""
+		return self._tokenize.cache_info()
+
+	@property
+	def hits(self):
+		return self.info().hits
+
+	@property
+	def misses(self):
+		return self.info().misses
+
+	@property
+	def bypassed(self):
+		return self._bypassed
+
+	def clear(self):
+		self._tokenize.cache_clear()
+		self._bypassed = 0
+
+	def __repr__(self):
+		return '%s(%s, bypassed=%d)' % (self.__class__.__name__, self.info(), self._bypassed)
+
+
+
+def _tokenize_to_tuple(value):
+	return tuple(tokenize_ussd_string(value))
+
+
+
+token_cache = UssdTokenCache()
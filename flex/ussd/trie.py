@@ -0,0 +1,114 @@
+from flex.utils.decorators import export
+from flex.utils.void import Void
+
+
+
+class _TrieNode(object):
+
+	__slots__ = ('children', 'value')
+
+	def __init__(self):
+		self.children = {}
+		self.value = Void
+
+
+
+@export
+class UssdCodeTrie(object):
+	"""A segment trie keyed on USSD tokens.
+
+	Each edge is a single USSD token (the parts between the '*'). Lookups walk
+	the given tokens once and return the value stored at the deepest matching
+	node, giving longest-prefix matches in O(depth) regardless of the number
+	of codes stored.
+	"""
+
+	__slots__ = ('_root', '_len')
+
+	def __init__(self, items=None):
+		self._root = _TrieNode()
+		self._len = 0
+		if items is not None:
+			for tokens, value in items:
+				self.insert(tokens, value)
+
+	def insert(self, tokens, value):
+		"""Store value under the given sequence of tokens. Replaces any value
+		already stored under the same tokens.
+		"""
+		node = self._root
+		for token in tokens:
+			child = node.children.get(token)
+			if child is None:
+				child = node.children[token] = _TrieNode()
+			node = child
+		if node.value is Void:
+			self._len += 1
+		node.value = value
+
+	def remove(self, tokens):
+		"""Remove the value stored under the given tokens. Raises KeyError if
+		the tokens are not in the trie.
+		"""
+		node, path = self._root, []
+		for token in tokens:
+			child = node.children.get(token)
+			if child is None:
+				raise KeyError(tokens)
+			path.append((node, token))
+			node = child
+
+		if node.value is Void:
+			raise KeyError(tokens)
+
+		node.value = Void
+		self._len -= 1
+		for parent, token in reversed(path):
+			if node.children or node.value is not Void:
+				break
+			del parent.children[token]
+			node = parent
+
+	def clear(self):
+		self._root = _TrieNode()
+		self._len = 0
+
+	def longest_prefix(self, tokens, start=0, default=None):
+		"""Find the longest stored prefix of tokens[start:].
+
+		Returns a `(value, length)` tuple where length is the number of
+		tokens matched from start. If no stored prefix matches,
+		`(default, None)` is returned.
+		"""
+		node = self._root
+		value, length = node.value, 0
+		depth = 0
+		for i in range(start, len(tokens)):
+			node = node.children.get(tokens[i])
+			if node is None:
+				break
+			depth += 1
+			if node.value is not Void:
+				value, length = node.value, depth
+
+		return (default, None) if value is Void else (value, length)
+
+	def get(self, tokens, default=None):
+		node = self._root
+		for token in tokens:
+			node = node.children.get(token)
+			if node is None:
+				return default
+		return default if node.value is Void else node.value
+
+	def __contains__(self, tokens):
+		return self.get(tokens, Void) is not Void
+
+	def __len__(self):
+		return self._len
+
+	def __bool__(self):
+		return self._len > 0
+
+	def __repr__(self):
+		return '%s(len=%d)' % (self.__class__.__name__, self._len)
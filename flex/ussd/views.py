@@ -1,5 +1,54 @@
+from collections import namedtuple
+
+from flex.utils.decorators import export
+
 from . import signals
-from .core import UssdRouter
+from .abc import UssdDataSequence
+from .trie import UssdCodeTrie
+from .wrappers import UssdCode
+
+
+
+UssdAppMatch = namedtuple('UssdAppMatch', 'code app length')
+export(UssdAppMatch, name='UssdAppMatch')
+
+
+
+@export
+class UssdAppMatcher(object):
+	"""Matches ussd strings to the most specific app in a list of
+	`(app_code, app)` pairs.
+
+	The codes are compiled into a token trie once so that each match is a
+	single prefix walk over the request's tokens. The matcher keeps a
+	reference to the list it was compiled from and reports itself stale if
+	that list is replaced or changes length.
+	"""
+
+	__slots__ = ('_source', '_size', '_trie')
+
+	def __init__(self, ussd_apps):
+		self._source = ussd_apps
+		self._size = len(ussd_apps)
+		self._trie = UssdCodeTrie()
+		for app_code, app in ussd_apps:
+			self._trie.insert(UssdCode(app_code), (app_code, app))
+
+	def is_current(self, ussd_apps):
+		return self._source is ussd_apps and self._size == len(ussd_apps)
+
+	def match(self, ussd_string):
+		"""Returns an `UssdAppMatch(code, app, length)` for the app with the
+		longest code prefixing ussd_string or None if no app matches. length
+		is the number of ussd tokens taken up by the app code.
+		"""
+		tokens = ussd_string.ussd_data if isinstance(ussd_string, UssdDataSequence) \
+			else UssdCode(ussd_string).ussd_data
+		rv, ln = self._trie.longest_prefix(tokens)
+		return None if ln is None else UssdAppMatch(rv[0], rv[1], ln)
+
+	def __len__(self):
+		return self._size
 
 
 
@@ -10,12 +59,41 @@ class UssdView(object):
 
 	]
 
+	app_matcher_class = UssdAppMatcher
+
+	_app_matcher = None
+
+	@classmethod
+	def register_ussd_app(cls, app_code, app):
+		"""Add app to the view's `ussd_apps` under app_code."""
+		if 'ussd_apps' not in cls.__dict__:
+			cls.ussd_apps = list(cls.ussd_apps)
+		cls.ussd_apps.append((app_code, app))
+		cls.reset_app_matcher()
+
+	@classmethod
+	def reset_app_matcher(cls):
+		"""Drop the compiled app matcher. Call after changing `ussd_apps` in
+		place other than through `register_ussd_app()`.
+		"""
+		cls._app_matcher = None
+
+	def get_app_matcher(self):
+		matcher = self.__class__.__dict__.get('_app_matcher')
+		if matcher is None or not matcher.is_current(self.ussd_apps):
+			matcher = self.app_matcher_class(self.ussd_apps)
+			self.__class__._app_matcher = matcher
+		return matcher
+
 	def match_ussd_app(self, request):
-		apps = list(filter(lambda k: request.ussd_string.startswith(k[0]), self.ussd_apps))
-		apps and apps.sort(key=lambda x: x[0])
-		if not apps:
+		"""Returns the `(app_code, app)` for request and sets
+		`request.input_offset` to the number of tokens in app_code.
+		"""
+		rv = self.get_app_matcher().match(request.ussd_code)
+		if rv is None:
 			raise RuntimeError('Error matching ussd app.')
-		return apps[-1]
+		request.input_offset = rv.length
+		return rv.code, rv.app
 
 	def make_ussd_request(self, http_request):
 		raise NotImplementedError('make_ussd_request')
@@ -28,8 +106,11 @@ class UssdView(object):
 
 	def dispatch_ussd_request(self, http_request):
 		request = self.make_ussd_request(http_request)
+		request.input_offset = None
 		app_code, app = self.match_ussd_app(request)
-		request.intup_string = request.ussd_string[len(app_code):]
+		request.app_code = app_code
+		if request.input_offset is None:
+			request.input_offset = len(UssdCode(app_code))
 
 		response = self.process_ussd_request(app, request)
 		if response is None:
@@ -1,8 +1,11 @@
+from bisect import bisect_right
 from collections import UserList
+from itertools import accumulate, islice
 
-from flex.utils.decorators import export
+from flex.utils.decorators import cached_property, export
 
 from .abc import UssdDataSequence
+from .tokens import resume_tokenize, token_cache
 
 
 
@@ -18,7 +21,6 @@ class UssdData(UssdDataSequence, UserList):
 	def __init__(self, data=None, name=None):
 		super(UssdData, self).__init__(self.parse_ussd_data(data))
 		self.name = data.name if name is None and isinstance(data, UssdData) else name
-		self.as_str()
 
 	@property
 	def ussd_data(self):
@@ -42,7 +44,186 @@ class UssdData(UssdDataSequence, UserList):
 		return '%s(data="%s")' % (self.__class__.__name__, self,)
 
 
-UssdCode = export(UssdData, name='UssdCode')
+@export
+class UssdCode(UssdDataSequence):
+	"""An immutable, hashable ussd code.
+
+	The token tuple, joined string and hash are computed once when the code
+	is created. Codes hash like their token tuples so they can be used as
+	dict keys interchangeably with tuples::
+
+		UssdCode('384*1') == ('384', '1')
+		{UssdCode('384*1'): ...}[('384', '1')]
+
+	Codes don't compare equal to strings since they can't hash like them.
+	Use `equals()` to compare a code to a string by its tokens.
+	"""
+
+	__slots__ = ('_tokens', '_str', '_hash')
+
+	def __init__(self, code=()):
+		if isinstance(code, UssdCode):
+			tokens = code._tokens
+		elif isinstance(code, str):
+			tokens = token_cache.get(code)
+		elif isinstance(code, UssdDataSequence):
+			tokens = tuple(code.ussd_data)
+		else:
+			tokens = tuple(code or ())
+
+		object.__setattr__(self, '_tokens', tokens)
+		object.__setattr__(self, '_str', code if isinstance(code, str) else '*'.join(tokens))
+		object.__setattr__(self, '_hash', hash(tokens))
+
+	@property
+	def ussd_data(self):
+		return self._tokens
+
+	data = ussd_data
+
+	def as_str(self):
+		return self._str
+
+	def copy(self):
+		return self
+
+	def _coerce(self, other):
+		if isinstance(other, UssdCode):
+			return other._tokens
+		elif isinstance(other, str):
+			return token_cache.get(other)
+		elif isinstance(other, tuple):
+			return other
+		elif isinstance(other, UssdDataSequence):
+			return tuple(other.ussd_data)
+		return tuple(other)
+
+	def equals(self, other):
+		"""Check equality against codes, strings, lists and tuples.
+		"""
+		if isinstance(other, UssdCode):
+			return self._hash == other._hash and self._tokens == other._tokens
+		elif isinstance(other, str) and other == self._str:
+			return True
+		try:
+			return self._tokens == self._coerce(other)
+		except (TypeError, ValueError):
+			return False
+
+	def startswith(self, other, start=None, end=None):
+		target = self._tokens if start is None and end is None else self._tokens[start:end]
+		other = self._coerce(other)
+		return len(target) >= len(other) and target[:len(other)] == other
+
+	def endswith(self, other, start=None, end=None):
+		target = self._tokens if start is None and end is None else self._tokens[start:end]
+		other = self._coerce(other)
+		return len(target) >= len(other) and target[len(target)-len(other):] == other
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			return self.__class__(self._tokens[key])
+		return self._tokens[key]
+
+	def __len__(self):
+		return len(self._tokens)
+
+	def __iter__(self):
+		return iter(self._tokens)
+
+	def __eq__(self, other):
+		if isinstance(other, (UssdDataSequence, tuple, list)):
+			return self.equals(other)
+		return NotImplemented
+
+	def __ne__(self, other):
+		rv = self.__eq__(other)
+		return rv if rv is NotImplemented else not rv
+
+	def __hash__(self):
+		return self._hash
+
+	def __setattr__(self, name, value):
+		raise AttributeError('%s objects are immutable.' % (self.__class__.__name__,))
+
+	def __delattr__(self, name):
+		raise AttributeError('%s objects are immutable.' % (self.__class__.__name__,))
+
+	def __reduce__(self):
+		return self.__class__, (self._tokens,)
+
+	def __repr__(self):
+		return '%s("%s")' % (self.__class__.__name__, self._str)
+
+
+
+@export
+class UssdDataView(UssdDataSequence):
+	"""A named, read-only view of a range of tokens in a shared token array.
+
+	Views don't copy the tokens they expose. Length, iteration and indexing
+	are translated to offsets in the underlying array.
+	"""
+
+	__slots__ = ('tokens', 'start', 'stop', 'name')
+
+	def __init__(self, tokens, start=0, stop=None, name=None):
+		self.tokens = tokens
+		self.start = start
+		self.stop = len(tokens) if stop is None else stop
+		self.name = name
+
+	@property
+	def ussd_data(self):
+		return self.tokens[self.start:self.stop]
+
+	data = ussd_data
+
+	def copy(self):
+		return UssdData(self.ussd_data, self.name)
+
+	def startswith(self, other, start=None, end=None):
+		if start is not None or end is not None:
+			return super(UssdDataView, self).startswith(other, start, end)
+
+		if isinstance(other, UssdDataSequence):
+			other = other.ussd_data
+		elif isinstance(other, str):
+			other = self.parse_ussd_data(other)
+
+		if len(other) > self.stop - self.start:
+			return False
+
+		tokens, offset = self.tokens, self.start
+		for i, token in enumerate(other):
+			if tokens[offset + i] != token:
+				return False
+		return True
+
+	def __len__(self):
+		return self.stop - self.start
+
+	def __iter__(self):
+		tokens = self.tokens
+		for i in range(self.start, self.stop):
+			yield tokens[i]
+
+	def __getitem__(self, key):
+		if isinstance(key, slice):
+			start, stop, step = key.indices(self.stop - self.start)
+			if step == 1:
+				return self.__class__(self.tokens, self.start + start, self.start + max(start, stop))
+			return self.ussd_data[key]
+
+		ln = self.stop - self.start
+		if key < 0:
+			key += ln
+		if not 0 <= key < ln:
+			raise IndexError('UssdDataView index out of range')
+		return self.tokens[self.start + key]
+
+	def __repr__(self):
+		return '%s(data="%s", name=%r)' % (self.__class__.__name__, self, self.name)
 
 
 
@@ -50,16 +231,35 @@ UssdCode = export(UssdData, name='UssdCode')
 @export
 class UssdDataStack(UssdDataSequence):
 	"""Base class for USSD argument vetors.
+
+	Keeps the cumulative end offset of each chunk so that len() is O(1) and
+	positional indexing is a binary search over the chunks instead of
+	flattening them into a list.
 	"""
-	__slots__ = ('data',)
+	__slots__ = ('_chunks', '_offsets')
 
 	def __init__(self, d):
 		self.data = list(self.parse_ussd_data(c) for c in ((d,) if isinstance(d, str) else d or [()]))
 
+	@property
+	def data(self):
+		return self._chunks
+
+	@data.setter
+	def data(self, value):
+		self._chunks = value
+		self.reindex()
+
 	@property
 	def ussd_data(self):
 		return list(self)
 
+	def reindex(self):
+		"""Rebuild the chunk offsets. Must be called after the chunks in data
+		are modified in place.
+		"""
+		self._offsets = list(accumulate(len(c) for c in self._chunks))
+
 	def get(self, name, default=None):
 		try:
 			return self[name]
@@ -69,30 +269,44 @@ class UssdDataStack(UssdDataSequence):
 	def copy(self):
 		return self.__class__(self.data)
 
-	def __getitem_custom__(self, key):
-		if isinstance(key, int):
-			_key = key
-			sign = -1 if key < 0 else 1
-			for ci in (range(-1, -(len(self.data)+1), -1) if key < 0 else range(len(self.data))):
-				chunk = self.data[ci]
-				lchunck = len(chunk)
-				if lchunck > key*sign or (sign == -1 and lchunck == key*sign):
-					return chunk[key]
-				else:
-					key = key - lchunck*sign
-			raise KeyError(_key)
+	def _locate(self, index):
+		"""Return the (chunk_index, local_index) of the given absolute index.
+		"""
+		ci = bisect_right(self._offsets, index)
+		return ci, index - (self._offsets[ci-1] if ci else 0)
 
 	def __getitem__(self, key):
 		if key is None or isinstance(key, str):
 			for chunk in self.data:
-				if key == chunk.name:
+				if key == getattr(chunk, 'name', None):
 					return chunk
 			raise KeyError('No chunk named %s.' % (key,))
+		elif isinstance(key, slice):
+			start, stop, step = key.indices(len(self))
+			if step != 1:
+				return list(self)[key]
+			rv = []
+			if start >= stop:
+				return rv
+			ci, i = self._locate(start)
+			ln = stop - start
+			for chunk in islice(self._chunks, ci, None):
+				rv.extend(chunk[i:i+ln-len(rv)])
+				if len(rv) >= ln:
+					break
+				i = 0
+			return rv
 		else:
-			return list(self).__getitem__(key)
+			ln = len(self)
+			if key < 0:
+				key += ln
+			if not 0 <= key < ln:
+				raise IndexError('%s index out of range' % (self.__class__.__name__,))
+			ci, i = self._locate(key)
+			return self._chunks[ci][i]
 
 	def __len__(self):
-		sum((len(c) for c in self.data))
+		return self._offsets[-1] if self._offsets else 0
 
 	def __iter__(self):
 		for chunk in self.data:
@@ -114,46 +328,102 @@ class UssdDataStack(UssdDataSequence):
 class UssdRequestData(UssdDataStack):
 	"""The USSD request data.
 
-	TODO:
-		Use views to define partitions and slices instead of partitioning the
-		data into nested chunks. Chunking makes some operations like len(),
-		iter() e.t.c more expensive.
+	The data is held in a single token array. Partitions and the head are
+	`UssdDataView`s over offset ranges of that array, so partitioning,
+	len(), iter() and indexing never copy the tokens.
 
 	Attributes:
-		data: A list representing the USSD request data.data
+		tokens: A list of all the tokens in the USSD request data.
+		data: The partitions followed by the head.
 		head: The top most unpartitioned chunk of the data.
+		resumed_at: The number of tokens reused from a previous ussd string
+			if the data was parsed incrementally, otherwise None.
 	"""
 
-	__slots__ = ()
+	__slots__ = ('tokens', '_partitions', '_head', 'resumed_at')
 
 	def __init__(self, d):
-		self.data = list(UssdData(c) for c in ((d,) if isinstance(d, str) else d or [()]))
-		self.data[-1].name = 'head'
+		chunks = (d,) if isinstance(d, str) else d or [()]
+		self.tokens = []
+		self._partitions = []
+		self.resumed_at = None
+		for chunk in chunks:
+			start = len(self.tokens)
+			self.tokens.extend(self.parse_ussd_data(chunk))
+			self._partitions.append(UssdDataView(self.tokens, start, len(self.tokens), getattr(chunk, 'name', None)))
+		self._head = self._partitions.pop()
+		self._head.name = 'head'
+
+	@classmethod
+	def parse(cls, ussd_string, previous_string=None, previous_tokens=None):
+		"""Create request data from ussd_string, reusing the tokens of the
+		previous turn's ussd string where possible.
+		"""
+		tokens = resume_tokenize(ussd_string, previous_string, previous_tokens)
+		if tokens is None:
+			return cls(ussd_string)
+
+		rv = cls(())
+		rv.tokens = rv._head.tokens = tokens
+		rv._head.stop = len(tokens)
+		rv.resumed_at = len(previous_tokens)
+		return rv
+
+	@property
+	def data(self):
+		return self._partitions + [self._head]
+
+	@property
+	def ussd_data(self):
+		return self.tokens
 
 	@property
 	def head(self):
-		return self.data[-1]
+		return self._head
 
 	def partition(self, chunk, name=None):
-		if isinstance(chunk, (str, list, tuple, UssdData)):
-			chunk = UssdData(chunk)
-			if not self.head.startswith(chunk):
+		head = self._head
+		if isinstance(chunk, (str, list, tuple, UssdDataSequence)):
+			if isinstance(chunk, UssdDataSequence):
+				chunk = chunk.ussd_data
+			elif chunk == '':
+				chunk = ()
+			else:
+				chunk = self.parse_ussd_data(chunk)
+			if not head.startswith(chunk):
 				raise ValueError('Shift value must be a prefix of argv head.')
 			ln = len(chunk)
 		elif isinstance(chunk, int):
-			ln = chunk
-			chunk = UssdData(self.head[:ln])
+			ln = min(max(chunk, 0), len(head))
+		else:
+			return None
 
 		if name is not None and (name == 'head' or not isinstance(name, str)):
 			raise ValueError('Partition name must be any str other than "head" or None.')
 
-		if chunk is not None:
-			self.head[:ln] = []
-			chunk.name = name
-		return chunk
+		rv = UssdDataView(self.tokens, head.start, head.start + ln, name)
+		head.start += ln
+		self._partitions.append(rv)
+		return rv
+
+	def copy(self):
+		return self.__class__(self.data)
 
 	def __getitem__(self, key):
-		return self.head if key == 'head' else super(UssdRequestData, self).__getitem__(key)
+		if key == 'head':
+			return self._head
+		elif key is None or isinstance(key, str):
+			for chunk in self._partitions:
+				if key == chunk.name:
+					return chunk
+			raise KeyError('No chunk named %s.' % (key,))
+		return self.tokens[key]
+
+	def __len__(self):
+		return len(self.tokens)
+
+	def __iter__(self):
+		return iter(self.tokens)
 
 
 
@@ -167,6 +437,9 @@ class UssdRequest(object):
 		self.phone_number = phone_number
 		self.session_id = session_id
 		self.http_request = http_request
+		self._service_code = service_code
+		self._initial_code = initial_code
+		self._previous = None
 
 		ussd_string = ussd_string or ''
 		if initial_code and ussd_string != initial_code and not ussd_string.startswith(initial_code+'*'):
@@ -175,15 +448,59 @@ class UssdRequest(object):
 		if service_code:
 			ussd_string = service_code + '*' + ussd_string if ussd_string else service_code
 
-		self.data = UssdRequestData([ussd_string,])
-		self.data.partition(service_code or '', 'service_code')
-		if initial_code:
-			self.data.partition(initial_code, 'initial_code')
+		self.raw_ussd_string = ussd_string
+
+	@cached_property
+	def data(self):
+		rv = UssdRequestData.parse(self.raw_ussd_string, *(self._previous or ()))
+		rv.partition(self._service_code or '', 'service_code')
+		if self._initial_code:
+			rv.partition(self._initial_code, 'initial_code')
+		return rv
+
+	@property
+	def parsed(self):
+		"""Whether the request data has been parsed."""
+		return 'data' in self.__dict__
+
+	@property
+	def ussd_string(self):
+		return self.data
+
+	@property
+	def ussd_code(self):
+		"""The raw ussd string as an `UssdCode` tokenized through the shared
+		token cache. Matching apps and routes against it doesn't parse the
+		request data, so it can still be resumed when the session is opened.
+		"""
+		return UssdCode(self.raw_ussd_string)
 
 	@property
 	def service_code(self):
 		return self.data['service_code']
 
+	@property
+	def inputs(self):
+		"""The inputs sent in this turn of the session.
+
+		If the data was parsed against the previous turn's ussd string, these
+		are the tokens following it. Otherwise all the tokens in the head.
+		"""
+		data = self.data
+		start = data.head.start if data.resumed_at is None else max(data.resumed_at, data.head.start)
+		return UssdDataView(data.tokens, start, len(data.tokens), 'inputs')
+
+	def resume(self, previous_string, previous_tokens):
+		"""Parse the request data incrementally against the ussd string and
+		tokens of the session's previous turn.
+
+		Has no effect if the data has already been parsed. Accessing
+		`ussd_string` or `data` parses it, use `ussd_code` to match requests
+		before the session is opened.
+		"""
+		if 'data' not in self.__dict__ and previous_string is not None:
+			self._previous = (previous_string, previous_tokens)
+
 
 
 
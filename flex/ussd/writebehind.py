@@ -0,0 +1,581 @@
+import asyncio
+import atexit
+import os
+import weakref
+from collections import OrderedDict
+from logging import getLogger
+from threading import Event, Lock, Thread
+
+from flex.utils.decorators import export
+
+from .abc import CacheBackendABC, AsyncCacheBackendABC
+
+
+logger = getLogger('ussd')
+
+# Kinds of queued writes.
+_SET, _FIELDS, _EXPIRE, _DELETE = 'set', 'fields', 'expire', 'delete'
+
+
+
+class _Write(object):
+	"""A queued write. version is the version expected in the store (for
+	compare-and-set writes) and head the version after the write.
+	"""
+
+	__slots__ = ('kind', 'value', 'version', 'head', 'timeout')
+
+	def __init__(self, kind, value=None, version=None, timeout=None):
+		self.kind = kind
+		self.value = value
+		self.version = version
+		self.head = None if version is None else version + 1
+		self.timeout = timeout
+
+
+
+class _WriteBehind(object):
+	"""The write queue and read overlay shared by the sync and async
+	write-behind backends. Callers hold the lock.
+	"""
+
+	__slots__ = ()
+
+	#: The longest delay between retries of a failing flush, in seconds.
+	max_backoff = 30.0
+
+	def __init__(self, backend, maxsize=1024, interval=0.05):
+		self.backend = backend
+		self.maxsize = maxsize
+		self.interval = interval
+		self.pending = OrderedDict()
+		self.inflight = OrderedDict()
+		self.conflicts = 0
+		self.errors = 0
+		self.failures = 0
+
+	def init_app(self, app):
+		pass
+
+	@property
+	def supports_fields(self):
+		return getattr(self.backend, 'supports_fields', False)
+
+	@property
+	def supports_cas(self):
+		return getattr(self.backend, 'supports_cas', False)
+
+	@property
+	def in_process(self):
+		return getattr(self.backend, 'in_process', False)
+
+	def is_full(self, keys):
+		return len(self.pending) >= self.maxsize and any(k not in self.pending for k in keys)
+
+	def get_writes(self, key):
+		return self.inflight.get(key, []) + self.pending.get(key, [])
+
+	def head(self, key):
+		"""Returns the version key will have once its queued writes are
+		flushed or None if unknown.
+		"""
+		for write in reversed(self.get_writes(key)):
+			if write.kind == _DELETE:
+				return None
+			elif write.head is not None:
+				return write.head
+		return None
+
+	def add(self, key, write):
+		"""Queue write coalescing it with the pending writes to key. Returns
+		False if write expects a different version than the queued writes
+		leave key with.
+		"""
+		if write.version is not None:
+			head = self.head(key)
+			if head is not None and head != write.version:
+				return False
+		self.merge(self.pending, key, write)
+		return True
+
+	def merge(self, queue, key, write):
+		"""Coalesce write with the writes to key in queue.
+
+		Compare-and-set writes are kept in order, each has to increment the
+		version in the store. Only expires are folded into them.
+		"""
+		writes = queue.get(key)
+		if not writes:
+			queue[key] = [write]
+			return
+
+		last = writes[-1]
+		if write.kind == _DELETE:
+			writes[:] = [write]
+		elif write.kind == _EXPIRE:
+			if last.kind != _DELETE:
+				last.timeout = write.timeout
+		elif write.kind == _SET and (write.version is None or all(w.version is None for w in writes)):
+			writes[:] = [write]
+		elif write.kind == _FIELDS and last.kind == _FIELDS and write.version is None and last.version is None:
+			last.value = dict(last.value, **write.value)
+			last.timeout = write.timeout
+		else:
+			writes.append(write)
+
+	def needs_backend(self, writes):
+		return not writes or writes[0].kind not in (_SET, _DELETE)
+
+	def overlay(self, value, writes):
+		"""Returns the value a key with value in the backend will have once
+		writes are flushed.
+		"""
+		for write in writes:
+			if write.kind == _SET:
+				value = write.value
+			elif write.kind == _DELETE:
+				value = None
+			elif write.kind == _FIELDS:
+				value = dict(value or (), **write.value)
+		return value
+
+	def take(self):
+		"""Move the pending writes in flight and return them. Writes left in
+		flight by a failed flush go first, with the newer pending writes
+		merged on top.
+		"""
+		batch, pending = self.inflight, self.pending
+		if not batch:
+			batch = pending
+		else:
+			for key, writes in pending.items():
+				for write in writes:
+					self.merge(batch, key, write)
+		self.inflight, self.pending = batch, OrderedDict()
+		return batch
+
+	def done(self, batch, keys, count=None):
+		"""Drop the writes applied to the backend from the in-flight batch,
+		all the writes to keys or the first count if given.
+		"""
+		for key in keys:
+			if count is None or len(batch[key]) <= count:
+				del batch[key]
+			else:
+				del batch[key][:count]
+
+	def flushed(self, batch, error):
+		"""Clear the batch once written. If the flush failed, the writes not
+		applied stay in flight and are retried by the next flush.
+		"""
+		if error is None:
+			self.inflight = OrderedDict()
+			self.failures = 0
+		else:
+			self.failures += 1
+			self.failed(batch, error)
+
+	def get_delay(self):
+		"""Returns the seconds to wait before the next flush, backing off
+		exponentially (up to `max_backoff`) while flushes fail.
+		"""
+		interval = self.interval or 0.05
+		if not self.failures:
+			return interval
+		return min(self.max_backoff, interval * 2 ** self.failures)
+
+	def group(self, batch):
+		"""Split batch into `(sets, deletes, others)` where sets maps timeouts
+		to the plain sets to write with `set_many()`, deletes is a list of keys
+		to remove with `delete_many()` and others a list of `(key, write)`
+		tuples to apply one by one, in order.
+		"""
+		sets, deletes, others = {}, [], []
+		for key, writes in batch.items():
+			if len(writes) == 1 and writes[0].kind == _SET and writes[0].version is None:
+				sets.setdefault(writes[0].timeout, {})[key] = writes[0].value
+			elif len(writes) == 1 and writes[0].kind == _DELETE:
+				deletes.append(key)
+			else:
+				others.extend((key, w) for w in writes)
+		return sets, deletes, others
+
+	def get_write(self, key, write):
+		"""Returns the `(backend_method, args)` tuple applying write."""
+		if write.kind == _SET:
+			if write.version is None:
+				return 'set', (key, write.value, write.timeout)
+			return 'cas', (key, write.value, write.version, write.timeout)
+		elif write.kind == _FIELDS:
+			if write.version is None:
+				return 'set_fields', (key, write.value, write.timeout)
+			return 'cas_fields', (key, write.value, write.version, write.timeout)
+		elif write.kind == _EXPIRE:
+			return 'expire', (key, write.timeout)
+		return 'delete', (key,)
+
+	def applied(self, key, method, rv):
+		if method in ('cas', 'cas_fields') and not rv:
+			self.conflicts += 1
+			logger.warning('Write-behind %s to %r lost a version check. Dropped.' % (method, key))
+
+	def failed(self, batch, error):
+		self.errors += 1
+		logger.error(
+			'Write-behind flush failed. %d keys kept for retry in %.2fs.'\
+			% (len(batch), self.get_delay()), exc_info=error
+		)
+
+
+
+@export
+class WriteBehindBackend(_WriteBehind, CacheBackendABC):
+	"""Wraps a cache backend to take writes off the request path.
+
+	Writes are queued in a bounded per-process queue and written by a
+	background thread every `interval` seconds. Repeated writes to the same
+	key are coalesced (e.g. field updates are merged and later sets replace
+	earlier ones). Reads see the queued writes so the next turn of a session
+	reads its own writes even if it lands before the flush.
+
+	Compare-and-set writes are not merged since each must increment the
+	stored version. They are checked against the queued writes when queued
+	and against the store when flushed. Writes that lose in the store are
+	dropped and counted in `conflicts`.
+
+	If a flush fails the writes it didn't apply stay in flight (and visible
+	to reads) and are retried, under any newer writes, with an exponential
+	backoff. Failures are counted in `errors`.
+
+	When the queue holds `maxsize` keys the request adding a new key flushes
+	it itself. Queued writes are flushed by `close()` and at exit.
+
+	The flusher thread is started by the first queued write. A forked child
+	process drops the writes queued by its parent, which flushes them, and
+	starts its own flusher.
+	"""
+
+	__slots__ = ('backend', 'maxsize', 'interval', 'pending', 'inflight', 'conflicts',
+				'errors', 'failures', '_lock', '_flush_lock', '_flusher', '__weakref__')
+
+	def __init__(self, backend, maxsize=1024, interval=0.05):
+		super(WriteBehindBackend, self).__init__(backend, maxsize, interval)
+		self._lock = Lock()
+		self._flush_lock = Lock()
+		self._flusher = None
+		_backends.add(self)
+
+	def queue(self, writes):
+		"""Queue writes, a list of `(key, _Write)` tuples. Returns False if
+		any lost a version check.
+		"""
+		if self.is_full([k for k, _ in writes]):
+			self.flush()
+		with self._lock:
+			rv = all([self.add(key, write) for key, write in writes])
+		if self.interval:
+			if self._flusher is None:
+				self.start()
+			self._flusher.wakeup.set()
+		return rv
+
+	def get(self, key):
+		with self._lock:
+			writes = self.get_writes(key)
+		value = self.backend.get(key) if self.needs_backend(writes) else None
+		return self.overlay(value, writes)
+
+	def get_many(self, keys):
+		with self._lock:
+			writes = {k: self.get_writes(k) for k in keys}
+		keys = [k for k, w in writes.items() if self.needs_backend(w)]
+		get_many = getattr(self.backend, 'get_many', None)
+		values = {k: self.backend.get(k) for k in keys} if get_many is None else get_many(keys)
+		rv = {}
+		for key, w in writes.items():
+			value = self.overlay(values.get(key), w)
+			if value is not None:
+				rv[key] = value
+		return rv
+
+	def get_fields(self, key):
+		with self._lock:
+			writes = self.get_writes(key)
+		value = self.backend.get_fields(key) if self.needs_backend(writes) else None
+		return self.overlay(value, writes)
+
+	def set(self, key, value, timeout=None):
+		self.queue([(key, _Write(_SET, value, None, timeout))])
+
+	def set_many(self, mapping, timeout=None):
+		self.queue([(k, _Write(_SET, v, None, timeout)) for k, v in mapping.items()])
+
+	def set_fields(self, key, mapping, timeout=None):
+		self.queue([(key, _Write(_FIELDS, dict(mapping), None, timeout))])
+
+	def cas(self, key, value, version, timeout=None):
+		return self.queue([(key, _Write(_SET, value, version, timeout))])
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		return self.queue([(key, _Write(_FIELDS, dict(mapping), version, timeout))])
+
+	def expire(self, key, timeout):
+		self.queue([(key, _Write(_EXPIRE, None, None, timeout))])
+
+	def delete(self, key):
+		self.queue([(key, _Write(_DELETE))])
+
+	def delete_many(self, keys):
+		self.queue([(k, _Write(_DELETE)) for k in keys])
+
+	def flush(self):
+		"""Write the queued writes to the backend."""
+		with self._flush_lock:
+			with self._lock:
+				batch = self.take()
+			error = None
+			try:
+				if batch:
+					self.write(batch)
+			except Exception as e:
+				error = e
+			with self._lock:
+				self.flushed(batch, error)
+
+	def write(self, batch):
+		sets, deletes, others = self.group(batch)
+		backend = self.backend
+		set_many, delete_many = getattr(backend, 'set_many', None), getattr(backend, 'delete_many', None)
+		for timeout, mapping in sets.items():
+			if set_many is None:
+				others.extend((k, _Write(_SET, v, None, timeout)) for k, v in mapping.items())
+			else:
+				set_many(mapping, timeout)
+				with self._lock:
+					self.done(batch, mapping)
+		if deletes and delete_many is None:
+			others.extend((k, _Write(_DELETE)) for k in deletes)
+		elif deletes:
+			delete_many(deletes)
+			with self._lock:
+				self.done(batch, deletes)
+		for key, write in others:
+			method, args = self.get_write(key, write)
+			self.applied(key, method, getattr(self.backend, method)(*args))
+			with self._lock:
+				self.done(batch, (key,), 1)
+
+	def start(self):
+		if self._flusher is None:
+			self._flusher = _Flusher(self, self.interval)
+			self._flusher.start()
+
+	def stop(self):
+		if self._flusher is not None:
+			self._flusher.stop()
+			self._flusher = None
+
+	def close(self):
+		"""Stop the flusher thread and flush the queued writes."""
+		self.stop()
+		self.flush()
+
+	def after_fork(self):
+		"""Reset the state inherited by a forked child process."""
+		self._lock = Lock()
+		self._flush_lock = Lock()
+		self._flusher = None
+		self.pending.clear()
+		self.inflight.clear()
+		self.failures = 0
+
+	def __len__(self):
+		return len(self.pending)
+
+
+
+class _Flusher(Thread):
+	"""Daemon thread calling `WriteBehindBackend.flush()` once writes are
+	queued, after waiting `interval` seconds for more to coalesce. Holds a
+	weak reference to the backend and exits once it is garbage collected.
+	"""
+
+	def __init__(self, backend, interval):
+		super(_Flusher, self).__init__(name='WriteBehindFlusher', daemon=True)
+		self.backend = weakref.ref(backend)
+		self.interval = interval
+		self.wakeup = Event()
+		self.stopped = Event()
+
+	def run(self):
+		delay = self.interval
+		while True:
+			self.wakeup.wait(1.0)
+			if self.stopped.wait(delay):
+				break
+			backend = self.backend()
+			if backend is None:
+				break
+			if self.wakeup.is_set():
+				self.wakeup.clear()
+				backend.flush()
+				if backend.failures:
+					self.wakeup.set()
+			delay = backend.get_delay()
+			del backend
+
+	def stop(self):
+		self.stopped.set()
+		self.wakeup.set()
+
+
+
+#: The live `WriteBehindBackend`s, closed at exit and reset after a fork.
+_backends = weakref.WeakSet()
+
+
+def _close_all():
+	for backend in list(_backends):
+		backend.close()
+
+
+def _after_fork():
+	for backend in list(_backends):
+		backend.after_fork()
+
+
+atexit.register(_close_all)
+
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=_after_fork)
+
+
+
+@export
+class AsyncWriteBehindBackend(_WriteBehind, AsyncCacheBackendABC):
+	"""`WriteBehindBackend` for async cache backends. The queue is flushed
+	by a task on the running loop. Await `close()` on shutdown to flush the
+	queued writes.
+	"""
+
+	__slots__ = ('backend', 'maxsize', 'interval', 'pending', 'inflight', 'conflicts',
+				'errors', 'failures', '_flush_lock', '_flusher', '_wakeup')
+
+	def __init__(self, backend, maxsize=1024, interval=0.05):
+		super(AsyncWriteBehindBackend, self).__init__(backend, maxsize, interval)
+		self._flush_lock = None
+		self._flusher = None
+		self._wakeup = None
+
+	async def queue(self, writes):
+		if self.is_full([k for k, _ in writes]):
+			await self.flush()
+		rv = all([self.add(key, write) for key, write in writes])
+		if self.interval:
+			self.start()
+			self._wakeup.set()
+		return rv
+
+	async def get(self, key):
+		writes = self.get_writes(key)
+		value = (await self.backend.get(key)) if self.needs_backend(writes) else None
+		return self.overlay(value, writes)
+
+	async def get_many(self, keys):
+		writes = {k: self.get_writes(k) for k in keys}
+		values = await self.backend.get_many([k for k, w in writes.items() if self.needs_backend(w)])
+		rv = {}
+		for key, w in writes.items():
+			value = self.overlay(values.get(key), w)
+			if value is not None:
+				rv[key] = value
+		return rv
+
+	async def get_fields(self, key):
+		writes = self.get_writes(key)
+		value = (await self.backend.get_fields(key)) if self.needs_backend(writes) else None
+		return self.overlay(value, writes)
+
+	async def set(self, key, value, timeout=None):
+		await self.queue([(key, _Write(_SET, value, None, timeout))])
+
+	async def set_many(self, mapping, timeout=None):
+		await self.queue([(k, _Write(_SET, v, None, timeout)) for k, v in mapping.items()])
+
+	async def set_fields(self, key, mapping, timeout=None):
+		await self.queue([(key, _Write(_FIELDS, dict(mapping), None, timeout))])
+
+	async def cas(self, key, value, version, timeout=None):
+		return await self.queue([(key, _Write(_SET, value, version, timeout))])
+
+	async def cas_fields(self, key, mapping, version, timeout=None):
+		return await self.queue([(key, _Write(_FIELDS, dict(mapping), version, timeout))])
+
+	async def expire(self, key, timeout):
+		await self.queue([(key, _Write(_EXPIRE, None, None, timeout))])
+
+	async def delete(self, key):
+		await self.queue([(key, _Write(_DELETE))])
+
+	async def delete_many(self, keys):
+		await self.queue([(k, _Write(_DELETE)) for k in keys])
+
+	async def flush(self):
+		if self._flush_lock is None:
+			self._flush_lock = asyncio.Lock()
+		async with self._flush_lock:
+			batch = self.take()
+			error = None
+			try:
+				if batch:
+					await self.write(batch)
+			except Exception as e:
+				error = e
+			self.flushed(batch, error)
+
+	async def write(self, batch):
+		sets, deletes, others = self.group(batch)
+		results = await asyncio.gather(
+			*(self.backend.set_many(mapping, timeout) for timeout, mapping in sets.items()),
+			*((self.backend.delete_many(deletes),) if deletes else ()),
+			return_exceptions=True
+		)
+		groups = list(sets.values()) + ([deletes] if deletes else [])
+		for keys, rv in zip(groups, results):
+			if not isinstance(rv, BaseException):
+				self.done(batch, keys)
+		for rv in results:
+			if isinstance(rv, BaseException):
+				raise rv
+		for key, write in others:
+			method, args = self.get_write(key, write)
+			self.applied(key, method, await getattr(self.backend, method)(*args))
+			self.done(batch, (key,), 1)
+
+	def start(self):
+		if self._flusher is None or self._flusher.done():
+			self._wakeup = asyncio.Event()
+			self._flusher = asyncio.ensure_future(self.run())
+
+	async def run(self):
+		while True:
+			await self._wakeup.wait()
+			await asyncio.sleep(self.get_delay())
+			self._wakeup.clear()
+			await self.flush()
+			if self.failures:
+				self._wakeup.set()
+
+	async def close(self):
+		"""Cancel the flusher task and flush the queued writes."""
+		if self._flusher is not None:
+			self._flusher.cancel()
+			try:
+				await self._flusher
+			except asyncio.CancelledError:
+				pass
+			self._flusher = None
+		await self.flush()
+
+	def __len__(self):
+		return len(self.pending)
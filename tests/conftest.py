@@ -8,6 +8,18 @@ def pytest_addoption(parser):
 					 default=False, help="run slow tests")
 	parser.addoption("--speed", action="store_true",
 					 default=False, help="run speed tests")
+	parser.addoption("--speed-output", action="store",
+					 default="speed-results.json", help="file to write speed test results to")
+	parser.addoption("--speed-baseline", action="store",
+					 default=None, help="speed test baseline file (default: tests/speed/baseline.json)")
+	parser.addoption("--speed-threshold", action="store", type=float,
+					 default=0.25, help="max allowed drop in ops/s relative to the baseline (0-1)")
+	parser.addoption("--speed-save-baseline", action="store_true",
+					 default=False, help="save the speed test results as the new baseline")
+
+def pytest_configure(config):
+	config.addinivalue_line("markers", "speedtest: speed test, only runs with --speed")
+	config.addinivalue_line("markers", "slow: slow test, only runs with --slow")
 
 def pytest_collection_modifyitems(config, items):
 	run_speed = config.getoption('--speed')
@@ -0,0 +1,14 @@
+
+
+
+class DictStore(dict):
+	"""A dict cache store for tests. Timeouts are ignored."""
+
+	def set(self, key, value, timeout=None):
+		self[key] = value
+
+	def delete(self, key):
+		self.pop(key, None)
+
+	def expire(self, key, timeout):
+		pass
@@ -0,0 +1,117 @@
+"""Helpers for the speed tests.
+
+Each benchmark runs a callable in batches and records the time per op of
+every batch. Results are reported as ops/s (from the total time) and p50/p99
+latencies (from the per-batch means), then compared to a committed baseline.
+
+Run with::
+
+	pytest --speed [--speed-threshold=0.25] [--speed-output=speed-results.json]
+
+The baseline is machine specific. Regenerate it on the reference machine with
+`pytest --speed --speed-save-baseline`. Changes that lower an entry should
+give the old and new figures, measured on the same machine, and their cause.
+"""
+import json
+import os
+from time import perf_counter
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+
+class BenchmarkResult(object):
+
+	__slots__ = ('name', 'ops', 'seconds', 'samples')
+
+	def __init__(self, name, ops, seconds, samples):
+		self.name = name
+		self.ops = ops
+		self.seconds = seconds
+		self.samples = sorted(samples)
+
+	@property
+	def ops_per_sec(self):
+		return self.ops / self.seconds if self.seconds else float('inf')
+
+	def percentile(self, p):
+		if not self.samples:
+			return 0.0
+		return self.samples[min(len(self.samples)-1, int(round(p / 100.0 * (len(self.samples)-1))))]
+
+	def asdict(self):
+		return dict(
+			ops=self.ops,
+			ops_per_sec=round(self.ops_per_sec, 2),
+			p50_us=round(self.percentile(50) * 1e6, 3),
+			p99_us=round(self.percentile(99) * 1e6, 3),
+		)
+
+
+
+class Benchmark(object):
+	"""Runs and collects benchmarks for a test session."""
+
+	def __init__(self, baseline=None, threshold=0.25, rounds=50, min_time=0.2):
+		self.baseline = baseline or {}
+		self.threshold = threshold
+		self.rounds = rounds
+		self.min_time = min_time
+		self.results = {}
+
+	def __call__(self, name, func, *args, inner=None):
+		"""Benchmark `func(*args)` and check it against the baseline.
+
+		Raises AssertionError if the ops/s dropped by more than the threshold
+		relative to the baseline.
+		"""
+		inner = inner or self._calibrate(func, args)
+		samples, total = [], 0.0
+		for _ in range(self.rounds):
+			st = perf_counter()
+			for _ in range(inner):
+				func(*args)
+			elapsed = perf_counter() - st
+			total += elapsed
+			samples.append(elapsed / inner)
+
+		rv = self.results[name] = BenchmarkResult(name, inner * self.rounds, total, samples)
+		self.check(rv)
+		return rv
+
+	def _calibrate(self, func, args):
+		inner, per_round = 1, self.min_time / self.rounds
+		while True:
+			st = perf_counter()
+			for _ in range(inner):
+				func(*args)
+			if perf_counter() - st >= per_round or inner >= 1 << 20:
+				return inner
+			inner *= 2
+
+	def check(self, result):
+		base = self.baseline.get(result.name)
+		if not base or not self.threshold:
+			return
+		floor = base['ops_per_sec'] * (1 - self.threshold)
+		assert result.ops_per_sec >= floor, (
+			'%s regressed: %.2f ops/s, baseline %.2f ops/s (threshold %d%%).'\
+			% (result.name, result.ops_per_sec, base['ops_per_sec'], self.threshold * 100)
+		)
+
+	def asdict(self):
+		return {k: v.asdict() for k, v in sorted(self.results.items())}
+
+	def dump(self, path):
+		with open(path, 'w') as fo:
+			json.dump(self.asdict(), fo, indent=2, sort_keys=True)
+			fo.write('\n')
+
+
+
+def load_baseline(path):
+	if path and os.path.exists(path):
+		with open(path) as fo:
+			return json.load(fo)
+	return {}
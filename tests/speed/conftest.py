@@ -0,0 +1,19 @@
+import pytest
+
+from .benchmark import Benchmark, BASELINE_FILE, load_baseline
+
+
+@pytest.fixture(scope='session')
+def benchmark(request):
+	config = request.config
+	baseline_file = config.getoption('--speed-baseline') or BASELINE_FILE
+	bench = Benchmark(
+		baseline={} if config.getoption('--speed-save-baseline') else load_baseline(baseline_file),
+		threshold=config.getoption('--speed-threshold'),
+	)
+	yield bench
+
+	if bench.results:
+		bench.dump(config.getoption('--speed-output'))
+		if config.getoption('--speed-save-baseline'):
+			bench.dump(baseline_file)
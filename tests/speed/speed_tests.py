@@ -0,0 +1,186 @@
+import datetime
+import pickle
+import pytest
+from flex.ussd import ussd_namespace
+from flex.ussd.codecs import BinarySessionCodec, PickleSessionCodec
+from flex.ussd.core import UssdApp, UssdAppRouter
+from flex.ussd.response import redirect
+from flex.ussd.screens import UssdScreen
+from flex.ussd.sessions import Session, SessionKey
+from flex.ussd.signals import Pipeline
+from flex.ussd.wrappers import UssdData, UssdRequest
+from ..fixtures import DictStore
+
+pytestmark = pytest.mark.speedtest
+parametrize = pytest.mark.parametrize
+
+ussd_namespace(__name__, 'speed')
+
+
+
+class Home(UssdScreen):
+
+	def get(self):
+		return 'Welcome\n1. Start\n2. Exit'
+
+	def put(self, arg):
+		return redirect('.step_one') if arg == '1' else 'Bye'
+
+
+class StepOne(UssdScreen):
+
+	def get(self):
+		return redirect('.step_two')
+
+
+class StepTwo(UssdScreen):
+
+	def get(self):
+		return 'Enter your name'
+
+	def put(self, arg):
+		return 'Hello %s' % (arg,)
+
+
+
+class Passthrough(object):
+
+	def __init__(self, handle_request):
+		self.handle_request = handle_request
+
+	def __call__(self, request):
+		return self.handle_request(request)
+
+
+
+def make_app(name, middleware=()):
+	return UssdApp(
+		name,
+		inital_screen='speed.home',
+		cache_store=DictStore,
+		middleware=['flex.ussd.sessions.SessionMiddleware'] + list(middleware),
+		request_handler='flex.ussd.handlers.RequestHandler',
+	)
+
+
+
+class Request(object):
+
+	def __init__(self, ussd_string):
+		self.ussd_string = UssdData(ussd_string)
+
+
+
+class UssdDataSpeedTest(object):
+
+	@parametrize('name,raw', [
+		('plain', '384*1*2*3*4*5*6*7*8*9'),
+		('quoted', '384*1*"my*input"*3*"a b"*5*6*7*8*9'),
+	])
+	def test_parse(self, benchmark, name, raw):
+		benchmark('ussd_data.parse.%s' % name, UssdData, raw)
+
+
+
+class UssdAppRouterSpeedTest(object):
+
+	@parametrize('size', [10, 100, 1000])
+	def test_resolve(self, benchmark, size):
+		router = UssdAppRouter('384')
+		for i in range(size):
+			router.route('%d*%d' % (i // 10, i % 10), i)
+		request = Request('384*%d*%d*1*2*3' % ((size - 1) // 10, (size - 1) % 10))
+		assert router.resolve(request)[0] is not None
+		benchmark('router.resolve.%d' % size, router.resolve, request)
+
+
+
+class SessionManagerSpeedTest(object):
+
+	def test_open_close(self, benchmark):
+		app = make_app('speed_sessions')
+		manager = app.session_manager
+		request = UssdRequest('254700000000', 'sid', '1*2', service_code='384')
+
+		def round_trip():
+			manager.close(manager.open(request), None)
+
+		benchmark('session_manager.open_close', round_trip)
+
+
+
+class SessionCodecSpeedTest(object):
+
+	@parametrize('name,codec', [
+		('binary', BinarySessionCodec()),
+		('pickle', PickleSessionCodec()),
+	])
+	def test_encode_decode(self, benchmark, name, codec):
+		session = Session(SessionKey('254700000000', 'ATUid_0123456789'))
+		session.created_at = session.accessed_at = datetime.datetime.now()
+		session.data.update(name='Jane', balance=1500.5, account='ACC-001')
+		session.ctx.update(menu='main', page=2)
+		session.argv = ['384', '1', '2']
+		session.screen = StepTwo()
+
+		value = codec.encode(session)
+		benchmark('session_codec.%s.encode' % name, codec.encode, session)
+		benchmark('session_codec.%s.decode' % name, codec.decode, value)
+
+
+
+class RequestHandlerSpeedTest(object):
+
+	@parametrize('name,ussd_string,middleware', [
+		('screen', '', ()),
+		('redirects', '1', ()),
+		('middleware8', '', (Passthrough,) * 7),
+	])
+	def test_dispatch(self, benchmark, name, ussd_string, middleware):
+		app = make_app('speed_handler_%s' % name, middleware)
+		handler = app.handler
+
+		def dispatch():
+			request = UssdRequest('254700000000', 'sid', ussd_string, service_code='384')
+			app.cache.delete(app.session_manager.get_backend_key(app.session_manager.get_session_key(request)))
+			return handler(request)
+
+		assert dispatch().data
+		benchmark('request_handler.dispatch.%s' % name, dispatch)
+
+
+
+class SignalSpeedTest(object):
+
+	@parametrize('receivers', [0, 1, 10])
+	def test_send(self, benchmark, receivers):
+		app = make_app('speed_signals_%d' % receivers)
+		signal = Pipeline('speed', get_sender_id=lambda app: app.name)
+		for i in range(receivers):
+			signal.connect(lambda sender, **kwargs: None, sender=app if i % 2 else None)
+
+		def send():
+			if signal.has_receivers(app):
+				signal.send(app, request=None)
+
+		benchmark('signals.send.%d' % receivers, send)
+
+
+
+class UssdPayloadSpeedTest(object):
+
+	def test_paginate(self, benchmark, tmp_path):
+		pytest.importorskip('django')
+		from django.conf import settings
+		if not settings.configured:
+			settings.configure(LOCAL_DATA_DIR=str(tmp_path), USSD={})
+		from flex.django.ussd.screens.base import UssdPayload
+
+		payload = UssdPayload()
+		for i in range(40):
+			payload.append('%d. Menu item number %d' % (i + 1, i + 1))
+
+		def paginate():
+			return list(payload.paginate(160, '00. Next', '0. Back'))
+
+		benchmark('django.payload.paginate', paginate)
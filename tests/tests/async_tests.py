@@ -0,0 +1,218 @@
+import asyncio
+import pytest
+from flex.ussd import ussd_namespace
+from flex.ussd.abc import AsyncCacheBackendABC
+from flex.ussd.cache import AsyncCacheBackend
+from flex.ussd.core import UssdApp
+from flex.ussd.handlers import AsyncRequestHandler
+from flex.ussd.instrumentation import Collector
+from flex.ussd.response import redirect
+from flex.ussd.screens import UssdScreen, StateAttribute
+from flex.ussd.sessions import AsyncSessionManager
+from flex.ussd.wrappers import UssdRequest
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+ussd_namespace(__name__, 'async_tests')
+
+
+
+class AsyncStore(DictStore):
+
+	def __init__(self):
+		self.pending = 0
+		self.max_pending = 0
+
+	async def io(self):
+		self.pending += 1
+		self.max_pending = max(self.max_pending, self.pending)
+		await asyncio.sleep(0)
+		self.pending -= 1
+
+	async def get(self, key):
+		await self.io()
+		return super(AsyncStore, self).get(key)
+
+	async def set(self, key, value, timeout=None):
+		await self.io()
+		super(AsyncStore, self).set(key, value, timeout)
+
+	async def delete(self, key):
+		await self.io()
+		super(AsyncStore, self).delete(key)
+
+	async def expire(self, key, timeout):
+		await self.io()
+
+
+
+class LocalAsyncStore(AsyncStore):
+
+	in_process = True
+
+
+
+class Start(UssdScreen):
+
+	async def get(self):
+		await asyncio.sleep(0)
+		return redirect('.menu')
+
+
+class Menu(UssdScreen):
+
+	visits = StateAttribute()
+
+	def get(self):
+		return 'Menu'
+
+	async def put(self, value):
+		await asyncio.sleep(0)
+		self.visits = getattr(self, 'visits', 0) + 1
+		return 'Got %s %d' % (value, self.visits)
+
+
+class Fail(UssdScreen):
+
+	async def get(self):
+		raise ValueError('fail')
+
+
+
+class Recover(object):
+
+	def __init__(self, handle_request):
+		self.handle_request = handle_request
+
+	async def __call__(self, request):
+		return await self.handle_request(request)
+
+	async def process_exception(self, request, exc):
+		return 'Recovered %s' % exc
+
+
+
+class Dispatches(object):
+
+	count = 0
+
+	def __init__(self, handle_request):
+		self.handle_request = handle_request
+
+	async def __call__(self, request):
+		Dispatches.count += 1
+		return await self.handle_request(request)
+
+
+
+def make_app(name, **config):
+	config.setdefault('inital_screen', 'async_tests.start')
+	config.setdefault('middleware', ['flex.ussd.sessions.AsyncSessionMiddleware'])
+	config.setdefault('cache_store', AsyncStore)
+	return UssdApp(
+		name,
+		cache_backend='flex.ussd.cache.AsyncCacheBackend',
+		session_manager='flex.ussd.sessions.AsyncSessionManager',
+		request_handler='flex.ussd.handlers.AsyncRequestHandler',
+		**config
+	)
+
+
+
+class AsyncCacheBackendTest(object):
+
+	def test_ops(self):
+		backend = AsyncCacheBackend(store=AsyncStore(), key_prefix='x')
+		assert isinstance(backend, AsyncCacheBackendABC)
+
+		async def run():
+			await backend.set_many({'a': 1, 'b': 2})
+			assert dict(backend.store) == {'x:a': 1, 'x:b': 2}
+			assert await backend.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+			assert backend.store.max_pending == 3
+			await backend.delete('a')
+			assert await backend.get('a') is None
+
+		asyncio.run(run())
+
+	def test_sync_store(self):
+		backend = AsyncCacheBackend(store=DictStore(), key_prefix='x')
+
+		async def run():
+			await backend.set('a', 1)
+			return await backend.get('a')
+
+		assert asyncio.run(run()) == 1
+
+
+
+class AsyncRequestHandlerTest(object):
+
+	def request(self, ussd_string='', phone_number='0700'):
+		return UssdRequest(phone_number, 'sid', ussd_string, service_code='384')
+
+	def test_handle(self):
+		collector = Collector()
+		app = make_app('async_handle', instrumentation_collector=collector)
+		assert isinstance(app.handler, AsyncRequestHandler)
+		assert isinstance(app.session_manager, AsyncSessionManager)
+
+		async def run():
+			assert (await app.handler(self.request())).data == 'Menu'
+			assert (await app.handler(self.request('1'))).data == 'Got 1 1'
+			assert (await app.handler(self.request('2'))).data == 'Got 2 2'
+
+		asyncio.run(run())
+		stages = {(stage, label) for (_, stage, label) in collector.histograms}
+		assert ('screen', 'async_tests.start') in stages
+		assert ('middleware', 'AsyncSessionMiddleware') in stages
+		assert ('session_close', None) in stages
+
+	def test_concurrent_sessions(self):
+		app = make_app('async_concurrent')
+
+		async def run():
+			requests = [self.request('', '07%05d' % i) for i in range(1000)]
+			return await asyncio.gather(*(app.handler(r) for r in requests))
+
+		responses = asyncio.run(run())
+		assert {r.data for r in responses} == {'Menu'}
+		assert len(app.cache.store) == 1000
+		assert app.cache.store.max_pending > 1
+
+	def test_exception_middleware(self):
+		app = make_app(
+			'async_exceptions', inital_screen='async_tests.fail',
+			middleware=['flex.ussd.sessions.AsyncSessionMiddleware', Recover]
+		)
+		assert asyncio.run(app.handler(self.request())) == 'Recovered fail'
+
+	def test_idempotency(self):
+		collector = Collector()
+		app = make_app('async_idempotent', session_idempotency=True, instrumentation_collector=collector)
+
+		async def run():
+			assert (await app.handler(self.request())).data == 'Menu'
+			assert (await app.handler(self.request('1'))).data == 'Got 1 1'
+			assert (await app.handler(self.request('1'))).data == 'Got 1 1'
+
+		asyncio.run(run())
+		assert collector.hit_rate('async_idempotent') == pytest.approx(1 / 3)
+
+	def test_concurrent_turns(self):
+		app = make_app(
+			'async_concurrent_turns', cache_store=LocalAsyncStore, session_versioning=True,
+			session_lease_timeout=10, session_lease_interval=0.001,
+			middleware=[Dispatches, 'flex.ussd.sessions.AsyncSessionMiddleware']
+		)
+
+		async def run():
+			await app.handler(self.request())
+			Dispatches.count = 0
+			return await asyncio.gather(app.handler(self.request('1')), app.handler(self.request('1')))
+
+		assert [r.data for r in asyncio.run(run())] == ['Got 1 1', 'Got 1 1']
+		assert Dispatches.count == 1
+		assert asyncio.run(app.handler(self.request('2'))).data == 'Got 2 2'
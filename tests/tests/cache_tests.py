@@ -0,0 +1,208 @@
+import pytest
+from flex.ussd.core import UssdApp
+from flex.ussd.cache import CacheBackend, LRUCache, NearCacheBackend
+from flex.ussd.stores import MemoryStore
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class Clock(object):
+
+	def __init__(self):
+		self.now = 0.0
+
+	def __call__(self):
+		return self.now
+
+
+
+class CountingStore(DictStore):
+
+	def __init__(self):
+		self.reads = 0
+
+	def get(self, key):
+		self.reads += 1
+		return super(CountingStore, self).get(key)
+
+
+
+class HashStore(CountingStore):
+
+	def get_fields(self, key):
+		self.reads += 1
+		return dict(dict.get(self, key) or {})
+
+	def set_fields(self, key, mapping, timeout=None):
+		self.setdefault(key, {}).update(mapping)
+
+
+
+class LRUCacheTest(object):
+
+	def test_evicts_least_recently_used(self):
+		cache = LRUCache(2)
+		cache.set('a', 1)
+		cache.set('b', 2)
+		assert cache.get('a') == 1
+		cache.set('c', 3)
+		assert 'b' not in cache
+		assert cache.get('a') == 1 and cache.get('c') == 3
+		assert len(cache) == 2
+
+	def test_ttl(self):
+		clock = Clock()
+		cache = LRUCache(clock=clock)
+		cache.set('a', 1, 10)
+		cache.set('b', 2)
+		clock.now = 9
+		assert cache.get('a') == 1
+		cache.expire('a', 5)
+		clock.now = 13.5
+		assert cache.get('a') == 1
+		clock.now = 14
+		assert cache.get('a') is None
+		assert cache.get('b') == 2
+
+
+
+class NearCacheBackendTest(object):
+
+	def make_backend(self, store=None, **kwargs):
+		return NearCacheBackend(store=CountingStore() if store is None else store, key_prefix='x', **kwargs)
+
+	def test_write_through(self):
+		backend = self.make_backend(mode=NearCacheBackend.WRITE_THROUGH)
+		backend.store['x:a'] = 1
+		assert backend.get('a') == 1
+		assert backend.get('a') == 1
+		assert backend.store.reads == 1
+
+		backend.set('b', 2)
+		assert backend.store['x:b'] == 2
+		assert backend.get('b') == 2
+		assert backend.store.reads == 1
+
+		backend.delete('b')
+		assert 'x:b' not in backend.store
+		assert backend.get('b') is None
+
+	def test_read_your_writes(self):
+		backend = self.make_backend()
+		assert backend.mode == NearCacheBackend.READ_YOUR_WRITES
+		backend.store['x:a'] = 1
+		assert backend.get('a') == 1
+		assert backend.get('a') == 1
+		assert backend.store.reads == 2
+
+		backend.set('a', 2)
+		assert backend.get('a') == 2
+		assert backend.store.reads == 2
+
+	def test_local_timeout(self):
+		backend = self.make_backend(near_timeout=5)
+		backend.local.clock = clock = Clock()
+		backend.set('a', 1, 60)
+		backend.store['x:a'] = 2
+		clock.now = 4
+		assert backend.get('a') == 1
+		clock.now = 5
+		assert backend.get('a') == 2
+
+	def test_invalidation_hooks(self):
+		published = []
+		backend = self.make_backend(invalidation_hooks=[published.append])
+		other = self.make_backend(store=backend.store)
+		backend.add_invalidation_hook(other.invalidate)
+
+		other.set('a', 1)
+		backend.set('a', 2)
+		backend.delete('b')
+		assert published == ['a', 'b']
+		assert other.get('a') == 2
+
+	def test_versioned_keys_are_read_from_the_store(self):
+		backend = self.make_backend(MemoryStore(sweep_interval=None), mode=NearCacheBackend.WRITE_THROUGH)
+		other = CacheBackend(store=backend.store, key_prefix='x')
+		assert backend.cas('a', 1, 0)
+		assert backend.get('a') == 1
+		assert other.cas('a', 2, 1)
+		assert backend.get('a') == 2
+		assert backend.get_many(['a']) == {'a': 2}
+		assert backend.cas('a', 3, 2)
+		assert len(backend.local) == 0
+
+	def test_fields(self):
+		backend = self.make_backend(HashStore(), mode=NearCacheBackend.WRITE_THROUGH)
+		assert backend.supports_fields
+		backend.set_fields('a', {'f': 1, 'g': 2})
+		assert backend.get_fields('a') == {'f': 1, 'g': 2}
+		backend.set_fields('a', {'g': 3})
+		assert backend.get_fields('a') == {'f': 1, 'g': 3}
+		assert backend.store.reads == 1
+
+	def test_app_config(self):
+		app = UssdApp('near_cache_tests', cache_backend=NearCacheBackend, cache_store=CountingStore,
+			cache_near_maxsize=10, cache_near_mode='read_your_writes')
+		assert isinstance(app.cache, NearCacheBackend)
+		assert app.cache.local.maxsize == 10
+		assert app.cache.mode == NearCacheBackend.READ_YOUR_WRITES
+		assert app.cache.key_prefix == 'near_cache_tests'
+
+	def test_invalid_mode(self):
+		with pytest.raises(ValueError):
+			UssdApp('near_cache_tests', cache_backend=NearCacheBackend,
+				cache_store=CountingStore, cache_near_mode='write_back').cache
+
+
+
+class CacheBackendBatchTest(object):
+
+	@parametrize('native', [True, False])
+	def test_batch_ops(self, native):
+		calls = []
+
+		class Store(CountingStore):
+			if native:
+				def get_many(self, keys):
+					calls.append(('get_many', sorted(keys)))
+					return {k: dict.get(self, k) for k in keys}
+
+				def set_many(self, mapping, timeout=None):
+					calls.append(('set_many', sorted(mapping)))
+					self.update(mapping)
+
+				def delete_many(self, keys):
+					calls.append(('delete_many', sorted(keys)))
+					for k in keys:
+						self.pop(k, None)
+
+		backend = CacheBackend(store=Store(), key_prefix='x')
+		backend.set_many({'a': 1, 'b': 2})
+		assert dict(backend.store) == {'x:a': 1, 'x:b': 2}
+		assert backend.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+		backend.delete_many(['a', 'c'])
+		assert dict(backend.store) == {'x:b': 2}
+
+		if native:
+			assert calls == [
+				('set_many', ['x:a', 'x:b']),
+				('get_many', ['x:a', 'x:b', 'x:c']),
+				('delete_many', ['x:a', 'x:c']),
+			]
+		else:
+			assert backend.store.reads == 3
+
+	def test_near_cache(self):
+		backend = NearCacheBackend(store=CountingStore(), key_prefix='x', mode=NearCacheBackend.WRITE_THROUGH)
+		backend.store['x:a'] = 1
+		backend.set_many({'b': 2})
+		assert backend.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+		assert backend.store.reads == 2
+		assert backend.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+		assert backend.store.reads == 2
+		backend.delete_many(['a'])
+		assert backend.get_many(['a']) == {}
@@ -0,0 +1,127 @@
+import datetime
+import pickle
+import pytest
+from flex.ussd import ussd_namespace
+from flex.ussd.codecs import BinarySessionCodec, PickleSessionCodec
+from flex.ussd.screens import UssdScreen, StateAttribute
+from flex.ussd.sessions import Session, SessionKey
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+ussd_namespace(__name__, 'codecs_tests')
+
+
+
+class Pay(UssdScreen):
+
+	amount = StateAttribute()
+
+
+
+class Opaque(object):
+
+	def __init__(self, value):
+		self.value = value
+
+	def __eq__(self, other):
+		return isinstance(other, Opaque) and other.value == self.value
+
+
+
+def make_session():
+	session = Session(SessionKey('254700000000', 'ATUid_0123456789'))
+	session.created_at = datetime.datetime(2018, 5, 1, 10, 30, 15, 123456)
+	session.accessed_at = datetime.datetime(2018, 5, 1, 10, 31, 2, 654321)
+	session.data.update(name='Jane', balance=1500.5, account='ACC-001', items=[1, 2, 3])
+	session.ctx.update(menu='main', page=2)
+	session.argv = ['384', '1', '2']
+	session.ussd_string = '384*1*2'
+	session.version = 3
+	session.last_response = ('Pay', 0)
+	session._history_stack = ['/a', '/a/b']
+	session.screen = Pay()
+	session.screen.amount = 300
+	return session
+
+
+
+class BinarySessionCodecTest(object):
+
+	def assert_equal(self, session, rv):
+		assert rv.key.phone_number == session.key.phone_number
+		assert rv.key.session_id == session.key.session_id
+		for k in ('created_at', 'accessed_at', 'version', 'argv', 'ussd_string', 'last_response', '_history_stack', 'restored'):
+			assert getattr(rv, k) == getattr(session, k)
+		assert dict(rv.data) == dict(session.data)
+		assert dict(rv.ctx) == dict(session.ctx)
+		assert type(rv.screen) is Pay
+		assert rv.screen.amount == 300
+
+	def test_round_trip(self):
+		codec = BinarySessionCodec()
+		session = make_session()
+		value = codec.encode(session)
+		assert value.startswith(codec.header)
+		self.assert_equal(session, codec.decode(value))
+
+	def test_pickles_unencodable_values(self):
+		codec = BinarySessionCodec()
+		session = make_session()
+		session.data.opaque = Opaque(1)
+		session.accessed_at = datetime.datetime.now(datetime.timezone.utc)
+		session.extra = Opaque(2)
+
+		rv = codec.decode(codec.encode(session))
+		self.assert_equal(session, rv)
+		assert rv.extra == Opaque(2)
+
+	def test_smaller_than_pickle(self):
+		session = make_session()
+		assert len(BinarySessionCodec().encode(session)) < len(PickleSessionCodec().encode(session))
+
+	def test_decodes_pickled_sessions(self):
+		session = make_session()
+		self.assert_equal(session, BinarySessionCodec().decode(pickle.dumps(session, 2)))
+
+	def test_unknown_encoding(self):
+		with pytest.raises(ValueError):
+			BinarySessionCodec().decode(b'garbage')
+
+	def test_changed_fields(self):
+		codec = BinarySessionCodec()
+		session = make_session()
+		assert codec.changed_fields(session, codec.encode_fields(session)) is None
+
+		session = codec.decode_fields(codec.encode_fields(session))
+		assert codec.changed_fields(session, codec.encode_fields(session)) == []
+
+		session.data.opaque = Opaque(1)
+		session.screen.amount = 400
+		session.accessed_at = datetime.datetime.now()
+		changed = codec.changed_fields(session, codec.encode_fields(session))
+		assert sorted(changed) == ['data', 'screen', 'time']
+
+	def test_encode_changes(self):
+		codec = BinarySessionCodec()
+		session = make_session()
+		assert codec.encode_changes(session)[1] is None
+
+		session = codec.decode(codec.encode(session))
+		session.accessed_at = datetime.datetime.now()
+		value, changed = codec.encode_changes(session)
+		assert changed is False
+		assert codec.decode(value).accessed_at == session.accessed_at
+
+		session.ussd_string = '384*1*2*3'
+		session.last_response = ('Paid', 1)
+		value, changed = codec.encode_changes(session)
+		assert changed is True
+		assert codec.decode(value).last_response == ('Paid', 1)
+		assert codec.encode_changes(session)[1] is False
+
+	def test_unsupported_version(self):
+		codec = BinarySessionCodec()
+		value = codec.encode(make_session())
+		with pytest.raises(ValueError):
+			codec.decode(codec.MAGIC + bytes((codec.VERSION + 1,)) + value[len(codec.header):])
@@ -0,0 +1,180 @@
+import pytest
+from flex.ussd import ussd_namespace
+from flex.ussd.core import UssdApp
+from flex.ussd.exc import RedirectError
+from flex.ussd.handlers import RequestHandler
+from flex.ussd.response import redirect
+from flex.ussd.screens import UssdScreen
+from flex.ussd.wrappers import UssdRequest
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+ussd_namespace(__name__, 'handlers_tests')
+
+
+
+class Menu(UssdScreen):
+
+	def get(self):
+		return 'Menu'
+
+
+class Fail(UssdScreen):
+
+	def get(self):
+		raise ValueError('fail')
+
+
+
+class Hop(UssdScreen):
+
+	def __init__(self, n=0):
+		self.n = n
+
+	def get(self):
+		return redirect('.hop', ('go',), n=self.n+1)
+
+	def put(self, arg):
+		return 'Hops %d' % self.n if self.n >= 5 else redirect('.hop', n=self.n+1)
+
+
+class Loop(UssdScreen):
+
+	def get(self):
+		return redirect('.loop')
+
+
+
+class Passthrough(object):
+
+	def __init__(self, handle_request):
+		self.handle_request = handle_request
+
+	def __call__(self, request):
+		return self.handle_request(request)
+
+
+class Inactive(Passthrough):
+
+	@staticmethod
+	def is_active(app):
+		return False
+
+	def __call__(self, request):
+		raise AssertionError('inactive middleware called')
+
+
+class Recover(Passthrough):
+
+	calls = 0
+
+	def process_exception(self, request, exc):
+		Recover.calls += 1
+		return 'Recovered %s' % exc
+
+
+class Decline(Passthrough):
+
+	calls = 0
+
+	def process_exception(self, request, exc):
+		Decline.calls += 1
+
+
+class Broken(Passthrough):
+
+	def __call__(self, request):
+		raise KeyError('broken')
+
+
+class Converting(RequestHandler):
+
+	def get_exception_response(self, request, exc):
+		return 'Converted %r' % (exc,)
+
+
+
+def make_app(name, screen='menu', **config):
+	config.setdefault('request_handler', 'flex.ussd.handlers.RequestHandler')
+	return UssdApp(name, inital_screen='handlers_tests.%s' % screen, cache_store=DictStore, **config)
+
+
+def request(ussd_string=''):
+	return UssdRequest('0700', 'sid', ussd_string, service_code='384')
+
+
+
+class RequestHandlerChainTest(object):
+
+	def setup_method(self, method):
+		Recover.calls = Decline.calls = 0
+
+	def test_no_exception_boundaries(self):
+		app = make_app('chain_plain', middleware=['flex.ussd.sessions.SessionMiddleware', Passthrough, Inactive])
+		assert isinstance(app.handler.handle, Passthrough)
+		assert app.handler(request()).data == 'Menu'
+
+	def test_recovered_response_passes_outer_middleware(self):
+		app = make_app('chain_recover', 'fail', middleware=[Passthrough, 'flex.ussd.sessions.SessionMiddleware', Decline, Recover])
+		assert app.handler(request()) == 'Recovered fail'
+		assert Decline.calls == 1 and Recover.calls == 1
+		assert len(app.cache.store) == 1
+
+	def test_exceptions_offered_once(self):
+		app = make_app('chain_decline', 'fail', middleware=['flex.ussd.sessions.SessionMiddleware', Decline, Passthrough, Decline])
+		with pytest.raises(ValueError) as exc:
+			app.handler(request())
+		assert Decline.calls == 2
+		assert not vars(exc.value)
+
+	def test_reraised_exceptions_offered_again(self):
+		error = ValueError('shared')
+
+		class Raise(Passthrough):
+			def __call__(self, request):
+				raise error
+
+		app = make_app('chain_reraise', middleware=[Raise, Decline, Passthrough, Decline])
+		for _ in range(2):
+			with pytest.raises(ValueError):
+				app.handler(request())
+		assert Decline.calls == 4
+
+	def test_middleware_exceptions_go_to_outer_middleware(self):
+		app = make_app('chain_broken', middleware=[Recover, Broken, Decline])
+		with pytest.raises(KeyError):
+			app.handler(request())
+		assert Recover.calls == 0 and Decline.calls == 1
+
+	def test_converted_exceptions(self):
+		app = make_app(
+			'chain_converted', 'fail', middleware=['flex.ussd.sessions.SessionMiddleware', Broken],
+			request_handler=Converting
+		)
+		assert app.handler(request()) == "Converted KeyError('broken')"
+
+
+
+class RequestHandlerRedirectTest(object):
+
+	middleware = ['flex.ussd.sessions.SessionMiddleware']
+
+	def test_follows_redirects(self):
+		app = make_app('redirect_chain', 'hop', middleware=self.middleware)
+		assert app.handler(request()).data == 'Hops 5'
+		assert Hop.__meta__.redirect_targets == {'.hop': Hop}
+
+	def test_redirect_cycle(self):
+		app = make_app('redirect_cycle', 'loop', middleware=self.middleware)
+		with pytest.raises(RedirectError):
+			app.handler(request())
+
+	def test_max_redirects(self):
+		app = make_app('redirect_max', 'hop', max_redirects=4, middleware=self.middleware)
+		with pytest.raises(RedirectError):
+			app.handler(request())
+		app = make_app('redirect_max_loop', 'loop', max_redirects=4, redirect_cycle_detection=False, middleware=self.middleware)
+		with pytest.raises(RedirectError):
+			app.handler(request())
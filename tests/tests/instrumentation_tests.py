@@ -0,0 +1,135 @@
+import pytest
+from flex.ussd import ussd_namespace
+from flex.ussd.core import UssdApp
+from flex.ussd.instrumentation import Collector, Histogram, LogExporter
+from flex.ussd.response import redirect
+from flex.ussd.screens import UssdScreen
+from flex.ussd.wrappers import UssdRequest
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+ussd_namespace(__name__, 'instrumentation_tests')
+
+
+
+class Start(UssdScreen):
+
+	def get(self):
+		return redirect('.menu')
+
+
+class Menu(UssdScreen):
+
+	def get(self):
+		return 'Menu'
+
+
+
+class HistogramTest(object):
+
+	def test_observe(self):
+		hist = Histogram((0.1, 1.0))
+		for v in (0.05, 0.1, 0.5, 2.0):
+			hist.observe(v)
+		assert hist.counts == [2, 1, 1]
+		assert hist.count == 4
+		assert hist.sum == pytest.approx(2.65)
+		assert hist.quantile(.5) == 0.1
+		assert hist.quantile(1) == float('inf')
+
+
+
+class RequestHandlerInstrumentationTest(object):
+
+	def make_app(self, name, **config):
+		return UssdApp(
+			name,
+			inital_screen='instrumentation_tests.start',
+			cache_store=DictStore,
+			middleware=['flex.ussd.sessions.SessionMiddleware'],
+			request_handler='flex.ussd.handlers.RequestHandler',
+			**config
+		)
+
+	def test_stages(self):
+		collector = Collector()
+		app = self.make_app('instrumented', instrumentation_collector=collector)
+		assert app.handler(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Menu'
+
+		assert set(k[0] for k in collector.histograms) == {'instrumented'}
+		stages = {(stage, label): h.count for (_, stage, label), h in collector.histograms.items()}
+		assert stages == {
+			('session_open', None): 1,
+			('parse', None): 1,
+			('middleware', 'SessionMiddleware'): 1,
+			('screen', 'instrumentation_tests.start'): 1,
+			('screen', 'instrumentation_tests.menu'): 1,
+			('redirect', 'instrumentation_tests.menu'): 1,
+			('session_close', None): 1,
+		}
+
+	def test_no_collector(self):
+		app = self.make_app('not_instrumented')
+		assert app.handler.collector is None
+		assert app.handler(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Menu'
+
+	def test_session_without_handler(self):
+		app = UssdApp('no_handler', cache_store=DictStore())
+		session = app.session_manager.open(UssdRequest('0700', 'sid', '1', service_code='384'))
+		assert session is not None and 'handler' not in vars(app)
+
+	def test_export(self, caplog):
+		collector = Collector(exporters=[LogExporter()])
+		collector.observe('app', 'screen', 0.002, 'home')
+		with caplog.at_level('INFO', logger='ussd'):
+			collector.export()
+		assert 'app screen[home]: count=1' in caplog.text
+
+
+
+class Counter(UssdScreen):
+
+	def get(self):
+		self.session.data.hits = self.session.data.get('hits', 0) + 1
+		return 'Count %d' % self.session.data.hits
+
+	def put(self, value):
+		return self.get()
+
+
+
+class IdempotencyTest(object):
+
+	def make_app(self, name, **config):
+		return UssdApp(
+			name,
+			inital_screen='instrumentation_tests.counter',
+			cache_store=DictStore,
+			middleware=['flex.ussd.sessions.SessionMiddleware'],
+			request_handler='flex.ussd.handlers.RequestHandler',
+			**config
+		)
+
+	def test_retransmits(self):
+		collector = Collector()
+		app = self.make_app('idempotent', session_idempotency=True, instrumentation_collector=collector)
+		handle = app.handler
+
+		assert handle(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Count 1'
+		assert handle(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Count 1'
+		assert handle(UssdRequest('0700', 'sid', '1', service_code='384')).data == 'Count 2'
+		assert handle(UssdRequest('0700', 'sid', '1', service_code='384')).data == 'Count 2'
+		assert handle(UssdRequest('0700', 'sid2', '1', service_code='384')).data == 'Count 3'
+
+		assert collector.hit_rate('idempotent') == pytest.approx(2 / 5)
+		assert ('idempotent', 'middleware', 'SessionMiddleware') in collector.histograms
+		assert collector.histograms['idempotent', 'middleware', 'SessionMiddleware'].count == 3
+
+	def test_disabled(self):
+		collector = Collector()
+		app = self.make_app('not_idempotent', instrumentation_collector=collector)
+		assert app.handler(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Count 1'
+		assert app.handler(UssdRequest('0700', 'sid', '', service_code='384')).data == 'Count 2'
+		assert collector.hit_rate('not_idempotent') is None
@@ -0,0 +1,383 @@
+import threading
+import pytest
+from flex.ussd.cache import CacheBackend
+from flex.ussd.sessions import Session, SessionKey, SessionManager, SessionMiddleware
+from flex.ussd.response import UssdResponse, UssdStatus
+from flex.ussd.wrappers import UssdRequest
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+class UssdRequestTest(object):
+
+	def test_data(self):
+		request = UssdRequest('0700', 'sid', '1*2', service_code='384', initial_code='5')
+		assert request.raw_ussd_string == '384*5*1*2'
+		assert request.service_code.equals('384')
+		assert request.data['initial_code'].equals('5')
+		assert request.data.head.equals('1*2')
+		assert request.inputs.equals('1*2')
+		assert request.data.resumed_at is None
+
+	@parametrize('previous,current,resumed_at,inputs', [
+		('1*2', '1*2*3*"a*b"', 4, ['3', 'a*b']),
+		('1*2', '1*2', 4, []),
+		('1*2', '1*3', None, ['1', '3']),
+	])
+	def test_resume(self, previous, current, resumed_at, inputs):
+		prev = UssdRequest('0700', 'sid', previous, service_code='384', initial_code='5')
+		request = UssdRequest('0700', 'sid', current, service_code='384', initial_code='5')
+		request.resume(prev.raw_ussd_string, prev.data.tokens)
+
+		assert request.data.resumed_at == resumed_at
+		assert list(request.inputs) == inputs
+		assert request.data.tokens == UssdRequest('0700', 'sid', current, '384', '5').data.tokens
+		assert request.service_code.equals('384')
+
+
+
+class SessionManagerIncrementalTest(object):
+
+	def test_open(self):
+		manager = SessionManager(backend=DictStore())
+
+		request = UssdRequest('0700', 'sid', '1', service_code='384')
+		session = manager.open(request)
+		assert request.data.resumed_at is None
+		manager.close(session, None)
+
+		request = UssdRequest('0700', 'sid', '1*2*3', service_code='384')
+		session = manager.open(request)
+		assert request.data.resumed_at == 2
+		assert list(request.inputs) == ['2', '3']
+		assert session.ussd_string == '384*1*2*3'
+		assert session.argv == ['384', '1', '2', '3']
+
+	def test_resumes_after_matching(self):
+		manager = SessionManager(backend=DictStore())
+		manager.close(manager.open(UssdRequest('0700', 'sid', '1', service_code='384')), None)
+
+		request = UssdRequest('0700', 'sid', '1*2', service_code='384')
+		assert request.ussd_code.startswith('384*1') and not request.parsed
+		manager.open(request)
+		assert request.data.resumed_at == 2
+
+	def test_new_session_id_is_not_resumed(self):
+		manager = SessionManager(backend=DictStore())
+		manager.close(manager.open(UssdRequest('0700', 'sid', '1', service_code='384')), None)
+
+		request = UssdRequest('0700', 'sid2', '1*2', service_code='384')
+		manager.open(request)
+		assert request.data.resumed_at is None
+		assert list(request.inputs) == ['1', '2']
+
+
+
+class HashBackend(DictStore):
+
+	supports_fields = True
+
+	def __init__(self):
+		self.calls = []
+
+	def get_fields(self, key):
+		return self.get(key)
+
+	def set_fields(self, key, mapping, timeout=None):
+		self.calls.append(('set_fields', sorted(mapping)))
+		self.setdefault(key, {}).update(mapping)
+
+	def set(self, key, value, timeout=None):
+		self.calls.append(('set', None))
+		self[key] = value
+
+	def expire(self, key, timeout):
+		self.calls.append(('expire', None))
+
+
+
+class SessionManagerDirtyTrackingTest(object):
+
+	def roundtrip(self, manager, ussd_string, **data):
+		session = manager.open(UssdRequest('0700', 'sid', ussd_string, service_code='384'))
+		session.data.update(data)
+		manager.close(session, None)
+		return session
+
+	def test_retransmit_only_expires(self):
+		backend = HashBackend()
+		backend.supports_fields = False
+		manager = SessionManager(backend=backend)
+
+		self.roundtrip(manager, '1', step=1)
+		self.roundtrip(manager, '1*2')
+		self.roundtrip(manager, '1*2')
+		assert [c for c, _ in backend.calls] == ['set', 'set', 'expire']
+
+		self.roundtrip(manager, '1*2*3', step=2)
+		assert [c for c, _ in backend.calls] == ['set', 'set', 'expire', 'set']
+		assert manager.open(UssdRequest('0700', 'sid', '1', service_code='384')).data == {'step': 2}
+
+	def test_writes_changed_fields(self):
+		backend = HashBackend()
+		manager = SessionManager(backend=backend)
+
+		self.roundtrip(manager, '1', step=1)
+		assert backend.calls[0][1] == ['ctx', 'data', 'history', 'input', 'key', 'meta', 'screen', 'time']
+
+		self.roundtrip(manager, '1*2')
+		self.roundtrip(manager, '1*2')
+		self.roundtrip(manager, '1*2*3', step=2)
+		assert backend.calls[1:] == [
+			('set_fields', ['input']), ('expire', None), ('set_fields', ['data', 'input'])
+		]
+
+		session = manager.open(UssdRequest('0700', 'sid', '1*2*3', service_code='384'))
+		assert session.data == {'step': 2}
+		assert session.ussd_string == '384*1*2*3'
+
+	def test_disabled(self):
+		backend = HashBackend()
+		manager = SessionManager(backend=backend, dirty_tracking=False)
+		self.roundtrip(manager, '1')
+		self.roundtrip(manager, '1*2')
+		assert [c for c, _ in backend.calls] == ['set', 'set']
+
+
+
+class BatchBackend(DictStore):
+
+	def __init__(self):
+		self.calls = []
+
+	def get_many(self, keys):
+		self.calls.append('get_many')
+		return {k: self[k] for k in keys if k in self}
+
+	def set_many(self, mapping, timeout=None):
+		self.calls.append('set_many')
+		self.update(mapping)
+
+	def delete_many(self, keys):
+		self.calls.append('delete_many')
+		for k in keys:
+			self.pop(k, None)
+
+	def get(self, key):
+		self.calls.append('get')
+		return super(BatchBackend, self).get(key)
+
+
+
+class SessionManagerAuxiliaryKeysTest(object):
+
+	def open(self, manager, ussd_string='1'):
+		return manager.open(UssdRequest('0700', 'sid', ussd_string, service_code='384'))
+
+	def test_loads_in_one_round_trip(self):
+		backend = BatchBackend()
+		manager = SessionManager(backend=backend, auxiliary_keys=('history', 'menu'))
+
+		session = self.open(manager)
+		assert session.aux == {}
+		session.aux['history'] = ['a']
+		session.aux['menu'] = 'main'
+		manager.close(session, None)
+		assert backend['ussd_session:0700:history'] == ['a']
+
+		del backend.calls[:]
+		session = self.open(manager, '1*2')
+		assert backend.calls == ['get_many']
+		assert session.aux == {'history': ['a'], 'menu': 'main'}
+		assert session.data == {}
+
+		del session.aux['menu']
+		manager.close(session, None)
+		assert 'ussd_session:0700:menu' not in backend
+		assert backend.calls[-2:] == ['set_many', 'delete_many']
+
+	def test_no_auxiliary_keys(self):
+		backend = BatchBackend()
+		manager = SessionManager(backend=backend)
+		manager.close(self.open(manager), None)
+		self.open(manager)
+		assert backend.calls == ['get', 'get']
+
+
+
+class CasBackend(DictStore):
+
+	supports_cas = True
+
+	def __init__(self):
+		self.versions = {}
+
+	def cas(self, key, value, version, timeout=None):
+		if self.versions.get(key, 0) != version:
+			return False
+		self.versions[key] = version + 1
+		self[key] = value
+		return True
+
+	def delete(self, key):
+		self.versions.pop(key, None)
+		super(CasBackend, self).delete(key)
+
+
+
+class LocalStore(DictStore):
+
+	in_process = True
+
+
+
+class SessionManagerVersioningTest(object):
+
+	def open(self, manager, ussd_string='1'):
+		return manager.open(UssdRequest('0700', 'sid', ussd_string, service_code='384'))
+
+	def race(self, manager):
+		session = self.open(manager)
+		session.data.step = 0
+		manager.close(session, UssdResponse('Start'))
+
+		first, second = self.open(manager, '1*2'), self.open(manager, '1*2')
+		first.data.step, second.data.step = 1, 2
+		assert manager.close(first, UssdResponse('First')) is None
+		return manager.close(second, UssdResponse('Second', UssdStatus.END))
+
+	@parametrize('backend', [CasBackend, LocalStore])
+	def test_loser_gets_winners_response(self, backend):
+		manager = SessionManager(backend=backend(), versioning=True)
+		rv = self.race(manager)
+		assert rv.data == 'First' and rv.status == UssdStatus.CON
+
+		session = self.open(manager, '1*2*3')
+		assert session.data.step == 1
+		assert session.version == 2
+
+	def test_disabled(self):
+		manager = SessionManager(backend=DictStore(), versioning=False)
+		assert not manager.leases
+		assert self.race(manager) is None
+		assert self.open(manager, '1*2*3').data.step == 2
+
+	def test_off_by_default(self):
+		manager = SessionManager(backend=LocalStore())
+		assert not manager.versioning and not manager.leases
+
+	def test_shared_store_without_cas(self):
+		backend = CacheBackend(store=DictStore(), key_prefix='')
+		first = SessionManager(backend=backend, versioning=True, lease_timeout=10)
+		second = SessionManager(backend=backend, versioning=True, lease_timeout=10)
+		for step, manager in enumerate((first, second, first)):
+			session = self.open(manager, '1*2' if step else '1')
+			session.data.step = step
+			assert manager.close(session, UssdResponse('resp %d' % step)) is None
+		assert self.open(second, '1*2*3').data.step == 2
+
+	def test_unchanged_sessions_keep_their_version(self):
+		manager = SessionManager(backend=CasBackend(), versioning=True)
+		manager.close(self.open(manager), UssdResponse('Start'))
+		manager.close(self.open(manager, '1*2'), UssdResponse('Next'))
+		assert self.open(manager, '1*2').version == 2
+		manager.close(self.open(manager, '1*2'), UssdResponse('Next'))
+		assert self.open(manager, '1*2').version == 2
+		manager.close(self.open(manager, '1*2*3'), UssdResponse('Next'))
+		session = self.open(manager, '1*2*3')
+		assert session.version == 3 and session.last_response == ('Next', 0)
+
+	@parametrize('backend', [CasBackend, LocalStore])
+	def test_saves_sessions_removed_from_the_store(self, backend):
+		manager = SessionManager(backend=backend(), versioning=True)
+		for ussd_string in ('1', '1*2'):
+			session = self.open(manager, ussd_string)
+			session.data.step = ussd_string
+			manager.close(session, UssdResponse('Next'))
+		manager.backend.delete('ussd_session:0700')
+
+		session = self.open(manager, '1')
+		session.data.step = 'again'
+		assert manager.close(session, UssdResponse('Again')) is None
+		assert self.open(manager, '1*2').data.step == 'again'
+
+	@parametrize('backend', [CasBackend, LocalStore])
+	def test_loser_waits_for_lease(self, backend):
+		manager = SessionManager(
+			backend=backend(), versioning=True, lease_timeout=10, lease_wait=5, lease_interval=0.001
+		)
+		session = self.open(manager)
+		session.data.step = 0
+		manager.close(session, UssdResponse('Start'))
+
+		first = self.open(manager, '1*2')
+		assert first._lease == 'ussd_session:0700:lease'
+		rv = []
+		thread = threading.Thread(target=lambda: rv.append(self.open(manager, '1*2')))
+		thread.start()
+		first.data.step = 1
+		assert manager.close(first, UssdResponse('First')) is None
+		thread.join()
+
+		second, = rv
+		winner = manager.pop_winning_response(second)
+		assert winner.data == 'First' and winner.status == UssdStatus.CON
+		assert manager.pop_winning_response(second) is None
+		assert not hasattr(second, '_lease')
+		assert self.open(manager, '1*2*3')._lease
+
+	def test_lease_wait_timeout(self):
+		manager = SessionManager(
+			backend=CasBackend(), versioning=True, lease_timeout=10, lease_wait=0, lease_interval=0.001
+		)
+		first, second = self.open(manager), self.open(manager)
+		assert first._lease and not hasattr(second, '_lease')
+		assert manager.pop_winning_response(second) is None
+		manager.close(first, UssdResponse('First'))
+		assert not manager.is_leased('ussd_session:0700:lease')
+
+
+
+class SessionMiddlewareTest(object):
+
+	def test_handler_without_timer(self):
+		class App(object):
+			handler = object()
+			session_manager = SessionManager(backend=DictStore())
+
+		request = UssdRequest('0700', 'sid', '1', service_code='384')
+		request.app = App()
+		response = SessionMiddleware(lambda request: UssdResponse('Hi'))(request)
+		assert response.data == 'Hi' and request.session is not None
+
+	def test_releases_lease_on_error(self):
+		class App(object):
+			handler = object()
+			session_manager = SessionManager(backend=LocalStore(), versioning=True, lease_timeout=10)
+
+		def handle(request):
+			raise ValueError()
+
+		request = UssdRequest('0700', 'sid', '1', service_code='384')
+		request.app = App()
+		with pytest.raises(ValueError):
+			SessionMiddleware(handle)(request)
+		assert not App.session_manager.is_leased('ussd_session:0700:lease')
+
+	def test_loser_returns_winners_response(self):
+		class App(object):
+			handler = object()
+			session_manager = SessionManager(backend=LocalStore(), versioning=True, lease_timeout=10, lease_wait=0)
+
+		def handle(request):
+			raise AssertionError('dispatched')
+
+		manager = App.session_manager
+		manager.open(UssdRequest('0700', 'sid', '1', service_code='384'))
+		manager.wait_for_winner = lambda session: UssdResponse('First')
+		request = UssdRequest('0700', 'sid', '1', service_code='384')
+		request.app = App()
+		assert SessionMiddleware(handle)(request).data == 'First'
+		assert request.session is None
@@ -0,0 +1,66 @@
+import pytest
+from flex.ussd.core import UssdAppRouter
+from flex.ussd.trie import UssdCodeTrie
+from flex.ussd.wrappers import UssdData
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+class Request(object):
+
+	def __init__(self, ussd_string):
+		self.ussd_string = UssdData(ussd_string)
+		self.route_code = None
+
+
+
+class UssdCodeTrieTest(object):
+
+	def test_longest_prefix(self):
+		trie = UssdCodeTrie([(('384',), 'a'), (('384', '1'), 'b'), (('384', '1', '2', '3'), 'c')])
+		assert len(trie) == 3
+		assert trie.longest_prefix(['384', '1', '2']) == ('b', 2)
+		assert trie.longest_prefix(['384', '1', '2', '3', '4']) == ('c', 4)
+		assert trie.longest_prefix(['384', '5']) == ('a', 1)
+		assert trie.longest_prefix(['0', '384', '1'], 1) == ('b', 2)
+		assert trie.longest_prefix(['385'], default='x') == ('x', None)
+
+	def test_remove(self):
+		trie = UssdCodeTrie([(('384',), 'a'), (('384', '1', '2'), 'b')])
+		trie.remove(('384', '1', '2'))
+		assert ('384', '1', '2') not in trie
+		assert trie.longest_prefix(['384', '1', '2']) == ('a', 1)
+		with pytest.raises(KeyError):
+			trie.remove(('384', '1'))
+
+
+
+class UssdAppRouterTest(object):
+
+	@parametrize('base,codes,ussd_string,expected', [
+		(None, ['384', '384*1', '384*1*2'], '384*1*5', ('384', '1')),
+		(None, ['384', '384*1', '384*1*2'], '384*1*2*9', ('384', '1', '2')),
+		(None, ['384', '384*1', '384*1*2'], '384*2', ('384',)),
+		(None, ['384', '384*1'], '385*1', None),
+		('500', ['1', '1*2'], '500*1*2*3', ('1', '2')),
+		('500', ['1', '1*2'], '501*1*2', None),
+	])
+	def test_resolve(self, base, codes, ussd_string, expected):
+		router = UssdAppRouter(base)
+		for code in codes:
+			router.route(code, code)
+
+		request = Request(ussd_string)
+		route, route_code = router.resolve(request)
+		if expected is None:
+			assert route is None and route_code is None
+		else:
+			assert tuple(route[0]) == expected
+			assert request.route_code == route_code
+
+	def test_duplicate_route(self):
+		router = UssdAppRouter()
+		router.route('384*1', None)
+		with pytest.raises(ValueError):
+			router.route('384*1', None)
@@ -0,0 +1,94 @@
+import pytest
+from flex.ussd.core import UssdApp
+from flex.ussd.sessions import SessionManager
+from flex.ussd.sharding import HashRing, ShardedCacheBackend, phone_number_shard_key
+from flex.ussd.wrappers import UssdRequest
+from ..fixtures import DictStore
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class HashRingTest(object):
+
+	def test_distribution(self):
+		ring = HashRing({'a': 1, 'b': 2, 'c': 3})
+		counts = {}
+		for i in range(3000):
+			name = ring.get_name('07%08d' % i)
+			counts[name] = counts.get(name, 0) + 1
+		assert set(counts) == {'a', 'b', 'c'}
+		assert min(counts.values()) > 700
+
+	def test_minimal_movement(self):
+		ring = HashRing({'a': 1, 'b': 2, 'c': 3})
+		keys = ['07%08d' % i for i in range(4000)]
+		before = {k: ring.get_name(k) for k in keys}
+		ring.add_node('d', 4)
+		moved = [k for k in keys if ring.get_name(k) != before[k]]
+		assert all(ring.get_name(k) == 'd' for k in moved)
+		assert 600 < len(moved) < 1400
+
+		ring.remove_node('d')
+		assert before == {k: ring.get_name(k) for k in keys}
+
+	def test_empty(self):
+		with pytest.raises(LookupError):
+			HashRing().get_node('x')
+
+
+
+class ShardedCacheBackendTest(object):
+
+	@parametrize('key,rv', [
+		('ussd_session:0700', '0700'),
+		('ussd_session:0700:history', '0700'),
+		('x:{0700}:y', '0700'),
+		('plain', 'plain'),
+	])
+	def test_shard_key(self, key, rv):
+		assert phone_number_shard_key(key) == rv
+
+	def test_ops(self):
+		backend = ShardedCacheBackend(shards=[DictStore(), DictStore(), DictStore()], key_prefix='x')
+		mapping = {'s:07%03d' % i: i for i in range(100)}
+		backend.set_many(mapping)
+		assert all(len(s) > 10 for s in backend.ring.nodes.values())
+		assert sum(len(s) for s in backend.ring.nodes.values()) == 100
+		assert backend.get_many(list(mapping) + ['s:missing']) == mapping
+		assert backend.get('s:07001') == 1
+		assert backend.get_shard('s:07001')['x:s:07001'] == 1
+
+		backend.delete_many(list(mapping)[:50])
+		backend.delete('s:07099')
+		assert len(backend.get_many(mapping)) == 49
+
+	def test_sessions_share_a_shard(self):
+		backend = ShardedCacheBackend(shards={'a': DictStore(), 'b': DictStore()})
+		manager = SessionManager(backend=backend, auxiliary_keys=('history',))
+		for i in range(20):
+			session = manager.open(UssdRequest('07%02d' % i, 'sid', '1', service_code='384'))
+			session.aux['history'] = [i]
+			manager.close(session, None)
+
+		for shard in backend.ring.nodes.values():
+			sessions = {k.split(':')[1] for k in shard if not k.endswith(':history')}
+			histories = {k.split(':')[1] for k in shard if k.endswith(':history')}
+			assert sessions and sessions == histories
+
+	def test_app_config(self):
+		app = UssdApp('sharding_tests', cache_backend=ShardedCacheBackend,
+			cache_shards={'a': DictStore, 'b': DictStore}, cache_shard_replicas=10)
+		assert set(app.cache.ring.nodes) == {'a', 'b'}
+		assert app.cache.ring.replicas == 10
+		assert len(app.cache.ring._points) == 20
+
+	def test_app_config_with_shards(self):
+		backend = ShardedCacheBackend(shards={'a': DictStore(), 'b': DictStore()})
+		backend.init_app(UssdApp('sharding_tests', cache_shard_replicas=10))
+		assert len(backend.ring._points) == 20
+
+	def test_requires_shards(self):
+		with pytest.raises(AttributeError):
+			UssdApp('sharding_tests', cache_backend=ShardedCacheBackend).cache
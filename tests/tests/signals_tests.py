@@ -0,0 +1,75 @@
+import pytest
+from flex.ussd import signals
+from flex.ussd.signals import Pipeline
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class App(object):
+
+	def __init__(self, name):
+		self.name = name
+
+
+
+class PipelineTest(object):
+
+	def make_pipeline(self):
+		return Pipeline('test', get_sender_id=lambda app: getattr(app, 'name', app))
+
+	def test_receivers_for_sender(self):
+		pipeline = self.make_pipeline()
+		assert not pipeline.has_receivers() and pipeline.receivers_for(App('a')) == ()
+
+		everyone = pipeline.connect(lambda sender, value: value + ['everyone'])
+
+		@pipeline.connect(sender=App('a'))
+		def only_a(sender, value):
+			return value + ['a']
+
+		assert pipeline.has_receivers(App('a')) and pipeline.has_receivers('b')
+		assert pipeline.receivers_for(App('a')) == (everyone, only_a)
+		assert pipeline.receivers_for('b') == (everyone,)
+		assert pipeline.pipe(App('a'), []) == ['everyone', 'a']
+		assert pipeline.send('b', value=[]) == [(everyone, ['everyone'])]
+
+	def test_compiled_until_connect_or_disconnect(self):
+		pipeline = self.make_pipeline()
+		first = pipeline.connect(lambda sender: 1)
+		compiled = pipeline.receivers_for('a')
+		assert pipeline.receivers_for('a') is compiled
+
+		second = pipeline.connect(lambda sender: 2, sender='a')
+		assert pipeline.receivers_for('a') == (first, second)
+		pipeline.connect(second, sender='a')
+		assert pipeline.receivers_for('a') == (first, second)
+
+		assert pipeline.disconnect(second, sender='a')
+		assert not pipeline.disconnect(second, sender='a')
+		assert pipeline.receivers_for('a') == (first,)
+		assert pipeline.disconnect(first)
+		assert not pipeline.has_receivers()
+
+	def test_unhashable_sender(self):
+		pipeline = Pipeline('test')
+		receiver = pipeline.connect(lambda sender: len(sender))
+		assert pipeline.send([1, 2]) == [(receiver, 2)]
+
+	def test_request_signals(self):
+		from .handlers_tests import make_app, request
+		app, seen = make_app('signals_app', middleware=['flex.ussd.sessions.SessionMiddleware']), []
+		receiver = signals.after_request.connect(lambda sender, **kw: seen.append(kw['response'].data), sender=app)
+		try:
+			app.handler(request())
+			assert seen == ['Menu']
+		finally:
+			signals.after_request.disconnect(receiver, sender=app)
+		assert not signals.after_request.has_receivers(app)
+
+	def test_namespace_resolves_pipelines(self):
+		assert signals.signals.pipeline('after_request') is signals.after_request
+		assert isinstance(signals.after_request, Pipeline)
+		assert signals.after_request.get_sender_id(App('a')) == 'a'
+		assert signals.signals.pipeline('signals_tests') is signals.signals.pipeline('signals_tests')
@@ -0,0 +1,116 @@
+import pytest
+from flex.ussd.cache import CacheBackend
+from flex.ussd.sessions import SessionManager
+from flex.ussd.snapshots import Snapshot, WarmStore, dump_snapshot
+from flex.ussd.stores import MemoryStore, SharedMemoryStore
+from flex.ussd.wrappers import UssdRequest
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class Clock(object):
+
+	def __init__(self, now=1000.0):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+
+
+class SnapshotTest(object):
+
+	def make_store(self, clock):
+		store = MemoryStore(sweep_interval=None, clock=clock)
+		store.set('a', b'1', 10)
+		store.set('b', {'x': 1})
+		store.set('c', b'3', 1)
+		store.cas('a', b'2', 1, 10)
+		return store
+
+	def test_roundtrip(self, tmpdir):
+		clock, path = Clock(), str(tmpdir.join('sessions.snap'))
+		assert dump_snapshot(self.make_store(clock), path, clock) == 3
+
+		clock.now += 2
+		snapshot = Snapshot(path, clock)
+		assert snapshot.taken_at == 1000.0
+		assert len(snapshot) == 2 and 'c' not in snapshot
+		assert snapshot.pop('a') == (b'2', 8.0, 2)
+		assert snapshot.pop('a') is None
+		assert not snapshot.closed
+		snapshot.discard('b')
+		assert snapshot.closed
+
+	def test_not_a_snapshot(self, tmpdir):
+		path = tmpdir.join('x.snap')
+		path.write_binary(b'nope')
+		with pytest.raises(ValueError):
+			Snapshot(str(path))
+
+	def test_warm_store(self, tmpdir):
+		clock, path = Clock(), str(tmpdir.join('sessions.snap'))
+		dump_snapshot(self.make_store(clock), path, clock)
+		clock.now += 2
+		store = WarmStore(MemoryStore(sweep_interval=None, clock=clock), path, clock)
+		assert store.warming and len(store.store) == 0
+
+		assert store.get('a') == b'2'
+		assert store.store.ttl('a') == 8 and len(store.store) == 1
+		assert not store.cas('a', b'x', 1) and store.cas('a', b'x', 2)
+		assert store.get('missing') is None
+
+		store.set('b', 'new')
+		assert not store.warming
+		assert store.get_many(['a', 'b']) == {'a': b'x', 'b': 'new'}
+
+	def test_warm_store_snapshot(self, tmpdir):
+		clock, path = Clock(), str(tmpdir.join('sessions.snap'))
+		dump_snapshot(self.make_store(clock), path, clock)
+		clock.now += 2
+		store = WarmStore(MemoryStore(sweep_interval=None, clock=clock), path, clock)
+		store.delete('a')
+		store.set('d', b'4')
+		assert store.snapshot() == 2
+
+		store = WarmStore(MemoryStore(sweep_interval=None, clock=clock), path, clock)
+		assert store.get_many(['a', 'b', 'd']) == {'b': {'x': 1}, 'd': b'4'}
+
+	def test_missing_file(self, tmpdir):
+		store = WarmStore(MemoryStore(sweep_interval=None), str(tmpdir.join('none.snap')))
+		assert not store.warming and store.get('a') is None
+
+	def test_shared_memory_store(self, tmpdir):
+		path = str(tmpdir.join('sessions.snap'))
+		store = SharedMemoryStore(buckets=4, slot_size=128)
+		try:
+			store.set('a', b'1', 60)
+			store.cas('b', {'x': 1}, 0)
+			assert dump_snapshot(store, path) == 2
+			store.delete_many(['a', 'b'])
+			warm = WarmStore(store, path)
+			assert warm.get_many(['a', 'b']) == {'a': b'1', 'b': {'x': 1}}
+			assert store.cas('b', {'x': 2}, 1)
+		finally:
+			store.close()
+			store.unlink()
+
+	def test_sessions_survive_restart(self, tmpdir):
+		path = str(tmpdir.join('sessions.snap'))
+		request = lambda s: UssdRequest('0700', 'sid', s, service_code='384')
+
+		store = WarmStore(MemoryStore(sweep_interval=None), path)
+		manager = SessionManager(backend=CacheBackend(store=store, key_prefix='x'), versioning=True)
+		session = manager.open(request('1'))
+		session.data.step = 1
+		manager.close(session, None)
+		store.snapshot()
+
+		store = WarmStore(MemoryStore(sweep_interval=None), path)
+		manager = SessionManager(backend=CacheBackend(store=store, key_prefix='x'), versioning=True)
+		session = manager.open(request('1*2'))
+		assert session.data.step == 1 and session.version == 1
+		session.data.step = 2
+		assert manager.close(session, None) is None
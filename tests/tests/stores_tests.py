@@ -0,0 +1,288 @@
+import multiprocessing
+import threading
+import pytest
+from flex.ussd.cache import CacheBackend
+from flex.ussd.sessions import SessionManager
+from flex.ussd.stores import MemoryStore, SharedMemoryStore, ValueTooLarge
+from flex.ussd.wrappers import UssdRequest
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class Clock(object):
+
+	def __init__(self, now=1000.0):
+		self.now = now
+
+	def __call__(self):
+		return self.now
+
+
+
+class MemoryStoreTest(object):
+
+	def make_store(self, **kwargs):
+		kwargs.setdefault('sweep_interval', None)
+		return MemoryStore(**kwargs)
+
+	def test_ops(self):
+		store = self.make_store()
+		store.set('a', 1)
+		store.set_many({'b': 2, 'c': 3})
+		assert store.get('a') == 1
+		assert store.get_many(['a', 'b', 'c', 'd']) == {'a': 1, 'b': 2, 'c': 3}
+		assert store.delete('a') and not store.delete('a')
+		store.delete_many(['b', 'd'])
+		assert len(store) == 1 and 'c' in store
+
+	def test_lazy_expiry(self):
+		clock = Clock()
+		store = self.make_store(clock=clock)
+		store.set('a', 1, 10)
+		store.set('b', 2)
+		assert store.ttl('a') == 10 and store.ttl('b') is None and store.ttl('c') == -1
+		clock.now += 9
+		assert store.get('a') == 1
+		assert store.expire('a', 5)
+		clock.now += 5
+		assert store.get('a') is None
+		assert not store.expire('a', 5)
+		assert store.get('b') == 2
+		assert store.expirations == 1
+
+	def test_sweep(self):
+		clock = Clock()
+		store = self.make_store(clock=clock, sweep_interval=1.0, stripes=4)
+		store.stop_sweeper()
+		for i in range(100):
+			store.set('k%d' % i, i, 1 + i % 10)
+		store.set('forever', 1)
+		store.expire('k0', None)
+		store.set('k1', 1, 50)
+
+		clock.now += 5.5
+		removed = store.sweep()
+		assert removed == 48
+		assert len(store) == 53
+		assert store.sweep() == 0
+
+		clock.now += 100
+		assert store.sweep() == 51
+		assert set(k for s in store.stripes for k in s.data) == {'forever', 'k0'}
+		assert all(not s.wheel for s in store.stripes)
+		assert store.size == sum(store.sizeof(k, store.get(k)) for k in ('forever', 'k0'))
+
+	def test_write_during_sweep(self):
+		clock = Clock()
+		store = self.make_store(clock=clock, sweep_interval=1.0, stripes=2)
+		first, second = store.stripes
+		key = next(k for k in map(str, range(100)) if store.get_stripe(k) is first)
+		clock.now += 5.5
+
+		with second.lock:
+			thread = threading.Thread(target=store.sweep)
+			thread.start()
+			while first.last_tick == 1000:
+				pass
+			# A writer that read the clock before the sweep did.
+			clock.now -= 0.5
+			store.set(key, 1, 0)
+		thread.join()
+
+		assert min(first.wheel) > first.last_tick == store._last_tick
+		clock.now += 10
+		assert store.sweep() == 1 and key not in first.data
+
+	def test_lru_eviction(self):
+		store = self.make_store(stripes=1, max_size=30)
+		for key in ('a', 'b', 'c'):
+			store.set(key, b'x' * 9)
+		store.get('a')
+		store.set('d', b'x' * 9)
+		assert 'b' not in store
+		assert store.get_many(['a', 'c', 'd']).keys() == {'a', 'c', 'd'}
+		assert store.evictions == 1
+		assert store.size == 30
+
+	def test_cas(self):
+		store = self.make_store()
+		assert store.cas('a', 1, 0)
+		assert not store.cas('a', 2, 0)
+		assert store.cas('a', 2, 1)
+		store.set('a', 3)
+		assert not store.cas('a', 4, 2)
+		assert store.get('a') == 3
+
+	def test_background_sweeper(self):
+		store = MemoryStore(sweep_interval=0.01)
+		store.set('a', 1, 0.01)
+		try:
+			for _ in range(200):
+				if not len(store):
+					break
+				threading.Event().wait(0.01)
+			assert len(store) == 0
+		finally:
+			store.close()
+
+	def test_threads(self):
+		store = self.make_store()
+
+		def work(n):
+			for i in range(500):
+				store.set('%d:%d' % (n, i % 50), i, 60)
+				store.get('%d:%d' % (n, (i + 1) % 50))
+
+		threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		assert len(store) == 400
+		assert sum(len(s.wheel[t]) for s in store.stripes for t in s.wheel) == 400
+
+	def test_session_manager(self):
+		manager = SessionManager(backend=CacheBackend(store=self.make_store(), key_prefix='x'))
+		assert manager.backend.supports_cas
+		session = manager.open(UssdRequest('0700', 'sid', '1', service_code='384'))
+		session.data.step = 1
+		manager.close(session, None)
+		assert manager.open(UssdRequest('0700', 'sid', '1*2', service_code='384')).data.step == 1
+
+
+
+class SharedMemoryStoreTest(object):
+
+	@pytest.fixture
+	def stores(self):
+		stores = []
+		yield stores
+		for store in stores:
+			store.close()
+			store.unlink()
+
+	def make_store(self, stores, **kwargs):
+		kwargs.setdefault('buckets', 16)
+		kwargs.setdefault('slot_size', 128)
+		store = SharedMemoryStore(**kwargs)
+		stores.append(store)
+		return store
+
+	def test_ops(self, stores):
+		store = self.make_store(stores)
+		store.set('a', b'1')
+		store.set_many({'b': {'x': 2}, 'c': b'3'})
+		assert store.get('a') == b'1'
+		assert store.get_many(['a', 'b', 'c', 'd']) == {'a': b'1', 'b': {'x': 2}, 'c': b'3'}
+		store.set('a', b'one')
+		assert store.get('a') == b'one'
+		assert store.delete('a') and not store.delete('a')
+		store.delete_many(['b', 'd'])
+		assert len(store) == 1
+
+	def test_expiry(self, stores):
+		clock = Clock()
+		store = self.make_store(stores, clock=clock)
+		store.set('a', b'1', 10)
+		store.set('b', b'2')
+		clock.now += 9
+		assert store.get('a') == b'1'
+		assert store.expire('a', 5)
+		clock.now += 5
+		assert store.get('a') is None and not store.expire('a', 5)
+		assert store.get('b') == b'2'
+
+	def test_cas(self, stores):
+		store = self.make_store(stores)
+		assert store.cas('a', b'1', 0)
+		assert not store.cas('a', b'2', 0)
+		assert store.cas('a', b'2', 1)
+		store.set('a', b'3')
+		assert not store.cas('a', b'4', 2)
+		assert store.get('a') == b'3'
+
+	def test_full_bucket(self, stores):
+		clock = Clock()
+		store = self.make_store(stores, buckets=1, bucket_size=4, clock=clock)
+		for i in range(4):
+			store.set('k%d' % i, b'x', 10 + i)
+		store.set('k4', b'x', 100)
+		assert store.get('k0') is None
+		assert store.get_many(['k1', 'k2', 'k3', 'k4']).keys() == {'k1', 'k2', 'k3', 'k4'}
+
+		clock.now += 12
+		store.set('k5', b'x')
+		assert store.get('k1') is None and store.get('k2') is None
+		assert len(store) == 3
+
+	def test_oversized(self, stores):
+		store = self.make_store(stores)
+		with pytest.raises(ValueTooLarge):
+			store.set('a', b'x' * 128)
+		assert store.get('a') is None
+
+		fallback = MemoryStore(sweep_interval=None)
+		store = self.make_store(stores, oversize_store=fallback)
+		store.set('a', b'x' * 128, 60)
+		assert store.get('a') == b'x' * 128 and len(fallback) == 1
+		store.set('a', b'small')
+		assert store.get('a') == b'small' and len(fallback) == 0
+		store.set('b', b'x' * 128)
+		store.delete('b')
+		assert len(fallback) == 0
+
+	def test_failed_write_keeps_external_value(self, stores):
+		class FailingStore(MemoryStore):
+			def set(self, key, value, timeout=None):
+				if value.startswith(b'fail'):
+					raise ValueError()
+				super(FailingStore, self).set(key, value, timeout)
+
+		fallback = FailingStore(sweep_interval=None)
+		store = self.make_store(stores, oversize_store=fallback)
+		store.set('a', b'x' * 128)
+		with pytest.raises(ValueError):
+			store.set('a', b'fail' * 32)
+		assert store.get('a') == b'x' * 128 and len(fallback) == 1
+		store.set('a', b'y' * 128)
+		assert store.get('a') == b'y' * 128 and len(fallback) == 1
+
+	def test_attach(self, stores):
+		store = self.make_store(stores, bucket_size=2)
+		store.set('a', b'1')
+		with pytest.raises(ValueError):
+			SharedMemoryStore(store.name, create=False)
+		other = SharedMemoryStore(store.name, create=False, locks=store.locks)
+		try:
+			assert (other.buckets, other.bucket_size, other.slot_size) == (16, 2, 128)
+			assert other.get('a') == b'1'
+		finally:
+			other.close()
+
+	@xfail('fork' not in multiprocessing.get_all_start_methods(), reason='requires fork')
+	def test_workers(self, stores):
+		store = self.make_store(stores, buckets=64)
+		ctx = multiprocessing.get_context('fork')
+
+		def work(n):
+			for i in range(50):
+				store.set('%d:%d' % (n, i), b'%d' % i, 60)
+
+		workers = [ctx.Process(target=work, args=(n,)) for n in range(4)]
+		for w in workers:
+			w.start()
+		for w in workers:
+			w.join()
+		assert all(w.exitcode == 0 for w in workers)
+		assert store.get_many(['%d:49' % n for n in range(4)]) == {'%d:49' % n: b'49' for n in range(4)}
+
+	def test_session_manager(self, stores):
+		store = self.make_store(stores, slot_size=1024)
+		manager = SessionManager(backend=CacheBackend(store=store, key_prefix='x'))
+		assert manager.backend.supports_cas
+		session = manager.open(UssdRequest('0700', 'sid', '1', service_code='384'))
+		session.data.step = 1
+		manager.close(session, None)
+		assert manager.open(UssdRequest('0700', 'sid', '1*2', service_code='384')).data.step == 1
@@ -1,5 +1,6 @@
 import pytest
-from flex.ussd.wrappers import UssdData
+from flex.ussd.tokens import tokenize_ussd_string, UssdTokenCache
+from flex.ussd.wrappers import UssdCode, UssdData, UssdDataStack, UssdRequestData
 
 xfail = pytest.mark.xfail
 parametrize = pytest.mark.parametrize
@@ -126,3 +127,149 @@ class UssdDataChunkTest(object):
 	def test__ge__(self):
 		assert False
 
+
+
+
+class UssdRequestDataTest(object):
+
+	def test_partition(self):
+		data = UssdRequestData('384*5*1*2*"a*b"')
+		tokens = data.tokens
+		service_code = data.partition('384', 'service_code')
+		initial_code = data.partition(1, 'initial_code')
+
+		assert data.tokens is tokens
+		assert service_code.tokens is tokens and initial_code.tokens is tokens
+		assert service_code.equals('384')
+		assert initial_code.equals(['5'])
+		assert data.head.equals(['1', '2', 'a*b'])
+		assert data['service_code'] is service_code
+		assert data['head'] is data.head
+		assert len(data) == 5
+		assert list(data) == ['384', '5', '1', '2', 'a*b']
+
+	def test_partition_invalid(self):
+		data = UssdRequestData('384*1')
+		with pytest.raises(ValueError):
+			data.partition('385')
+		with pytest.raises(ValueError):
+			data.partition('384', 'head')
+
+	@parametrize('key,expected', [
+		(0, '1'), (-1, 'a*b'), (2, 'a*b'), (slice(1, None), ['2', 'a*b']),
+	])
+	def test_head_getitem(self, key, expected):
+		data = UssdRequestData('384*1*2*"a*b"')
+		data.partition(1, 'service_code')
+		rv = data.head[key]
+		assert (list(rv) if isinstance(key, slice) else rv) == expected
+
+
+
+class TokenizeUssdStringTest(object):
+
+	@parametrize('raw,expected', [
+		('', ['']),
+		('123*4*00', ['123', '4', '00']),
+		('123**00*', ['123', '', '00', '']),
+		('123*"my*input"*00', ['123', 'my*input', '00']),
+		('123*"a*b"*"c*d"', ['123', 'a*b', 'c*d']),
+		('123*"unbalanced*00', ['123*"unbalanced', '00']),
+		('123*in"ner"*00', ['123', 'in"ner"', '00']),
+	])
+	def test_tokenize(self, raw, expected):
+		assert tokenize_ussd_string(raw) == expected
+
+
+
+class UssdTokenCacheTest(object):
+
+	def test_get(self):
+		cache = UssdTokenCache(maxsize=2, max_length=10)
+		assert cache.get('123*"a*b"') == ('123', 'a*b')
+		assert cache.get('123*"a*b"') == ('123', 'a*b')
+		assert (cache.hits, cache.misses) == (1, 1)
+
+		cache.get('1')
+		cache.get('2')
+		cache.get('123*"a*b"')
+		assert cache.info().currsize == 2
+		assert cache.misses == 4
+
+	def test_bypass_long_strings(self):
+		cache = UssdTokenCache(max_length=4)
+		assert cache.get('12*34*56') == ('12', '34', '56')
+		assert cache.bypassed == 1
+		assert cache.info().currsize == 0
+
+
+
+class UssdDataStackTest(object):
+
+	chunks = [['1', '2'], [], ['3'], ['4', '5', '6']]
+
+	def test_len(self):
+		assert len(UssdDataStack(self.chunks)) == 6
+		assert len(UssdDataStack('1*2*3')) == 3
+
+	@parametrize('key', [0, 1, 2, 5, -1, -4, -6, slice(1, 4), slice(None, -2), slice(2, None), slice(None, None, 2)])
+	def test_getitem(self, key):
+		flat = [v for c in self.chunks for v in c]
+		assert UssdDataStack(self.chunks)[key] == flat[key]
+
+	@parametrize('key', [6, -7])
+	def test_getitem_out_of_range(self, key):
+		with pytest.raises(IndexError):
+			UssdDataStack(self.chunks)[key]
+
+
+
+class UssdCodeTest(object):
+
+	def test_hash(self):
+		code = UssdCode('384*"a*b"')
+		assert hash(code) == hash(('384', 'a*b'))
+		assert {code: 1}[('384', 'a*b')] == 1
+		assert {('384', 'a*b'): 1}[code] == 1
+		assert {UssdCode(['384', 'a*b']): 1}[code] == 1
+
+	@parametrize('other,expected', [
+		('384*1', False),
+		(('384', '1'), True),
+		(['384', '1'], True),
+		(UssdData('384*1'), True),
+		('384', False),
+		(('384', '1', '2'), False),
+		(384, False),
+	])
+	def test_eq(self, other, expected):
+		code = UssdCode('384*1')
+		assert (code == other) == expected
+		assert (code != other) != expected
+
+	@parametrize('other,expected', [
+		('384*1', True),
+		('384*"1"', True),
+		('384', False),
+	])
+	def test_equals_str(self, other, expected):
+		assert UssdCode('384*1').equals(other) == expected
+
+	def test_str_keys(self):
+		code = UssdCode('*123#')
+		assert code != '*123#' and code not in {'*123#': 1}
+		assert '*123#' not in {code: 1}
+
+	def test_startswith(self):
+		code = UssdCode('384*1*2')
+		assert code.startswith('384*1')
+		assert code.startswith(UssdCode('384'))
+		assert not code.startswith('384*2')
+		assert code.endswith(('1', '2'))
+		assert UssdData('384*1*2').startswith(UssdCode('384*1'))
+
+	def test_immutable(self):
+		code = UssdCode('384')
+		with pytest.raises(AttributeError):
+			code._tokens = ()
+		assert code.copy() is code
@@ -0,0 +1,77 @@
+import pytest
+from flex.ussd.views import UssdView, UssdAppMatcher
+from flex.ussd.wrappers import UssdRequest
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+class UssdAppMatcherTest(object):
+
+	apps = [('384', 'a'), ('384*1', 'b'), ('384*1*2', 'c'), ('500', 'd')]
+
+	@parametrize('ussd_string,expected', [
+		('384', ('384', 'a', 1)),
+		('384*9', ('384', 'a', 1)),
+		('384*1*5', ('384*1', 'b', 2)),
+		('384*1*2*9*9', ('384*1*2', 'c', 3)),
+		('3841', None),
+		('600*1', None),
+	])
+	def test_match(self, ussd_string, expected):
+		rv = UssdAppMatcher(self.apps).match(ussd_string)
+		assert (rv if rv is None else tuple(rv)) == expected
+
+	def test_view_rebuilds_stale_matcher(self):
+		class View(UssdView):
+			ussd_apps = [('384', 'a')]
+
+		view = View()
+		matcher = view.get_app_matcher()
+		assert view.get_app_matcher() is matcher
+
+		View.ussd_apps.append(('384*1', 'b'))
+		assert view.get_app_matcher() is not matcher
+		assert len(view.get_app_matcher()) == 2
+
+	def test_register_resets_matcher(self):
+		class View(UssdView):
+			ussd_apps = [('384', 'a')]
+
+		view = View()
+		matcher = view.get_app_matcher()
+		View.ussd_apps[0] = ('500', 'd')
+		View.reset_app_matcher()
+		assert view.get_app_matcher().match('500*1').app == 'd'
+
+		View.register_ussd_app('384', 'a')
+		assert view.get_app_matcher().match('384').app == 'a'
+		assert UssdView.ussd_apps == []
+
+
+
+class UssdViewTest(object):
+
+	class View(UssdView):
+
+		ussd_apps = [('384', lambda request: request), ('384*1', lambda request: request)]
+
+		def make_ussd_request(self, http_request):
+			return UssdRequest('0700', 'sid', http_request)
+
+	def test_match_ussd_app(self):
+		view, request = self.View(), UssdRequest('0700', 'sid', '384*1*5')
+		assert view.match_ussd_app(request) == self.View.ussd_apps[1]
+		assert request.input_offset == 2 and not request.parsed
+
+	def test_dispatch(self):
+		request = self.View().dispatch_ussd_request('384*1*5')
+		assert request.app_code == '384*1' and request.input_offset == 2
+
+	def test_dispatch_with_overridden_match(self):
+		class View(self.View):
+			def match_ussd_app(self, request):
+				return self.ussd_apps[0]
+
+		request = View().dispatch_ussd_request('384*1*5')
+		assert request.app_code == '384' and request.input_offset == 1
@@ -0,0 +1,274 @@
+import asyncio
+import os
+import threading
+import pytest
+from flex.ussd.cache import AsyncCacheBackend, CacheBackend
+from flex.ussd.response import UssdResponse, UssdStatus
+from flex.ussd.sessions import AsyncSessionManager, SessionManager
+from flex.ussd.stores import MemoryStore
+from flex.ussd.wrappers import UssdRequest
+from flex.ussd.writebehind import AsyncWriteBehindBackend, WriteBehindBackend
+
+xfail = pytest.mark.xfail
+parametrize = pytest.mark.parametrize
+
+
+
+class RecordingStore(MemoryStore):
+
+	def __init__(self):
+		super(RecordingStore, self).__init__(sweep_interval=None)
+		self.calls = []
+		self.versions = {}
+
+	def get_fields(self, key):
+		return self.get(key)
+
+	def set_fields(self, key, mapping, timeout=None):
+		self.calls.append(('set_fields', key, sorted(mapping)))
+		self.set(key, dict(self.get(key) or (), **mapping), timeout)
+
+	def cas_fields(self, key, mapping, version, timeout=None):
+		self.calls.append(('cas_fields', key, version))
+		if self.versions.get(key, 0) != version:
+			return False
+		self.versions[key] = version + 1
+		self.set(key, dict(self.get(key) or (), **mapping), timeout)
+		return True
+
+	def set_many(self, mapping, timeout=None):
+		self.calls.append(('set_many', sorted(mapping)))
+		super(RecordingStore, self).set_many(mapping, timeout)
+
+
+
+class WriteBehindBackendTest(object):
+
+	def make_backend(self, **kwargs):
+		kwargs.setdefault('interval', None)
+		return WriteBehindBackend(CacheBackend(store=RecordingStore(), key_prefix=''), **kwargs)
+
+	def test_coalesces_writes(self):
+		backend = self.make_backend()
+		store = backend.backend.store
+		backend.set('a', 1)
+		backend.set('a', 2)
+		backend.set_many({'b': 1, 'c': 1})
+		backend.delete('c')
+		backend.set_fields('h', {'x': 1})
+		backend.set_fields('h', {'y': 2})
+		backend.expire('h', 30)
+		assert len(backend) == 4 and not store.calls
+
+		backend.flush()
+		assert store.calls == [('set_many', ['a', 'b']), ('set_fields', 'h', ['x', 'y'])]
+		assert store.get_many(['a', 'b', 'c']) == {'a': 2, 'b': 1}
+		assert 29 < store.ttl('h') <= 30
+		assert len(backend) == 0
+
+	def test_reads_own_writes(self):
+		backend = self.make_backend()
+		store = backend.backend.store
+		store.set('h', {'x': 1, 'y': 1})
+		store.set('d', 1)
+		backend.set_fields('h', {'y': 2})
+		backend.set('a', 1)
+		backend.delete('d')
+		assert backend.get('a') == 1 and backend.get('d') is None
+		assert backend.get_fields('h') == {'x': 1, 'y': 2}
+		assert backend.get_many(['a', 'd', 'e']) == {'a': 1}
+
+	def test_cas(self):
+		backend = self.make_backend()
+		store = backend.backend.store
+		assert backend.cas_fields('h', {'x': 1}, 0)
+		assert backend.cas_fields('h', {'x': 2}, 1)
+		backend.expire('h', 30)
+		assert not backend.cas_fields('h', {'x': 3}, 1)
+		backend.flush()
+		assert store.calls == [('cas_fields', 'h', 0), ('cas_fields', 'h', 1)]
+		assert store.versions['h'] == 2 and store.get('h') == {'x': 2}
+
+		store.versions['h'] = 5
+		assert backend.cas_fields('h', {'x': 4}, 2)
+		backend.flush()
+		assert backend.conflicts == 1 and store.get('h') == {'x': 2}
+
+	def test_backpressure(self):
+		backend = self.make_backend(maxsize=2)
+		store = backend.backend.store
+		backend.set('a', 1)
+		backend.set('b', 1)
+		backend.set('a', 2)
+		assert not store.calls
+		backend.set('c', 1)
+		assert store.calls == [('set_many', ['a', 'b'])]
+		assert len(backend) == 1
+
+	def test_flusher_thread(self):
+		backend = self.make_backend(interval=0.001)
+		store = backend.backend.store
+		backend.set('a', 1)
+		for _ in range(500):
+			if store.get('a') is not None:
+				break
+			threading.Event().wait(0.01)
+		assert store.get('a') == 1
+		backend.set('b', 1)
+		backend.close()
+		assert store.get('b') == 1
+
+	def test_starts_flusher_on_write(self):
+		backend = self.make_backend(interval=60)
+		assert backend._flusher is None
+		backend.set('a', 1)
+		assert backend._flusher.is_alive()
+		backend.close()
+		assert backend._flusher is None and backend.backend.store.get('a') == 1
+
+	@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires os.fork')
+	def test_fork(self):
+		backend = self.make_backend(interval=60)
+		backend.set('a', 1)
+		pid = os.fork()
+		if pid == 0:
+			ok = len(backend) == 0 and backend._flusher is None
+			backend.set('b', 1)
+			os._exit(0 if ok and backend._flusher.is_alive() else 1)
+		assert os.waitpid(pid, 0)[1] == 0
+		assert len(backend) == 1
+		backend.close()
+		assert backend.backend.store.get('a') == 1
+
+	def test_failed_flush_is_retried(self):
+		backend = self.make_backend()
+		store = backend.backend.store
+		backend.set('a', 1)
+		assert backend.cas_fields('h', {'x': 1}, 0)
+		assert backend.cas_fields('h', {'x': 2}, 1)
+
+		cas_fields, calls = store.cas_fields, []
+		def failing(key, mapping, version, timeout=None):
+			calls.append(version)
+			if len(calls) == 2:
+				raise ConnectionError()
+			return cas_fields(key, mapping, version, timeout)
+
+		store.cas_fields = failing
+		backend.flush()
+		assert backend.errors == 1 and backend.failures == 1
+		assert store.get('a') == 1 and store.versions['h'] == 1
+		assert list(backend.inflight) == ['h'] and len(backend.inflight['h']) == 1
+		assert backend.get_fields('h') == {'x': 2}
+		assert backend.get_delay() == 0.1
+
+		assert backend.cas_fields('h', {'y': 1}, 2)
+		backend.set('a', 2)
+		assert backend.get('a') == 2 and backend.get_fields('h') == {'x': 2, 'y': 1}
+		backend.flush()
+		assert calls == [0, 1, 1, 2]
+		assert backend.failures == 0 and not backend.inflight and backend.conflicts == 0
+		assert store.get('a') == 2 and store.get('h') == {'x': 2, 'y': 1} and store.versions['h'] == 3
+
+	def test_backoff(self):
+		backend = self.make_backend(interval=None)
+		backend.failures = 3
+		assert backend.get_delay() == 0.4
+		backend.failures = 20
+		assert backend.get_delay() == backend.max_backoff
+
+
+
+class AsyncWriteBehindBackendTest(object):
+
+	def test_failed_flush_is_retried(self):
+		store = RecordingStore()
+		backend = AsyncWriteBehindBackend(AsyncCacheBackend(store=store, key_prefix=''), interval=None)
+		set_many, calls = store.set_many, []
+		def failing(mapping, timeout=None):
+			calls.append(sorted(mapping))
+			if len(calls) == 1:
+				raise ConnectionError()
+			set_many(mapping, timeout)
+
+		store.set_many = failing
+
+		async def run():
+			await backend.set_many({'a': 1, 'b': 1})
+			await backend.delete('c')
+			await backend.flush()
+			assert backend.errors == 1 and list(backend.inflight) == ['a', 'b']
+			assert await backend.get_many(['a', 'b']) == {'a': 1, 'b': 1}
+			await backend.set('b', 2)
+			await backend.flush()
+			assert not backend.inflight and backend.failures == 0
+
+		store.set('c', 1)
+		asyncio.run(run())
+		assert calls == [['a', 'b'], ['a', 'b']]
+		assert store.get_many(['a', 'b', 'c']) == {'a': 1, 'b': 2}
+
+
+
+class SessionManagerWriteBehindTest(object):
+
+	def open(self, manager, ussd_string='1'):
+		return manager.open(UssdRequest('0700', 'sid', ussd_string, service_code='384'))
+
+	def make_manager(self, **kwargs):
+		store = RecordingStore()
+		return SessionManager(
+			backend=CacheBackend(store=store, key_prefix=''), versioning=True, write_behind=True,
+			write_behind_interval=None, **kwargs
+		), store
+
+	def test_next_turn_reads_its_writes(self):
+		manager, store = self.make_manager(auxiliary_keys=('menu',))
+		session = self.open(manager)
+		session.data.step = 1
+		session.aux['menu'] = 'main'
+		manager.close(session, UssdResponse('Start'))
+		assert not store.calls
+
+		session = self.open(manager, '1*2')
+		assert session.data.step == 1 and session.aux == {'menu': 'main'}
+		session.data.step = 2
+		manager.close(session, UssdResponse('Next'))
+
+		manager.flush()
+		assert [c[0] for c in store.calls] == ['set_many', 'cas_fields', 'cas_fields']
+		assert store.versions['ussd_session:0700'] == 2
+		manager.write_behind = False
+		session = self.open(manager, '1*2*3')
+		assert session.data.step == 2 and session.version == 2
+
+	def test_local_race(self):
+		manager, store = self.make_manager()
+		manager.close(self.open(manager), UssdResponse('Start'))
+		first, second = self.open(manager, '1*2'), self.open(manager, '1*2')
+		first.data.step, second.data.step = 1, 2
+		assert manager.close(first, UssdResponse('First')) is None
+		rv = manager.close(second, UssdResponse('Second', UssdStatus.END))
+		assert rv.data == 'First'
+
+	def test_async(self):
+		store = RecordingStore()
+		manager = AsyncSessionManager(
+			backend=AsyncCacheBackend(store=store, key_prefix=''), versioning=True, write_behind=True,
+			write_behind_interval=0.001
+		)
+
+		async def run():
+			session = await manager.open(UssdRequest('0700', 'sid', '1', service_code='384'))
+			session.data.step = 1
+			await manager.close(session, None)
+			session = await manager.open(UssdRequest('0700', 'sid', '1*2', service_code='384'))
+			assert session.data.step == 1
+			await asyncio.sleep(0.05)
+			assert store.calls
+			session.data.step = 2
+			await manager.close(session, None)
+			await manager.backend.close()
+
+		asyncio.run(run())
+		assert store.versions['ussd_session:0700'] == 2